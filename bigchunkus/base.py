@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
 import itertools
-from typing import Dict, List, Union, Tuple
+from typing import Dict, List, Optional, Sequence, Union, Tuple
 import xarray as xr
 
 class BaseChunkPlanner(ABC):
@@ -18,6 +18,26 @@ class BaseChunkPlanner(ABC):
             from .single import SingleSourceChunkPlanner
             return SingleSourceChunkPlanner(datasets[0])
 
+    @classmethod
+    def from_paths(cls, paths: Sequence[str], engine: Optional[str] = "h5netcdf", max_workers: Optional[int] = None, index: Optional[str] = None):
+        """
+        Plan from files without keeping them open.
+
+        Headers are read on `max_workers` threads and, with `index`, cached in a JSON
+        sidecar file so unchanged files are not reopened (see `sources.read_metadata`).
+        The paths themselves become the planner's sources.
+        """
+        if not paths:
+            raise ValueError("At least one path must be provided.")
+        elif len(paths) > 1:
+            from .sources import read_metadata
+            from .unmerged import UnmergedChunkPlanner
+            metadata = read_metadata(paths, engine=engine, max_workers=max_workers, index=index)
+            return UnmergedChunkPlanner(*paths, metadata=metadata)
+        else:
+            from .single import SingleSourceChunkPlanner
+            return SingleSourceChunkPlanner(xr.open_dataset(paths[0], engine=engine))
+
     @abstractmethod
     def map_chunks(self, chunk_definition: Dict[str, int]) -> dict:
         pass
@@ -0,0 +1,261 @@
+"""
+Planning benchmarks over synthetic, metadata-only archives.
+
+Sources are described by `SourceMetadata` alone and never opened, so archives of any
+size are planned offline and without touching disk. Run with
+`python -m bigchunkus.benchmark`, optionally comparing against a stored baseline.
+"""
+from .sources import SourceMetadata
+from .unmerged import UnmergedChunkPlanner
+
+import argparse
+import collections
+import gc
+import json
+import math
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+RESULTS_FORMAT_VERSION = 2
+DIMS = ("time", "level", "y", "x")
+# Wall times: planning, enumerating every (zarr_key, slices) record, and every zarr key
+TIMED_METRICS = ("seconds", "iterate_seconds", "keys_seconds")
+# Metrics which depend only on the scenario, and so must match the baseline exactly
+EXACT_METRICS = ("n_chunks", "n_pieces", "table_bytes")
+
+
+class Scenario(NamedTuple):
+    """A synthetic archive of `n_sources` files concatenated along time, and its chunking."""
+    name: str
+    family: str
+    n_sources: int
+    n_dims: int
+    n_variables: int
+    ragged: bool
+    steps_per_source: int = 24
+    chunk_size: int = 10
+    seed: int = 0
+
+    @property
+    def dims(self) -> Sequence[str]:
+        # Time always comes first; the other dimensions fill in from the right
+        return ("time",) + DIMS[len(DIMS) - self.n_dims + 1:]
+
+
+class Regression(NamedTuple):
+    name: str
+    metric: str
+    baseline: float
+    current: float
+
+
+def synthetic_metadata(scenario: Scenario) -> List[SourceMetadata]:
+    """Metadata of the sources of `scenario`, in shuffled order, with time bounds to sort them by."""
+    rng = np.random.default_rng(scenario.seed)
+    if scenario.ragged:
+        steps = rng.integers(1, 2 * scenario.steps_per_source, size=scenario.n_sources)
+    else:
+        steps = np.full(scenario.n_sources, scenario.steps_per_source)
+    starts = np.concatenate([[0], np.cumsum(steps)[:-1]])
+
+    sizes = {dim: 16 for dim in scenario.dims[1:]}
+    variables = {f"var_{n}": tuple(scenario.dims) for n in range(scenario.n_variables)}
+    dtypes = {name: "<f4" for name in variables}
+    native_chunks = {name: {"time": 1, **sizes} for name in variables}
+
+    metadata = []
+    for n in rng.permutation(scenario.n_sources).tolist():
+        bounds = {"time": np.array([starts[n], starts[n] + steps[n] - 1])}
+        metadata.append(SourceMetadata({"time": int(steps[n]), **sizes}, variables, dtypes, {}, native_chunks, bounds))
+    return metadata
+
+
+def plan_scenario(scenario: Scenario, metadata: Sequence[SourceMetadata]):
+    """Order and concatenate the sources of `scenario` and plan its chunking."""
+    paths = [f"synthetic/{n}.nc" for n in range(len(metadata))]
+    planner = UnmergedChunkPlanner(*paths, metadata=metadata).concat("time")
+    chunk_definition = {dim: scenario.chunk_size if dim == "time" else 8 for dim in scenario.dims}
+    return planner.plan(chunk_definition)
+
+
+def _best_time(function: Callable[[], Any], repeat: int) -> float:
+    seconds = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return min(seconds)
+
+
+def measure(scenario: Scenario, repeat: int = 3) -> Dict[str, Any]:
+    """
+    Plan `scenario` and report the best wall time over `repeat` runs of planning, of
+    enumerating the plan's records (`iter_chunks`) and of enumerating its zarr keys, the
+    peak memory traced while planning once more, and the size of the plan.
+
+    Building the synthetic metadata is not measured.
+    """
+    metadata = synthetic_metadata(scenario)
+    seconds = _best_time(lambda: plan_scenario(scenario, metadata), repeat)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        plan = plan_scenario(scenario, metadata)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # Consumed without being kept, as an orchestrator dispatching them would
+    iterate_seconds = _best_time(lambda: collections.deque(plan.iter_chunks(), maxlen=0), repeat)
+    keys_seconds = _best_time(lambda: collections.deque(iter(plan), maxlen=0), repeat)
+
+    tables = plan.dim_tables.values()
+    return {
+        "name": scenario.name,
+        "family": scenario.family,
+        "parameters": scenario._asdict(),
+        "seconds": seconds,
+        "iterate_seconds": iterate_seconds,
+        "keys_seconds": keys_seconds,
+        "peak_bytes": peak_bytes,
+        "n_chunks": sum(math.prod(plan.chunk_grid(var_name)) for var_name in plan.variables),
+        "n_pieces": sum(len(pieces) for _, pieces in tables),
+        "table_bytes": sum(indptr.nbytes + pieces.nbytes for indptr, pieces in tables),
+    }
+
+
+def default_scenarios(max_sources: int = 100_000) -> List[Scenario]:
+    """
+    The benchmark families: source counts from 10 up to `max_sources`, one to four
+    dimensions, one to a hundred variables, and uniform against ragged source lengths
+    (the last three with at most `max_sources` sources).
+    """
+    scenarios = []
+    medium, large = min(1000, max_sources), min(10_000, max_sources)
+    n = 10
+    while n <= max_sources:
+        scenarios.append(Scenario(f"sources-{n}", "sources", n, 3, 2, True))
+        n *= 10
+    for n_dims in range(1, 5):
+        scenarios.append(Scenario(f"dims-{n_dims}", "dims", medium, n_dims, 2, True))
+    for n_variables in (1, 10, 100):
+        scenarios.append(Scenario(f"variables-{n_variables}", "variables", medium, 3, n_variables, True))
+    for ragged in (False, True):
+        scenarios.append(Scenario(f"ragged-{str(ragged).lower()}", "ragged", large, 3, 2, ragged))
+    return scenarios
+
+
+# The parameter each family sweeps, against which its scaling exponent is fitted
+_FAMILY_PARAMETERS = {"sources": "n_sources", "dims": "n_dims", "variables": "n_variables"}
+
+
+def scaling_exponents(results: Sequence[Dict[str, Any]], metric: str = "seconds") -> Dict[str, float]:
+    """
+    Slope of log(`metric`) against log(swept parameter) per family: about 1 for
+    linear scaling, 2 for quadratic.
+    """
+    exponents = {}
+    for family, parameter in _FAMILY_PARAMETERS.items():
+        points = [(r["parameters"][parameter], r[metric]) for r in results if r["family"] == family and r[metric] > 0]
+        if len({x for x, _ in points}) < 2:
+            continue
+        x, y = np.log(np.array(points, dtype=float)).T
+        exponents[family] = float(np.polyfit(x, y, 1)[0])
+    return exponents
+
+
+def run(scenarios: Optional[Sequence[Scenario]] = None, repeat: int = 3, log: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    """Measure every scenario (the default families if none are given) and fit scaling exponents."""
+    results = []
+    for scenario in default_scenarios() if scenarios is None else scenarios:
+        result = measure(scenario, repeat)
+        results.append(result)
+        if log is not None:
+            log(
+                f"{result['name']}: plan {result['seconds'] * 1e3:.1f} ms, iterate {result['iterate_seconds'] * 1e3:.1f} ms, "
+                f"keys {result['keys_seconds'] * 1e3:.1f} ms, peak {result['peak_bytes'] / 2**20:.1f} MiB, {result['n_chunks']} chunks"
+            )
+    return {
+        "version": RESULTS_FORMAT_VERSION,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "results": results,
+        "scaling": {metric: scaling_exponents(results, metric) for metric in (*TIMED_METRICS, "peak_bytes")},
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.5, min_seconds: float = 0.005, exponent_tolerance: float = 0.25) -> List[Regression]:
+    """
+    Regressions of `current` results against `baseline`, for the scenarios both hold
+    with the same parameters.
+
+    Wall times (`TIMED_METRICS`) and peak memory regress when they grow by more than
+    `tolerance` (a fraction; wall times must also grow by `min_seconds`, to ignore timer
+    noise), plan sizes when they change at all, and scaling exponents when they grow by
+    more than `exponent_tolerance`. Metrics the baseline does not hold are not compared.
+    """
+    regressions = []
+    baseline_results = {r["name"]: r for r in baseline["results"]}
+    shared = []
+    for result in current["results"]:
+        previous = baseline_results.get(result["name"])
+        # Capped runs (--max-sources) plan some scenarios with fewer sources than the baseline did
+        if previous is None or previous["parameters"] != result["parameters"]:
+            continue
+        shared.append(previous)
+        for metric in TIMED_METRICS:
+            if metric not in previous:
+                continue
+            if result[metric] > previous[metric] * (1 + tolerance) and result[metric] - previous[metric] > min_seconds:
+                regressions.append(Regression(result["name"], metric, previous[metric], result[metric]))
+        if result["peak_bytes"] > previous["peak_bytes"] * (1 + tolerance):
+            regressions.append(Regression(result["name"], "peak_bytes", previous["peak_bytes"], result["peak_bytes"]))
+        for metric in EXACT_METRICS:
+            if result[metric] != previous[metric]:
+                regressions.append(Regression(result["name"], metric, previous[metric], result[metric]))
+
+    # Exponents are refitted over the baseline scenarios also run now, so partial runs compare like with like
+    for metric, exponents in current["scaling"].items():
+        if not all(metric in previous for previous in shared):
+            continue
+        baseline_exponents = scaling_exponents(shared, metric)
+        for family, exponent in exponents.items():
+            previous = baseline_exponents.get(family)
+            if previous is not None and exponent > previous + exponent_tolerance:
+                regressions.append(Regression(f"scaling-{family}", metric, previous, exponent))
+    return regressions
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", help="write results as JSON to this path")
+    parser.add_argument("--baseline", help="compare against results stored at this path")
+    parser.add_argument("--max-sources", type=int, default=100_000, help="largest source count to plan")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per scenario; the fastest is kept")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed relative growth of time and memory")
+    args = parser.parse_args(argv)
+
+    results = run(default_scenarios(args.max_sources), args.repeat, log=print)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression.name} {regression.metric}: {regression.baseline:.4g} -> {regression.current:.4g}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,224 @@
+from .merge.merge import MergePlan
+from .merge.mosaic import MosaicPlan
+from .plan import PLAN_FORMAT_VERSION, ChunkPlan, _source_name
+from .util import merge_chunk_definitions
+
+import copy
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple, Union
+
+import numpy as np
+
+CACHE_ENTRY = "entry.json"
+_PLAN_TYPES = {cls.__name__: cls for cls in (ChunkPlan, MosaicPlan, MergePlan)}
+# Planner attributes, besides metadata and sources, which determine its plans
+_LAYOUT_ATTRIBUTES = ("concat_dim_name", "offsets", "concat_dim_ranges", "grid", "grid_dims")
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def _fingerprint(planner: Any) -> Tuple[str, bool]:
+    """The `source_fingerprint` of `planner`, and whether all its sources are named."""
+    metadata = planner.metadata
+    record = {
+        "version": PLAN_FORMAT_VERSION,
+        "planner": type(planner).__name__,
+        "sizes": metadata.sizes,
+        "variables": metadata.variables,
+        "dtypes": metadata.dtypes,
+        "chunks": metadata.chunks,
+        "parts": [source_fingerprint(part) for part in getattr(planner, "parts", [])],
+    }
+    digest = hashlib.sha256(json.dumps(record, sort_keys=True, default=_json_default).encode())
+    sources = planner.source_datasets
+    names = [_source_name(source) for source in sources]
+    named = None not in names
+    if not named:
+        names = [f"\1{id(source)}" if name is None else name for name, source in zip(names, sources)]
+    digest.update("\0".join(names).encode())
+    for attribute in _LAYOUT_ATTRIBUTES:
+        if hasattr(planner, attribute):
+            value = np.asarray(getattr(planner, attribute))
+            digest.update(f"{attribute}:{value.dtype.str}:{value.shape}".encode())
+            digest.update(value.tobytes())
+    return digest.hexdigest(), named
+
+
+def source_fingerprint(planner: Any) -> str:
+    """
+    Stable hash of what a planner's plans depend on: its type, the names of its sources,
+    their combined sizes, dimensions and dtypes, and their layout (concat offsets, tile
+    grid, or the fingerprints of the parts of a merge).
+
+    Sources without a name, such as in-memory datasets, are identified by the object
+    itself, so their fingerprint only holds in this process and while they are alive.
+    Per-source values are hashed as arrays rather than serialized one by one, so that
+    fingerprinting stays cheaper than planning even for 100k sources.
+    """
+    return _fingerprint(planner)[0]
+
+
+def _plan_nbytes(plan: ChunkPlan) -> int:
+    return sum(indptr.nbytes + pieces.nbytes for indptr, pieces in plan.dim_tables.values())
+
+
+def _with_sources(plan: ChunkPlan, planner: Any) -> ChunkPlan:
+    """Shallow copy of a cached plan reading from the sources of `planner`."""
+    plan = copy.copy(plan)
+    plan.sources = list(planner.source_datasets)
+    return plan
+
+
+def _directory_nbytes(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+class PlanCache:
+    """
+    Opt-in cache of full-output plans, in memory and, with `directory`, on disk.
+
+    Plans are keyed by the `source_fingerprint` of their planner and the chunk
+    definition, normalized with `util.merge_chunk_definitions` against the planner's
+    defaults. Least recently used plans are dropped from memory beyond `max_entries`
+    plans or `max_bytes` of dimension tables, and from disk beyond `max_disk_bytes`.
+    Plans on disk are written with `save` and memory-mapped back with `open`, so a plan
+    cached by another process loads without being recomputed. Plans of planners with
+    unnamed sources (see `source_fingerprint`) are only cached in memory, where the
+    cached plan keeps those sources alive. Cached plans are returned as shallow copies
+    using the sources of the planner asking for them.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 32,
+        max_bytes: int = 256 * 2**20,
+        directory: Optional[Union[str, os.PathLike]] = None,
+        max_disk_bytes: Optional[int] = None,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = os.fspath(directory) if directory is not None else None
+        self.max_disk_bytes = max_disk_bytes
+        self.nbytes = 0
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+        self._plans: "OrderedDict[str, Tuple[ChunkPlan, int]]" = OrderedDict()
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, planner: Any, chunk_definition: Dict[str, int]) -> str:
+        """Cache key of the plan of `planner` for `chunk_definition`."""
+        return self._key(planner, chunk_definition)[0]
+
+    def _key(self, planner: Any, chunk_definition: Dict[str, int]) -> Tuple[str, bool]:
+        defaults = {**planner.metadata.sizes, **planner.metadata.chunks}
+        normalized = merge_chunk_definitions(chunk_definition, defaults)
+        definition = json.dumps(sorted(normalized.items()), default=_json_default).encode()
+        fingerprint, named = _fingerprint(planner)
+        return f"{fingerprint}-{hashlib.sha256(definition).hexdigest()[:16]}", named
+
+    def plan(self, planner: Any, chunk_definition: Dict[str, int]) -> ChunkPlan:
+        """The plan of `planner` for `chunk_definition`, from the cache if held, else built and cached."""
+        key, named = self._key(planner, chunk_definition)
+        if key in self._plans:
+            self._plans.move_to_end(key)
+            self.stats["hits"] += 1
+            return _with_sources(self._plans[key][0], planner)
+
+        plan = self._load(key) if named else None
+        if plan is not None:
+            self.stats["disk_hits"] += 1
+        else:
+            self.stats["misses"] += 1
+            plan = planner.plan(chunk_definition)
+            if named:
+                self._store(key, plan)
+        self._remember(key, plan)
+        return _with_sources(plan, planner)
+
+    def invalidate(self, planner: Any = None, chunk_definition: Optional[Dict[str, int]] = None) -> int:
+        """
+        Drop cached plans: all of them, those of `planner`, or just its plan for
+        `chunk_definition`. Returns the number of plans dropped from memory and disk.
+        """
+        if planner is None:
+            prefix = ""
+        elif chunk_definition is None:
+            prefix = source_fingerprint(planner) + "-"
+        else:
+            prefix = self.key(planner, chunk_definition)
+
+        dropped = 0
+        for key in [key for key in self._plans if key.startswith(prefix)]:
+            self.nbytes -= self._plans.pop(key)[1]
+            dropped += 1
+        if self.directory is not None:
+            for entry in os.scandir(self.directory):
+                if entry.is_dir() and not entry.name.startswith(".") and entry.name.startswith(prefix):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    dropped += 1
+        return dropped
+
+    def clear(self) -> None:
+        self.invalidate()
+
+    def _remember(self, key: str, plan: ChunkPlan) -> None:
+        nbytes = _plan_nbytes(plan)
+        self._plans[key] = (plan, nbytes)
+        self.nbytes += nbytes
+        while len(self._plans) > 1 and (len(self._plans) > self.max_entries or self.nbytes > self.max_bytes):
+            _, (_, evicted) = self._plans.popitem(last=False)
+            self.nbytes -= evicted
+
+    def _load(self, key: str) -> Optional[ChunkPlan]:
+        if self.directory is None:
+            return None
+        path = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(path, CACHE_ENTRY)) as f:
+                plan_type = _PLAN_TYPES[json.load(f)["type"]]
+            plan = plan_type.open(path)
+        except (OSError, KeyError, ValueError):
+            return None
+        # Mark it recently used, for eviction
+        os.utime(path)
+        return plan
+
+    def _store(self, key: str, plan: ChunkPlan) -> None:
+        if self.directory is None:
+            return
+        # Written aside and renamed into place, so readers never see a partial plan
+        staging = os.path.join(self.directory, f".{key}.{uuid.uuid4().hex}")
+        plan.save(staging)
+        with open(os.path.join(staging, CACHE_ENTRY), "w") as f:
+            json.dump({"type": type(plan).__name__}, f)
+        try:
+            os.replace(staging, os.path.join(self.directory, key))
+        except OSError:
+            # Another process cached the same plan first
+            shutil.rmtree(staging, ignore_errors=True)
+        self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        if self.max_disk_bytes is None:
+            return
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_dir() and not entry.name.startswith("."):
+                entries.append((entry.stat().st_mtime, entry.path, _directory_nbytes(entry.path)))
+        total = sum(nbytes for _, _, nbytes in entries)
+        for _, path, nbytes in sorted(entries)[:-1]:
+            if total <= self.max_disk_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= nbytes
@@ -0,0 +1,452 @@
+from . import instrument
+from .instrument import ChunkTiming
+from .plan import ChunkPlan, Piece
+from .schedule import SourceScheduler
+from .sources import open_source
+from .util import block_ranges
+from .zarr import encode_coordinate, json_attrs
+
+import contextlib
+import itertools
+import json
+import math
+import os
+import posixpath
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ThreadPoolExecutor, wait
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, MutableMapping, NamedTuple, Optional, Tuple, Union
+
+import fsspec
+from fsspec.implementations.local import LocalFileSystem
+import numcodecs
+import numpy as np
+import xarray as xr
+
+DEFAULT_COMPRESSOR = numcodecs.Zstd(level=3)
+# Ending of the files chunks are written to before being renamed into place
+PARTIAL_SUFFIX = ".partial"
+
+
+class VariableSpec(NamedTuple):
+    """Static description of an output variable, shared by all of its chunk tasks."""
+    name: str
+    dims: Tuple[str, ...]
+    chunk_shape: Tuple[int, ...]
+    dtype: np.dtype
+    fill_value: Any
+
+
+class ExecutionContext(NamedTuple):
+    """Settings shared by every chunk task of an execution."""
+    store: MutableMapping
+    compressor: Optional[numcodecs.abc.Codec]
+    engine: Optional[str]
+    max_open_files: int
+    # Whether tasks time each chunk, to report to the observer of the execution
+    timed: bool = False
+
+
+def _fill_value(variable: xr.DataArray) -> Any:
+    fill_value = variable.encoding.get("_FillValue", variable.attrs.get("_FillValue"))
+    if fill_value is None and variable.dtype.kind == "f":
+        return np.nan
+    return fill_value
+
+
+def _json_fill_value(fill_value: Any, dtype: np.dtype) -> Any:
+    """Encode a fill value the way zarr v2 stores it in `.zarray`."""
+    if fill_value is None or dtype.kind not in "biuf":
+        return None
+    value = np.asarray(fill_value, dtype=dtype).item()
+    if isinstance(value, float) and not math.isfinite(value):
+        return "NaN" if math.isnan(value) else ("Infinity" if value > 0 else "-Infinity")
+    return value
+
+
+def variable_specs(plan: ChunkPlan, engine: Optional[str] = None) -> Dict[str, VariableSpec]:
+    """Specification of every planned variable, with dtype and fill value from the first source holding it."""
+    specs = {}
+    for var_name, variable_dims in plan.variables.items():
+        variable = open_source(plan.sources[plan.variable_source(var_name)], engine=engine)[var_name]
+        specs[var_name] = VariableSpec(
+            var_name,
+            variable_dims,
+            tuple(plan.chunk_definition[dim] for dim in variable_dims),
+            variable.dtype,
+            _fill_value(variable),
+        )
+    return specs
+
+
+def write_metadata(
+    plan: ChunkPlan,
+    store: MutableMapping,
+    compressor: Optional[numcodecs.abc.Codec] = DEFAULT_COMPRESSOR,
+    coords: Optional[Mapping[str, Any]] = None,
+    engine: Optional[str] = None,
+) -> Dict[str, VariableSpec]:
+    """
+    Write zarr v2 group and array metadata for the plan's variables (and `coords`, in full).
+
+    Group attributes are taken from the first source, and the data type, attributes and
+    fill value of each variable from the first source holding it. Returns the
+    specification of every planned variable.
+    """
+    template = open_source(plan.sources[0], engine=engine)
+    store[".zgroup"] = json.dumps({"zarr_format": 2}).encode()
+    store[".zattrs"] = json.dumps(json_attrs(template.attrs)).encode()
+
+    specs = variable_specs(plan, engine=engine)
+    for var_name, spec in specs.items():
+        variable = open_source(plan.sources[plan.variable_source(var_name)], engine=engine)[var_name]
+        zarray = {
+            "shape": [plan.dim_sizes[dim] for dim in spec.dims],
+            "chunks": list(spec.chunk_shape),
+            "dtype": spec.dtype.str,
+            "fill_value": _json_fill_value(spec.fill_value, spec.dtype),
+            "order": "C",
+            "filters": None,
+            "compressor": compressor.get_config() if compressor is not None else None,
+            "dimension_separator": ".",
+            "zarr_format": 2,
+        }
+        zattrs = json_attrs({key: value for key, value in variable.attrs.items() if key != "_FillValue"})
+        zattrs["_ARRAY_DIMENSIONS"] = list(spec.dims)
+        store[f"{var_name}/.zarray"] = json.dumps(zarray).encode()
+        store[f"{var_name}/.zattrs"] = json.dumps(zattrs).encode()
+
+    for name, coord in (coords or {}).items():
+        zarray, zattrs, chunk_key, data = encode_coordinate(name, getattr(coord, "variable", coord))
+        store[f"{name}/.zarray"] = json.dumps(zarray).encode()
+        store[f"{name}/.zattrs"] = json.dumps(zattrs).encode()
+        store[chunk_key] = data
+
+    return specs
+
+
+class BlockCache:
+    """
+    Native source chunks read while executing a batch, so each is read only once.
+
+    The reads of the batch are announced up front with `expect`; a block is then held
+    from its first read to its last, and no longer.
+    """
+
+    def __init__(self, native_chunks: Dict[str, Dict[str, int]]):
+        self.native_chunks = native_chunks
+        self.nbytes = 0
+        self.blocks_read = 0
+        self._uses: Counter = Counter()
+        self._blocks: Dict[Tuple[int, str, Tuple[int, ...]], np.ndarray] = {}
+
+    def _ranges(self, spec: VariableSpec, bounds: List[Tuple[int, int]]) -> List[range]:
+        native = self.native_chunks[spec.name]
+        return [block_ranges(start, end, native[dim]) for dim, (start, end) in zip(spec.dims, bounds)]
+
+    def expect(self, spec: VariableSpec, pieces: List[Piece]) -> None:
+        """Count the native chunks the output chunk of `spec` made of `pieces` will read."""
+        for source, region, _ in pieces:
+            for block in itertools.product(*self._ranges(spec, [region[dim] for dim in spec.dims])):
+                self._uses[(source, spec.name, block)] += 1
+
+    def _block(self, dataset: xr.Dataset, source: int, spec: VariableSpec, block: Tuple[int, ...]) -> np.ndarray:
+        key = (source, spec.name, block)
+        data = self._blocks.get(key)
+        if data is None:
+            native = self.native_chunks[spec.name]
+            indexers = {dim: slice(n * native[dim], (n + 1) * native[dim]) for dim, n in zip(spec.dims, block)}
+            data = dataset[spec.name].isel(indexers).transpose(*spec.dims).values
+            self.blocks_read += 1
+            self._blocks[key] = data
+            self.nbytes += data.nbytes
+
+        self._uses[key] -= 1
+        if self._uses[key] <= 0:
+            del self._uses[key], self._blocks[key]
+            self.nbytes -= data.nbytes
+        return data
+
+    def read(self, dataset: xr.Dataset, source: int, spec: VariableSpec, region: Dict[str, slice]) -> np.ndarray:
+        """Read `region` of `spec.name` from `dataset`, assembled from (cached) native chunks."""
+        native = self.native_chunks[spec.name]
+        bounds = [(region[dim].start, region[dim].stop) for dim in spec.dims]
+        out = np.empty([end - start for start, end in bounds], dtype=dataset[spec.name].dtype)
+
+        for block in itertools.product(*self._ranges(spec, bounds)):
+            data = self._block(dataset, source, spec, block)
+            source_index, out_index = [], []
+            for dim, n, (start, end) in zip(spec.dims, block, bounds):
+                block_start = n * native[dim]
+                lo, hi = max(start, block_start), min(end, block_start + native[dim])
+                source_index.append(slice(lo - block_start, hi - block_start))
+                out_index.append(slice(lo - start, hi - start))
+            out[tuple(out_index)] = data[tuple(source_index)]
+        return out
+
+
+def read_chunk(
+    context: ExecutionContext,
+    spec: VariableSpec,
+    pieces: List[Piece],
+    sources: Dict[int, Any],
+    blocks: Optional[BlockCache] = None,
+) -> np.ndarray:
+    """
+    Read and assemble the (unpadded) data of one output chunk from its `pieces`
+    (`ChunkPlan.chunk_pieces`). Parts of the chunk no piece covers hold the fill value.
+
+    With `blocks`, reads go through the cache of native chunks.
+    """
+    arrays = []
+    for source, region, _ in pieces:
+        dataset = open_source(sources[source], engine=context.engine, max_open_files=context.max_open_files)
+        indexers = {dim: slice(start, end) for dim, (start, end) in region.items()}
+        if blocks is None:
+            arrays.append(dataset[spec.name].isel(indexers).transpose(*spec.dims).values)
+        else:
+            arrays.append(blocks.read(dataset, source, spec, indexers))
+
+    if len(arrays) == 1 and not any(pieces[0][2].values()):
+        return arrays[0]
+    if not arrays:
+        shape = spec.chunk_shape
+    else:
+        shape = tuple(
+            max(offsets[dim] + region[dim][1] - region[dim][0] for _, region, offsets in pieces)
+            for dim in spec.dims
+        )
+    fill_value = spec.fill_value if spec.fill_value is not None else 0
+    out = np.full(shape, fill_value, dtype=spec.dtype)
+    for (_, region, offsets), data in zip(pieces, arrays):
+        out[tuple(slice(offsets[dim], offsets[dim] + region[dim][1] - region[dim][0]) for dim in spec.dims)] = data
+    return out
+
+
+def encode_chunk(context: ExecutionContext, spec: VariableSpec, data: np.ndarray) -> bytes:
+    """Pad an edge chunk to the full chunk shape and encode it as a zarr v2 chunk."""
+    data = np.asarray(data, dtype=spec.dtype)
+    if data.shape != spec.chunk_shape:
+        fill_value = spec.fill_value if spec.fill_value is not None else 0
+        padded = np.full(spec.chunk_shape, fill_value, dtype=spec.dtype)
+        padded[tuple(slice(0, n) for n in data.shape)] = data
+        data = padded
+    data = np.ascontiguousarray(data)
+    if context.compressor is None:
+        return data.tobytes()
+    return bytes(context.compressor.encode(data))
+
+
+def _is_local(store: MutableMapping) -> bool:
+    return isinstance(store, fsspec.FSMap) and isinstance(store.fs, LocalFileSystem)
+
+
+def store_chunk(store: MutableMapping, zarr_key: str, data: bytes) -> None:
+    """
+    Write an encoded chunk so that it is either complete or absent, even if the writer dies.
+
+    On a local filesystem the chunk is written aside and renamed into place; the file
+    written aside is removed if that fails. Object stores only ever hold whole objects,
+    so other stores are written directly.
+    """
+    if not _is_local(store):
+        store[zarr_key] = data
+        return
+    path = posixpath.join(store.root, zarr_key)
+    directory, name = posixpath.split(path)
+    partial_path = posixpath.join(directory, f".{name}.{uuid.uuid4().hex}{PARTIAL_SUFFIX}")
+    store.fs.makedirs(directory, exist_ok=True)
+    try:
+        store.fs.pipe_file(partial_path, data)
+        os.replace(partial_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(partial_path)
+        raise
+
+
+def clear_partial_chunks(store: MutableMapping, min_age: float = 60.0) -> int:
+    """
+    Remove the files `store_chunk` wrote aside and never renamed, because their writer
+    was killed outright; returns how many were removed.
+
+    Only files untouched for `min_age` seconds are removed, so writes still running
+    (e.g. another shard's) keep theirs. Only local stores have such files.
+    """
+    if not _is_local(store):
+        return 0
+    removed = 0
+    cutoff = time.time() - min_age
+    for directory, _, names in os.walk(store.root):
+        for name in names:
+            path = os.path.join(directory, name)
+            if name.startswith(".") and name.endswith(PARTIAL_SUFFIX) and os.path.getmtime(path) < cutoff:
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+                    removed += 1
+    return removed
+
+
+def _write_items(
+    context: ExecutionContext,
+    specs: Mapping[str, VariableSpec],
+    items: List[Tuple[str, List[Piece]]],
+    sources: Dict[int, Any],
+    blocks: Optional[BlockCache] = None,
+) -> Tuple[int, int, List[ChunkTiming]]:
+    """Read, encode and store output chunks; returns their count, bytes written and, if timed, latencies."""
+    nbytes = 0
+    timings = []
+    for zarr_key, pieces in items:
+        spec = specs[zarr_key.rpartition("/")[0]]
+        start = time.perf_counter() if context.timed else 0.0
+        data = read_chunk(context, spec, pieces, sources, blocks)
+        read = time.perf_counter() if context.timed else 0.0
+        encoded = encode_chunk(context, spec, data)
+        store_chunk(context.store, zarr_key, encoded)
+        nbytes += len(encoded)
+        if context.timed:
+            timings.append(ChunkTiming(zarr_key, read - start, time.perf_counter() - read, len(encoded)))
+    return len(items), nbytes, timings
+
+
+def _write_chunk(
+    context: ExecutionContext,
+    spec: VariableSpec,
+    zarr_key: str,
+    pieces: List[Piece],
+    sources: Dict[int, Any],
+) -> Tuple[int, int, List[ChunkTiming]]:
+    return _write_items(context, {spec.name: spec}, [(zarr_key, pieces)], sources)
+
+
+def _write_batch(
+    context: ExecutionContext,
+    specs: Dict[str, VariableSpec],
+    items: List[Tuple[str, List[Piece]]],
+    sources: Dict[int, Any],
+    native_chunks: Dict[str, Dict[str, int]],
+) -> Tuple[int, int, List[ChunkTiming]]:
+    blocks = BlockCache(native_chunks)
+    for zarr_key, pieces in items:
+        blocks.expect(specs[zarr_key.rpartition("/")[0]], pieces)
+    return _write_items(context, specs, items, sources, blocks)
+
+
+def execute(
+    plan: ChunkPlan,
+    store: Union[str, os.PathLike, MutableMapping],
+    executor: Optional[Executor] = None,
+    keys: Optional[Iterable[str]] = None,
+    coords: Optional[Mapping[str, Any]] = None,
+    compressor: Optional[numcodecs.abc.Codec] = DEFAULT_COMPRESSOR,
+    engine: Optional[str] = None,
+    max_in_flight_bytes: int = 256 * 2**20,
+    max_open_files: int = 128,
+    skip_existing: bool = True,
+    by_source: bool = False,
+    native_chunks: Optional[Dict[str, Dict[str, int]]] = None,
+    max_batch_bytes: int = 64 * 2**20,
+    metadata: bool = True,
+) -> Dict[str, int]:
+    """
+    Materialize a chunk plan as a zarr v2 store.
+
+    Every output chunk (or only those in `keys`, e.g. the work left over by
+    `to_kerchunk_references`) is read from its sources, assembled and written to `store`
+    (a path/URL or a mutable mapping) by `executor`, a thread pool by default. Process
+    pools work too, as long as plan sources are paths and the store can be pickled.
+
+    Each worker keeps its source files open between tasks. New tasks are only submitted
+    while the uncompressed size of the chunks in flight stays under
+    `max_in_flight_bytes`. With `skip_existing`, chunks already present in the store are
+    not recomputed, so an interrupted run can simply be started again: chunks are
+    written with `store_chunk`, so none is left truncated, and the files of writes
+    killed mid-way are cleared (`clear_partial_chunks`).
+
+    With `by_source`, chunks are run in batches from a `SourceScheduler`, each writing
+    and reading native source chunks of up to `max_batch_bytes`, and every native chunk
+    is read once per batch. The native chunks a batch caches count as in flight too.
+    Batches are scheduled as the plan is walked, so the plan is never held in full.
+
+    When shards of a plan (`ChunkPlan.shard`) run on several machines, pass
+    `metadata=False` on all but one of them, so only one writes the group and array
+    metadata and no object is written twice.
+
+    With an observer installed (`instrument.observe`), the read and the encode-and-write
+    latency of every chunk is reported to it, as are the counts returned.
+
+    Returns counts of chunks written and skipped and of bytes written.
+    """
+    if isinstance(store, (str, os.PathLike)):
+        store = fsspec.get_mapper(os.fspath(store))
+
+    if metadata:
+        specs = write_metadata(plan, store, compressor=compressor, coords=coords, engine=engine)
+    else:
+        specs = variable_specs(plan, engine=engine)
+    observer = instrument.current()
+    context = ExecutionContext(store, compressor, engine, max_open_files, timed=observer is not None)
+    if skip_existing:
+        clear_partial_chunks(store)
+    existing = set(store) if skip_existing else set()
+    stats = {"written": 0, "skipped": 0, "bytes_written": 0}
+
+    def select(zarr_key: str) -> bool:
+        if zarr_key in existing:
+            stats["skipped"] += 1
+            return False
+        return True
+
+    def chunk_tasks() -> Iterator[Tuple[int, Callable[[], Tuple[int, int, List[ChunkTiming]]]]]:
+        records = plan.iter_chunks() if keys is None else ((key, plan[key]) for key in keys)
+        for zarr_key, slices in records:
+            if not select(zarr_key):
+                continue
+            spec = specs[zarr_key.rpartition("/")[0]]
+            nbytes = math.prod(spec.chunk_shape) * spec.dtype.itemsize
+            pieces = plan.chunk_pieces(spec.name, slices)
+            sources = {source: plan.sources[source] for source, _, _ in pieces}
+            yield nbytes, partial(_write_chunk, context, spec, zarr_key, pieces, sources)
+
+    def batch_tasks() -> Iterator[Tuple[int, Callable[[], Tuple[int, int, List[ChunkTiming]]]]]:
+        with instrument.phase("schedule"):
+            scheduler = SourceScheduler(plan, native_chunks=native_chunks, max_batch_bytes=max_batch_bytes, engine=engine)
+        for batch in scheduler.batches(keys, select):
+            items = [(zarr_key, plan.chunk_pieces(zarr_key.rpartition("/")[0], slices)) for zarr_key, slices in batch.items]
+            sources = {source: plan.sources[source] for _, pieces in items for source, _, _ in pieces}
+            task = partial(_write_batch, context, specs, items, sources, scheduler.native_chunks)
+            # The native chunks a batch caches are held with its chunks
+            yield batch.nbytes + batch.cache_bytes, task
+
+    in_flight: Dict[Future, int] = {}
+
+    def collect(futures: Iterable[Future]) -> None:
+        for future in futures:
+            in_flight.pop(future)
+            written, nbytes, timings = future.result()
+            stats["written"] += written
+            stats["bytes_written"] += nbytes
+            for timing in timings:
+                observer.on_chunk(timing)
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor()
+    try:
+        for nbytes, task in (batch_tasks() if by_source else chunk_tasks()):
+            while in_flight and sum(in_flight.values()) + nbytes > max_in_flight_bytes:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight[executor.submit(task)] = nbytes
+
+        collect(wait(in_flight).done)
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    for name, value in (("chunks_written", stats["written"]), ("chunks_skipped", stats["skipped"]), ("bytes_written", stats["bytes_written"])):
+        instrument.count(name, value)
+    return stats
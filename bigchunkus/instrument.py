@@ -0,0 +1,143 @@
+"""
+Timings and counters reported by planners and the executor.
+
+Instrumentation is off unless an `Observer` is installed with `observe`, which scopes it
+to the current context (thread or asyncio task). While off, each instrumented call costs
+one context variable lookup.
+
+Phases reported: `order` (sorting sources along the concat dimension), `concat`
+(combining their metadata, and `xr.concat` if asked for), `slices` (computing the
+dimension tables), `schedule` (setting up the batching of chunks by source), and, while a plan is iterated,
+`keys` and `enumerate` (generating zarr keys and the slices of each chunk). Counters:
+`chunks`, `multi_source_chunks` and `sources_touched` for every plan built, and
+`chunks_written`, `chunks_skipped` and `bytes_written` for every execution.
+"""
+import contextlib
+import contextvars
+import time
+from collections import defaultdict
+from typing import Any, ContextManager, Dict, Iterator, List, NamedTuple, Optional
+
+import numpy as np
+
+
+class ChunkTiming(NamedTuple):
+    """Latency of reading and of encoding and writing one output chunk."""
+    zarr_key: str
+    read_seconds: float
+    write_seconds: float
+    nbytes: int
+
+
+class Observer:
+    """Receives instrumentation events; override the methods of interest."""
+
+    def on_phase(self, name: str, seconds: float) -> None:
+        pass
+
+    def on_count(self, name: str, value: int) -> None:
+        pass
+
+    def on_chunk(self, timing: ChunkTiming) -> None:
+        pass
+
+
+class Recorder(Observer):
+    """Observer accumulating total time and calls per phase, counter totals and chunk timings."""
+
+    def __init__(self):
+        self.phases: Dict[str, float] = defaultdict(float)
+        self.phase_calls: Dict[str, int] = defaultdict(int)
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.chunks: List[ChunkTiming] = []
+
+    def on_phase(self, name: str, seconds: float) -> None:
+        self.phases[name] += seconds
+        self.phase_calls[name] += 1
+
+    def on_count(self, name: str, value: int) -> None:
+        self.counters[name] += value
+
+    def on_chunk(self, timing: ChunkTiming) -> None:
+        self.chunks.append(timing)
+
+    def summary(self) -> Dict[str, Any]:
+        """Phase totals, counters and, if chunks were executed, their latency percentiles."""
+        summary: Dict[str, Any] = {"phases": dict(self.phases), "counters": dict(self.counters)}
+        if self.chunks:
+            for field in ("read_seconds", "write_seconds"):
+                values = np.array([getattr(timing, field) for timing in self.chunks])
+                summary[field] = {f"p{q}": float(np.percentile(values, q)) for q in (50, 90, 99)}
+        return summary
+
+
+_observer: "contextvars.ContextVar[Optional[Observer]]" = contextvars.ContextVar("bigchunkus_observer", default=None)
+_DISABLED = contextlib.nullcontext()
+
+
+def current() -> Optional[Observer]:
+    """The observer installed in this context, if any."""
+    return _observer.get()
+
+
+@contextlib.contextmanager
+def observe(observer: Optional[Observer] = None) -> Iterator[Observer]:
+    """Report instrumentation within the block to `observer` (a new `Recorder` by default)."""
+    observer = Recorder() if observer is None else observer
+    token = _observer.set(observer)
+    try:
+        yield observer
+    finally:
+        _observer.reset(token)
+
+
+class _Phase:
+    __slots__ = ("observer", "name", "start")
+
+    def __init__(self, observer: Observer, name: str):
+        self.observer = observer
+        self.name = name
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.observer.on_phase(self.name, time.perf_counter() - self.start)
+
+
+def phase(name: str) -> ContextManager[None]:
+    """Time the enclosed block as phase `name`."""
+    observer = _observer.get()
+    if observer is None:
+        return _DISABLED
+    return _Phase(observer, name)
+
+
+def count(name: str, value: int = 1) -> None:
+    """Add `value` to counter `name`."""
+    observer = _observer.get()
+    if observer is not None:
+        observer.on_count(name, value)
+
+
+def count_plan(plan: Any) -> None:
+    """Report the `chunks`, `multi_source_chunks` and `sources_touched` counters of a ChunkPlan."""
+    observer = _observer.get()
+    if observer is None:
+        return
+    n_chunks = multi_source = 0
+    for var_name, variable_dims in plan.variables.items():
+        grid = plan.chunk_grid(var_name)
+        chunks = int(np.prod(grid))
+        n_chunks += chunks
+        if plan.concat_dim in variable_dims:
+            indptr, _ = plan.dim_tables[plan.concat_dim]
+            multi_rows = int(np.count_nonzero(np.diff(indptr) > 1))
+            multi_source += chunks // max(len(indptr) - 1, 1) * multi_rows
+    if plan.concat_dim in plan.dim_tables:
+        sources_touched = len(np.unique(plan.dim_tables[plan.concat_dim][1][:, 0]))
+    else:
+        sources_touched = len(plan.sources)
+    observer.on_count("chunks", n_chunks)
+    observer.on_count("multi_source_chunks", multi_source)
+    observer.on_count("sources_touched", sources_touched)
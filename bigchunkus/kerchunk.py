@@ -0,0 +1,286 @@
+from .plan import ChunkPlan, Slice
+from .util import block_ranges
+from .zarr import encode_coordinate
+
+import base64
+import itertools
+import json
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+import fsspec
+import xarray as xr
+
+# .zarray fields which must agree for a source chunk to be reused verbatim in the output
+_ENCODING_FIELDS = ("dtype", "compressor", "filters", "fill_value", "order")
+
+
+def _refs(source_refs: Mapping[str, Any]) -> Mapping[str, Any]:
+    """Accept both versioned (`{"version": 1, "refs": {...}}`) and bare reference sets."""
+    return source_refs.get("refs", source_refs)
+
+
+def _zarray(refs: Mapping[str, Any], var_name: str) -> Optional[Dict[str, Any]]:
+    zarray = refs.get(f"{var_name}/.zarray")
+    if zarray is None:
+        return None
+    return json.loads(zarray) if isinstance(zarray, (str, bytes)) else dict(zarray)
+
+
+def native_chunk_definition(source_refs: Mapping[str, Any]) -> Dict[str, int]:
+    """Chunk size per dimension as declared by the data arrays of a kerchunk reference set."""
+    refs = _refs(source_refs)
+    chunk_definition = {}
+    for key in refs:
+        if not key.endswith("/.zarray"):
+            continue
+        var_name = key[:-len("/.zarray")]
+        dims = json.loads(refs.get(f"{var_name}/.zattrs", "{}")).get("_ARRAY_DIMENSIONS", [])
+        if dims == [var_name]:
+            # Dimension coordinates are usually stored as a single chunk
+            continue
+        for dim, size in zip(dims, _zarray(refs, var_name)["chunks"]):
+            chunk_definition.setdefault(dim, size)
+    return chunk_definition
+
+
+def _inline_variable(name: str, variable: xr.Variable) -> Dict[str, str]:
+    """Encode a (small) coordinate variable as inline references."""
+    zarray, zattrs, chunk_key, data = encode_coordinate(name, variable)
+    return {
+        f"{name}/.zarray": json.dumps(zarray),
+        f"{name}/.zattrs": json.dumps(zattrs),
+        chunk_key: "base64:" + base64.b64encode(data).decode(),
+    }
+
+
+def _aligned_source_key(
+    var_name: str,
+    variable_dims: Tuple[str, ...],
+    slices: Dict[str, List[Slice]],
+    plan: ChunkPlan,
+    source_zarrays: Sequence[Optional[Dict[str, Any]]],
+    template: Dict[str, Any],
+) -> Optional[Tuple[int, str]]:
+    """
+    Return (source, source_key) if this output chunk is exactly one native chunk of one source.
+
+    That requires a single piece along every dimension, a native chunk shape equal to the
+    output chunk shape, a piece starting on a native chunk boundary and either covering a
+    whole native chunk or ending at the edge of the source (edge chunks are stored padded).
+    """
+    if any(len(slices[dim]) != 1 for dim in variable_dims):
+        return None
+
+    pieces = plan.chunk_pieces(var_name, slices)
+    if len(pieces) != 1:
+        return None
+    source = pieces[0][0]
+    zarray = source_zarrays[source]
+    if zarray is None or any(zarray.get(field) != template.get(field) for field in _ENCODING_FIELDS):
+        return None
+
+    native_indices = []
+    for dim, native_chunk, source_size in zip(variable_dims, zarray["chunks"], zarray["shape"]):
+        _, start, end = slices[dim][0]
+        if native_chunk != plan.chunk_definition[dim] or start % native_chunk:
+            return None
+        if end - start != native_chunk and end != source_size:
+            return None
+        native_indices.append(str(start // native_chunk))
+
+    separator = zarray.get("dimension_separator") or "."
+    # Scalars have the single native chunk "0"
+    return source, f"{var_name}/" + (separator.join(native_indices) or "0")
+
+
+def kerchunk_references(
+    plan: ChunkPlan,
+    source_refs: Sequence[Mapping[str, Any]],
+    coords: Optional[Mapping[str, xr.Variable]] = None,
+) -> Tuple[Dict[str, Any], Dict[str, Dict[str, List[Slice]]]]:
+    """
+    Split a chunk plan into kerchunk references and the work which remains.
+
+    `source_refs` holds one kerchunk reference set per plan source, in plan source order
+    (e.g. the output of `kerchunk.hdf.SingleHdf5ToZarr(...).translate()`). Every output
+    chunk which is exactly one native chunk of one source becomes a reference to that
+    chunk's bytes; every other chunk is returned, with its slices, as work which must
+    still be materialized. `coords`, if given, are inlined into the references.
+
+    Returns a `{"version": 1, "refs": {...}}` reference set and the `{zarr_key: slices}`
+    work mapping.
+    """
+    if len(source_refs) != len(plan.sources):
+        raise ValueError(f"Expected {len(plan.sources)} source reference sets, got {len(source_refs)}")
+
+    all_refs = [_refs(refs) for refs in source_refs]
+    first_refs = all_refs[0]
+    references = {
+        ".zgroup": first_refs.get(".zgroup", json.dumps({"zarr_format": 2})),
+        ".zattrs": first_refs.get(".zattrs", "{}"),
+    }
+    for name, variable in (coords or {}).items():
+        references.update(_inline_variable(name, variable))
+
+    variable_zarrays = {}
+    for var_name, variable_dims in plan.variables.items():
+        source_zarrays = [_zarray(refs, var_name) for refs in all_refs]
+        template_source = plan.variable_source(var_name)
+        template = source_zarrays[template_source]
+        if template is None:
+            raise KeyError(f"Variable '{var_name}' not found in reference set {template_source}")
+        variable_zarrays[var_name] = (source_zarrays, template)
+
+        zarray = dict(template)
+        zarray["shape"] = [plan.dim_sizes[dim] for dim in variable_dims]
+        zarray["chunks"] = [plan.chunk_definition[dim] for dim in variable_dims]
+        zarray["dimension_separator"] = "."
+        references[f"{var_name}/.zarray"] = json.dumps(zarray)
+        references[f"{var_name}/.zattrs"] = all_refs[template_source].get(
+            f"{var_name}/.zattrs", json.dumps({"_ARRAY_DIMENSIONS": list(variable_dims)})
+        )
+
+    work = {}
+    for zarr_key, slices in plan.iter_chunks():
+        var_name = zarr_key.rpartition("/")[0]
+        source_zarrays, template = variable_zarrays[var_name]
+        aligned = _aligned_source_key(var_name, plan.variables[var_name], slices, plan, source_zarrays, template)
+        if aligned is None:
+            work[zarr_key] = slices
+            continue
+        source, source_key = aligned
+        # A missing native chunk is all fill value, and so is the output chunk
+        if source_key in all_refs[source]:
+            references[zarr_key] = all_refs[source][source_key]
+
+    return {"version": 1, "refs": references}, work
+
+
+class ByteRange(NamedTuple):
+    """
+    The bytes of one native source chunk read by an output chunk.
+
+    `subselection` is the part of the decoded native chunk which is kept and
+    `out_selection` where it goes in the output chunk. `shared` marks native chunks also
+    read by other output chunks, which are worth keeping once fetched.
+    """
+    path: str
+    offset: int
+    length: int
+    native_chunk_index: Tuple[int, ...]
+    subselection: Tuple[slice, ...]
+    out_selection: Tuple[slice, ...]
+    shared: bool
+
+
+class RangeRequest(NamedTuple):
+    """A single read of contiguous bytes of `path` covering one or more `ranges`."""
+    path: str
+    offset: int
+    length: int
+    ranges: List[ByteRange]
+
+
+class ChunkReads(NamedTuple):
+    """The native chunk byte ranges of one output chunk, and the coalesced requests fetching them."""
+    zarr_key: str
+    ranges: List[ByteRange]
+    requests: List[RangeRequest]
+
+
+def coalesce_ranges(ranges: Iterable[ByteRange], max_gap: int = 0) -> List[RangeRequest]:
+    """
+    Merge byte ranges of the same file into as few requests as possible.
+
+    Ranges are merged when they overlap or when the gap between them is at most
+    `max_gap` bytes, which are read and dropped.
+    """
+    requests: List[RangeRequest] = []
+    for byte_range in sorted(ranges, key=lambda r: (r.path, r.offset)):
+        if requests:
+            last = requests[-1]
+            if byte_range.path == last.path and byte_range.offset <= last.offset + last.length + max_gap:
+                end = max(last.offset + last.length, byte_range.offset + byte_range.length)
+                requests[-1] = RangeRequest(last.path, last.offset, end - last.offset, last.ranges + [byte_range])
+                continue
+        requests.append(RangeRequest(byte_range.path, byte_range.offset, byte_range.length, [byte_range]))
+    return requests
+
+
+def _chunk_byte_ranges(
+    var_name: str,
+    variable_dims: Tuple[str, ...],
+    slices: Dict[str, List[Slice]],
+    plan: ChunkPlan,
+    all_refs: Sequence[Mapping[str, Any]],
+    source_zarrays: Sequence[Optional[Dict[str, Any]]],
+) -> Iterator[ByteRange]:
+    """Byte ranges of the native chunks read by one output chunk, in output order."""
+    for source, region, offsets in plan.chunk_pieces(var_name, slices):
+        zarray = source_zarrays[source]
+        if zarray is None:
+            raise KeyError(f"Variable '{var_name}' not found in reference set {source}")
+        separator = zarray.get("dimension_separator") or "."
+        bounds = [region[dim] for dim in variable_dims]
+        out_starts = [offsets[dim] for dim in variable_dims]
+
+        ranges = [block_ranges(lo, hi, native) for (lo, hi), native in zip(bounds, zarray["chunks"])]
+        for block in itertools.product(*ranges):
+            ref = all_refs[source].get(f"{var_name}/" + (separator.join(map(str, block)) or "0"))
+            # A missing native chunk is all fill value, so there is nothing to read
+            if ref is None:
+                continue
+            if not isinstance(ref, (list, tuple)) or len(ref) != 3:
+                raise ValueError(f"Native chunk {block} of '{var_name}' in source {source} is not a byte range; translate sources with inline_threshold=0")
+
+            subselection, out_selection = [], []
+            shared = False
+            for n, (lo, hi), native, size, out_offset in zip(block, bounds, zarray["chunks"], zarray["shape"], out_starts):
+                block_start = n * native
+                block_end = min(block_start + native, size)
+                first, last = max(lo, block_start), min(hi, block_end)
+                subselection.append(slice(first - block_start, last - block_start))
+                out_selection.append(slice(first - lo + out_offset, last - lo + out_offset))
+                # Along this dimension, other output chunks read what this one leaves of the native chunk
+                shared |= first > block_start or last < block_end
+            path, offset, length = ref
+            yield ByteRange(path, int(offset), int(length), block, tuple(subselection), tuple(out_selection), shared)
+
+
+def byte_range_plan(
+    plan: ChunkPlan,
+    source_refs: Sequence[Mapping[str, Any]],
+    keys: Optional[Iterable[str]] = None,
+    max_gap: int = 0,
+) -> Iterator[ChunkReads]:
+    """
+    Turn every output chunk (or those in `keys`) into the byte ranges of the native chunks it reads.
+
+    `source_refs` holds one kerchunk reference set per plan source, as for
+    `kerchunk_references`; `kerchunk.hdf.SingleHdf5ToZarr(path, inline_threshold=0)`
+    gives the offsets and lengths of the native chunks of a netCDF4/HDF5 file. Ranges
+    are still encoded: they must be decompressed (per each source's `.zarray`) before
+    `subselection` is taken. The ranges of each output chunk are merged with
+    `coalesce_ranges` into the requests a reader should issue.
+    """
+    if len(source_refs) != len(plan.sources):
+        raise ValueError(f"Expected {len(plan.sources)} source reference sets, got {len(source_refs)}")
+
+    all_refs = [_refs(refs) for refs in source_refs]
+    zarrays = {var_name: [_zarray(refs, var_name) for refs in all_refs] for var_name in plan.variables}
+    records = plan.iter_chunks() if keys is None else ((key, plan[key]) for key in keys)
+    for zarr_key, slices in records:
+        var_name = zarr_key.rpartition("/")[0]
+        ranges = list(_chunk_byte_ranges(var_name, plan.variables[var_name], slices, plan, all_refs, zarrays[var_name]))
+        yield ChunkReads(zarr_key, ranges, coalesce_ranges(ranges, max_gap))
+
+
+def write_references(references: Dict[str, Any], output: str, **storage_options) -> None:
+    """Write a reference set as JSON or, for `.parq`/`.parquet` outputs, as kerchunk parquet."""
+    if output.endswith((".parq", ".parquet")):
+        from kerchunk.df import refs_to_dataframe
+
+        refs_to_dataframe(references, output, storage_options=storage_options or None)
+    else:
+        with fsspec.open(output, "w", **storage_options) as f:
+            json.dump(references, f)
@@ -1 +1,3 @@
-from .concat import ConcatChunkPlanner
\ No newline at end of file
+from .concat import ConcatChunkPlanner
+from .merge import MergeChunkPlanner
+from .mosaic import MosaicChunkPlanner
@@ -1,86 +1,277 @@
+from .. import instrument
 from ..base import BaseChunkPlanner
-from ..zarr import build_zarr_key_generator
+from ..plan import ChunkPlan, Slice
+from ..sources import SourceMetadata, open_source
+from ..util import chunk_boundaries, overlap_slices, whole_source_slices
 
-import itertools
-from typing import Dict, List, Union, Tuple
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Union, Tuple
+import numpy as np
+import pandas as pd
 import xarray as xr
 
+if TYPE_CHECKING:
+    from ..cache import PlanCache
+
+
+def _sorted_position(index: pd.Index, label: Any, side: str) -> int:
+    """
+    `index.searchsorted(label, side)` for an ascending or descending index, where `side`
+    is that of a slice start ("left") or stop ("right"), as `Dataset.sel` slices either.
+    """
+    if index.is_monotonic_increasing:
+        return int(index.searchsorted(label, side=side))
+    if index.is_monotonic_decreasing:
+        flipped = "right" if side == "left" else "left"
+        return len(index) - int(index[::-1].searchsorted(label, side=flipped))
+    raise ValueError(f"Index of '{index.name}' must be sorted to select a region by label")
+
+
 class ConcatChunkPlanner(BaseChunkPlanner):
-    def __init__(self, source_datasets: List[xr.Dataset], merged_dataset: xr.Dataset, concat_dim_ranges: List[Tuple[int, int]], offsets: List[int], concat_dim_name: str):
+    def __init__(self, source_datasets: List[xr.Dataset], merged_dataset: Optional[xr.Dataset], concat_dim_ranges: List[Tuple[int, int]], offsets: List[int], concat_dim_name: str, metadata: Optional[SourceMetadata] = None, source_metadata: Optional[List[SourceMetadata]] = None):
         self.source_datasets = source_datasets
+        # The fully concatenated dataset is only built on request; planning needs just its metadata
         self.merged_dataset = merged_dataset
+        self.metadata = metadata if metadata is not None else SourceMetadata.from_dataset(merged_dataset)
         self.concat_dim_ranges = concat_dim_ranges
         self.offsets = offsets
         self.concat_dim_name = concat_dim_name  # This is the dimension we're concatenating along
+        # Per-source metadata, if known, locates label bounds along the concat dim without opening every source
+        self.source_metadata = source_metadata
 
-    def map_chunks(self, chunk_definition: Dict[str, int]) -> dict:
-        """Map output chunks to input slices without duplication"""
-        chunk_map = {}
-
-        # Merge the user-defined chunk definition with the dataset's chunk sizes
-        dataset_dim_sizes = dict(self.merged_dataset.sizes)
-        dataset_chunk_sizes = dict(self.merged_dataset.chunks)
-        chunk_definition = {**dataset_dim_sizes, **dataset_chunk_sizes, **chunk_definition}
-
-        print("Final chunk definition with fallbacks:", chunk_definition)
-
-        for var_name, var_data in self.merged_dataset.data_vars.items():
-            # Get the specific dimensions for this variable
-            variable_dims = var_data.dims
-            
-            # Calculate chunk indices for the dimensions relevant to this variable
-            chunk_indices_list = []
-            for dim in variable_dims:
-                chunk_size = chunk_definition[dim]
-                chunk_indices = list(range(0, self.merged_dataset.sizes[dim], chunk_size))
-                chunk_indices_list.append(chunk_indices)
-
-            # Validate arguments at this point and produce closure to avoid revalidation
-            generate_zarr_key = build_zarr_key_generator(
-                var_name,
-                chunk_definition,
-                variable_dims
+    @property
+    def coords(self) -> Dict[str, xr.Variable]:
+        """Dimension coordinates of the concatenated dataset (the concat one is assembled from every source)"""
+        if self.merged_dataset is not None:
+            coords = self.merged_dataset.coords
+            return {name: coord.variable for name, coord in coords.items() if coord.dims == (name,)}
+
+        first = open_source(self.source_datasets[0])
+        coords = {
+            name: coord.variable for name, coord in first.coords.items()
+            if coord.dims == (name,) and name != self.concat_dim_name
+        }
+        if self.concat_dim_name in first.coords:
+            coords[self.concat_dim_name] = xr.Variable.concat(
+                [open_source(ds)[self.concat_dim_name].variable for ds in self.source_datasets],
+                dim=self.concat_dim_name,
             )
-            # Iterate through combinations of chunk indices
-            for chunk_indices in itertools.product(*chunk_indices_list):
-                zarr_key = generate_zarr_key(chunk_indices)
-                chunk_slices = {}
-
-                # Iterate over each dimension relevant to this variable and compute chunk slices
-                for dim, chunk_index in zip(variable_dims, chunk_indices):
-                    dim_chunk_slices = []
-                    current_chunk_start = chunk_index
-                    current_chunk_end = min(current_chunk_start + chunk_definition[dim], self.merged_dataset.sizes[dim])
-
-                    # Handle concatenation dimension
-                    if dim == self.concat_dim_name:
-                        for i, (start, end) in enumerate(self.concat_dim_ranges):
-                            if end > current_chunk_start and start < current_chunk_end:
-                                slice_start = max(start, current_chunk_start) - start
-                                slice_end = min(end, current_chunk_end) - start
-                                slice_tuple = (i, slice_start, slice_end)
-                                dim_chunk_slices.append(slice_tuple)
-
-                        chunk_key_index = current_chunk_start // chunk_definition[dim]
-                        dim_key = f"{dim}/{chunk_key_index}"
-                    else:
-                        # Handle non-concatenated dimensions normally
-                        slice_tuple = (0, current_chunk_start, current_chunk_end)
-                        dim_chunk_slices.append(slice_tuple)
-                        dim_key = f"{dim}/{chunk_index}"
-
-                    # Add slices to the chunk map (avoid adding the same dimension slices multiple times)
-                    if dim_key not in chunk_map:
-                        chunk_map[dim_key] = dim_chunk_slices
-                    else:
-                        # Only add new slices that haven't been processed yet
-                        chunk_map[dim_key].extend(
-                            [s for s in dim_chunk_slices if s not in chunk_map[dim_key]]
-                        )
-
-                    chunk_slices[dim] = dim_chunk_slices
-
-                # Assign Zarr key with correct chunk slices
-                chunk_map[zarr_key] = chunk_slices
-
-        return chunk_map
+        return coords
+
+    def _resolve_chunk_definition(self, chunk_definition: Dict[str, int]) -> Dict[str, int]:
+        """Merge the user-defined chunk definition with the dataset's chunk sizes"""
+        return {**self.metadata.sizes, **self.metadata.chunks, **chunk_definition}
+
+    def _label_position(self, dim: str, label: Any, side: str) -> int:
+        """
+        Position along `dim` where `label` would be inserted, on `side` of equal labels.
+
+        Along the concat dimension the source holding `label` is found by binary search
+        over the sources' first labels, and only that source's index is read.
+        """
+        if dim == self.concat_dim_name:
+            if self.source_metadata is not None and all(dim in metadata.bounds for metadata in self.source_metadata):
+                firsts = pd.Index(np.array([metadata.bounds[dim][0] for metadata in self.source_metadata]), name=dim)
+                source = max(_sorted_position(firsts, label, "right") - 1, 0)
+                index = open_source(self.source_datasets[source]).indexes[dim]
+                return self.offsets[source] + _sorted_position(index, label, side)
+            index = self.coords[dim].to_index()
+        else:
+            index = open_source(self.source_datasets[0]).indexes[dim]
+        return _sorted_position(index, label, side)
+
+    def _chunk_windows(self, chunk_definition: Dict[str, int], region: Mapping[str, slice], positional: bool) -> Dict[str, Tuple[int, int]]:
+        """
+        The (first, stop) chunk numbers along each dimension of `region` which intersect it.
+
+        Bounds are labels, inclusive like `Dataset.sel` (coordinates must be sorted, either
+        way; a descending one is sliced from its larger label), for dimensions with an
+        index unless `positional`; otherwise they are positions as for `Dataset.isel`.
+        """
+        windows = {}
+        for dim, bounds in region.items():
+            if dim not in self.metadata.sizes:
+                raise ValueError(f"Region dimension '{dim}' not found in the datasets")
+            if bounds.step is not None:
+                raise ValueError(f"Region of '{dim}' must not have a step")
+            size = self.metadata.sizes[dim]
+            if positional or dim not in self.metadata.bounds:
+                start, stop, _ = bounds.indices(size)
+            else:
+                start = 0 if bounds.start is None else self._label_position(dim, bounds.start, "left")
+                stop = size if bounds.stop is None else self._label_position(dim, bounds.stop, "right")
+            chunk_size = chunk_definition[dim]
+            first = start // chunk_size
+            windows[dim] = (first, -(-stop // chunk_size) if stop > start else first)
+        return windows
+
+    def _dim_slice_tables(self, chunk_definition: Dict[str, int], dims: Iterable[str], windows: Optional[Mapping[str, Tuple[int, int]]] = None) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """
+        Compute, once per dimension, the source slices making up each of its chunks
+        (or only the chunks numbered from `first` to `stop` in `windows`).
+
+        Overlaps along the concatenated dimension are found for every chunk boundary at
+        once with a binary search over the source offsets.
+        """
+        tables = {}
+        for dim in dims:
+            if dim in tables:
+                continue
+            first, stop = windows[dim] if windows is not None and dim in windows else (0, None)
+            chunk_starts, chunk_ends = chunk_boundaries(self.metadata.sizes[dim], chunk_definition[dim], first, stop)
+
+            if dim == self.concat_dim_name:
+                source_ends = [end for _, end in self.concat_dim_ranges]
+                tables[dim] = overlap_slices(self.offsets, source_ends, chunk_starts, chunk_ends)
+            else:
+                # Non-concatenated dimensions are shared by every source
+                tables[dim] = whole_source_slices(chunk_starts, chunk_ends)
+        return tables
+
+    def plan(self, chunk_definition: Dict[str, int], region: Optional[Mapping[str, slice]] = None, positional: bool = False) -> ChunkPlan:
+        """
+        Build the factorized ChunkPlan for `chunk_definition`.
+
+        With `region` (a slice of labels, or of positions if `positional`, per dimension)
+        the plan only holds the chunks intersecting it, keyed as in the full plan.
+        """
+        chunk_definition = self._resolve_chunk_definition(chunk_definition)
+        variables = self.metadata.variables
+        windows = self._chunk_windows(chunk_definition, region, positional) if region else None
+        with instrument.phase("slices"):
+            tables = self._dim_slice_tables(chunk_definition, [dim for dims in variables.values() for dim in dims], windows)
+        chunk_plan = ChunkPlan(
+            chunk_definition,
+            self.metadata.sizes,
+            variables,
+            tables,
+            sources=self.source_datasets,
+            concat_dim=self.concat_dim_name,
+            dtypes=self.metadata.dtypes,
+            chunk_offsets={dim: first for dim, (first, _) in (windows or {}).items()},
+        )
+        instrument.count_plan(chunk_plan)
+        return chunk_plan
+
+    def append(self, *new_datasets: Union[xr.Dataset, str], metadata: Optional[Sequence[SourceMetadata]] = None) -> "ConcatChunkPlanner":
+        """
+        Planner for this concatenation with `new_datasets` appended along the concat dimension.
+
+        The new datasets must follow the existing ones, in order, and match their sizes
+        along every other dimension. Only their metadata is read (or taken from
+        `metadata`, one per dataset), and this planner is left as it is, so plans built
+        from it can be brought up to date with `update_plan`.
+        """
+        if not new_datasets:
+            raise ValueError("At least one dataset must be appended.")
+        if metadata is None:
+            metadata = [SourceMetadata.from_dataset(open_source(ds)) for ds in new_datasets]
+        for n, source_metadata in enumerate(metadata):
+            for dim, size in source_metadata.sizes.items():
+                if dim != self.concat_dim_name and self.metadata.sizes.get(dim, size) != size:
+                    raise ValueError(f"Appended dataset {n} has size {size} along '{dim}', expected {self.metadata.sizes[dim]}")
+
+        concat_dim_ranges = list(self.concat_dim_ranges)
+        offsets = list(self.offsets)
+        current_offset = concat_dim_ranges[-1][1] if concat_dim_ranges else 0
+        for source_metadata in metadata:
+            end = current_offset + source_metadata.sizes[self.concat_dim_name]
+            concat_dim_ranges.append((current_offset, end))
+            offsets.append(current_offset)
+            current_offset = end
+
+        return ConcatChunkPlanner(
+            [*self.source_datasets, *new_datasets],
+            None,
+            concat_dim_ranges,
+            offsets,
+            concat_dim_name=self.concat_dim_name,
+            metadata=SourceMetadata.concat([self.metadata, *metadata], self.concat_dim_name),
+            source_metadata=[*self.source_metadata, *metadata] if self.source_metadata is not None else None,
+        )
+
+    def update_plan(self, previous: ChunkPlan) -> ChunkPlan:
+        """
+        Extend `previous`, a plan over a prefix of this planner's sources, to all of them.
+
+        Along the concat dimension only the previous trailing (possibly partial) chunk and
+        the chunks after it are computed; every other row of every table is reused, so
+        the cost is proportional to the appended data. `ChunkPlan.changed_keys` lists the
+        keys which then need to be (re)written.
+        """
+        dim = self.concat_dim_name
+        if previous.is_region():
+            raise ValueError("Only plans of the full output can be updated")
+        if previous.concat_dim != dim or len(previous.sources) > len(self.source_datasets):
+            raise ValueError(f"Plan is not a plan of a prefix of this concatenation along '{dim}'")
+        for other_dim, size in previous.dim_sizes.items():
+            if other_dim != dim and self.metadata.sizes[other_dim] != size:
+                raise ValueError(f"Dimension '{other_dim}' changed size from {size} to {self.metadata.sizes[other_dim]}")
+
+        chunk_size = previous.chunk_definition[dim]
+        size = self.metadata.sizes[dim]
+        first_changed = previous.dim_sizes[dim] // chunk_size
+        chunk_starts, chunk_ends = chunk_boundaries(size, chunk_size, first_changed)
+        source_ends = [end for _, end in self.concat_dim_ranges]
+        new_indptr, new_pieces = overlap_slices(self.offsets, source_ends, chunk_starts, chunk_ends)
+
+        indptr, pieces = previous.dim_tables[dim]
+        n_kept = indptr[first_changed]
+        tables = dict(previous.dim_tables)
+        tables[dim] = (
+            np.concatenate([indptr[:first_changed], new_indptr + n_kept]),
+            np.concatenate([pieces[:n_kept], new_pieces]),
+        )
+        return ChunkPlan(
+            previous.chunk_definition,
+            self.metadata.sizes,
+            previous.variables,
+            tables,
+            sources=self.source_datasets,
+            concat_dim=dim,
+            dtypes=previous.dtypes,
+        )
+
+    def iter_chunks(self, chunk_definition: Dict[str, int], region: Optional[Mapping[str, slice]] = None, positional: bool = False) -> Iterator[Tuple[str, Dict[str, List[Slice]]]]:
+        """
+        Lazily yield (zarr_key, slices) records for every output chunk.
+
+        Records are produced variable by variable, in row-major chunk order, and
+        nothing is retained between records, so memory use does not depend on the
+        size of the output grid.
+        """
+        return self.plan(chunk_definition, region, positional).iter_chunks()
+
+    def map_chunks(self, chunk_definition: Dict[str, int], stream: bool = False, region: Optional[Mapping[str, slice]] = None, positional: bool = False, cache: Optional["PlanCache"] = None) -> Union[ChunkPlan, Iterator[Tuple[str, Dict[str, List[Slice]]]]]:
+        """
+        Map output chunks to input slices without duplication.
+
+        The returned ChunkPlan is a read-only mapping resolved on demand. With
+        `stream=True` this returns the `iter_chunks` generator instead. `region`
+        restricts the plan to the chunks intersecting a sub-selection (see `plan`).
+        Plans of the full output are looked up in, and added to, `cache` if given.
+        """
+        if stream:
+            return self.iter_chunks(chunk_definition, region, positional)
+        if cache is not None and not region:
+            return cache.plan(self, chunk_definition)
+        return self.plan(chunk_definition, region, positional)
+
+    def to_kerchunk_references(self, source_refs: Sequence[Mapping[str, Any]], chunk_definition: Optional[Dict[str, int]] = None, output: Optional[str] = None, **storage_options) -> Tuple[Dict[str, Any], Dict[str, Dict[str, List[Slice]]]]:
+        """
+        Emit kerchunk references for every output chunk which is exactly one native source chunk.
+
+        `source_refs` are kerchunk reference sets for `self.source_datasets`, in the same
+        order. `chunk_definition` defaults to the native chunking of the first source. The
+        references (including inlined dimension coordinates) are written to `output` as
+        JSON or parquet when it is given. Returns the references together with the
+        `{zarr_key: slices}` of the misaligned chunks, which still need to be copied.
+        """
+        from ..kerchunk import kerchunk_references, native_chunk_definition, write_references
+
+        if chunk_definition is None:
+            chunk_definition = native_chunk_definition(source_refs[0])
+        coords = {name: coord for name, coord in self.coords.items() if coord.dtype.kind not in "OSU"}
+        references, work = kerchunk_references(self.plan(chunk_definition), source_refs, coords=coords)
+        if output is not None:
+            write_references(references, output, **storage_options)
+        return references, work
@@ -0,0 +1,173 @@
+from ..base import BaseChunkPlanner
+from ..plan import ChunkPlan, Slice
+from ..sources import SourceMetadata
+
+import json
+import os
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from ..cache import PlanCache
+
+MERGE_HEADER = "merge.json"
+
+
+def _offset_slices(slices: Dict[str, List[Slice]], offset: int) -> Dict[str, List[Slice]]:
+    if not offset:
+        return slices
+    return {dim: [(source + offset, start, end) for source, start, end in pieces] for dim, pieces in slices.items()}
+
+
+def _check_shared_variable(var_name: str, variable_dims: Tuple[str, ...], first: SourceMetadata, first_part: int, metadata: SourceMetadata, part: int) -> None:
+    # Like xr.merge(compat='override'), a variable held by several parts is read from
+    # the first, which is only right if they hold it over the same coordinates
+    for dim in variable_dims:
+        if dim not in first.bounds and dim not in metadata.bounds:
+            continue
+        if dim not in first.bounds or dim not in metadata.bounds or not np.array_equal(first.bounds[dim], metadata.bounds[dim]):
+            raise ValueError(
+                f"Parts {first_part} and {part} both hold '{var_name}' over different '{dim}' coordinates; "
+                f"pass concat_dim to concatenate them instead of merging"
+            )
+
+
+class MergePlan(ChunkPlan):
+    """
+    Chunk plan of the merge of the variables of several part plans.
+
+    Every variable is read from the first part holding it; its entries are that part's,
+    with source indices offset into the concatenated list of all parts' sources. Entries
+    of a dimension come from the first part holding it.
+    """
+
+    def __init__(self, parts: Sequence[ChunkPlan]):
+        self.parts = list(parts)
+        self.source_offsets = np.concatenate([[0], np.cumsum([len(part.sources) for part in self.parts])]).astype(int).tolist()
+        self.owners: Dict[str, int] = {}
+        chunk_definition: Dict[str, int] = {}
+        dim_sizes: Dict[str, int] = {}
+        dim_tables: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        variables: Dict[str, Tuple[str, ...]] = {}
+        dtypes: Dict[str, str] = {}
+        for n, part in enumerate(self.parts):
+            for dim, table in part.dim_tables.items():
+                if dim in dim_sizes and (dim_sizes[dim], chunk_definition[dim]) != (part.dim_sizes[dim], part.chunk_definition[dim]):
+                    raise ValueError(
+                        f"Part {n} has {part.dim_sizes[dim]} '{dim}' steps in chunks of {part.chunk_definition[dim]}, "
+                        f"expected {dim_sizes[dim]} in chunks of {chunk_definition[dim]}"
+                    )
+                if dim not in dim_tables:
+                    indptr, pieces = table
+                    pieces = np.array(pieces, dtype=np.int64)
+                    pieces[:, 0] += self.source_offsets[n]
+                    dim_tables[dim] = (indptr, pieces)
+                    dim_sizes[dim] = part.dim_sizes[dim]
+                    chunk_definition[dim] = part.chunk_definition[dim]
+            for var_name, variable_dims in part.variables.items():
+                if var_name not in variables:
+                    variables[var_name] = variable_dims
+                    self.owners[var_name] = n
+                    if var_name in part.dtypes:
+                        dtypes[var_name] = part.dtypes[var_name]
+
+        concat_dims = {part.concat_dim for part in self.parts if len(part.sources) > 1}
+        if len(concat_dims) > 1:
+            raise ValueError(f"Parts are concatenated along different dimensions: {sorted(concat_dims)}")
+        concat_dim = concat_dims.pop() if concat_dims else self.parts[0].concat_dim
+        sources = [source for part in self.parts for source in part.sources]
+        super().__init__(chunk_definition, dim_sizes, variables, dim_tables, sources=sources, concat_dim=concat_dim, dtypes=dtypes)
+
+    def chunk_slices(self, var_name: str, chunk_numbers: Sequence[int]) -> Dict[str, List[Slice]]:
+        n = self.owners[var_name]
+        return _offset_slices(self.parts[n].chunk_slices(var_name, chunk_numbers), self.source_offsets[n])
+
+    def chunk_sources(self, var_name: str, slices: Dict[str, List[Slice]]) -> List[int]:
+        if not self.variables[var_name]:
+            # Scalars are read from the first source of the part holding them
+            return [self.source_offsets[self.owners[var_name]]]
+        return super().chunk_sources(var_name, slices)
+
+    def iter_chunks(self, var_names: Optional[Iterable[str]] = None) -> Iterator[Tuple[str, Dict[str, List[Slice]]]]:
+        """Yield (zarr_key, slices) for every output chunk, variable by variable in row-major order."""
+        for var_name in self.variables if var_names is None else var_names:
+            n = self.owners[var_name]
+            for zarr_key, slices in self.parts[n].iter_chunks([var_name]):
+                yield zarr_key, _offset_slices(slices, self.source_offsets[n])
+
+    def save(self, path: Union[str, os.PathLike]) -> None:
+        """Write every part as `ChunkPlan.save` does, in a `part_{n}` subdirectory of `path`."""
+        os.makedirs(path, exist_ok=True)
+        for n, part in enumerate(self.parts):
+            part.save(os.path.join(path, f"part_{n}"))
+        with open(os.path.join(path, MERGE_HEADER), "w") as f:
+            json.dump({"parts": len(self.parts)}, f)
+
+    @classmethod
+    def open(cls, path: Union[str, os.PathLike], mmap: bool = True) -> "MergePlan":
+        with open(os.path.join(path, MERGE_HEADER)) as f:
+            n_parts = json.load(f)["parts"]
+        return cls([ChunkPlan.open(os.path.join(path, f"part_{n}"), mmap=mmap) for n in range(n_parts)])
+
+
+class MergeChunkPlanner(BaseChunkPlanner):
+    """
+    Plans the merge of datasets which hold different variables over the same grid.
+
+    `parts` are planners with a `plan(chunk_definition)` method, such as a
+    `ConcatChunkPlanner` per variable for a merge of concatenations. Each output
+    variable is routed to the first part holding it, and no merged dataset is built.
+    Parts holding the same variable must hold it over the same coordinates, or ValueError
+    is raised: they are pieces of a series to concatenate, not to merge.
+    """
+
+    def __init__(self, *parts: Any):
+        if not parts:
+            raise ValueError("At least one part must be provided.")
+        self.parts = list(parts)
+        self.source_datasets = [source for part in self.parts for source in part.source_datasets]
+
+        sizes: Dict[str, int] = {}
+        owners: Dict[str, int] = {}
+        variables: Dict[str, Tuple[str, ...]] = {}
+        dtypes: Dict[str, str] = {}
+        chunks: Dict[str, int] = {}
+        native_chunks: Dict[str, Dict[str, int]] = {}
+        for n, part in enumerate(self.parts):
+            metadata = part.metadata
+            for dim, size in metadata.sizes.items():
+                if sizes.setdefault(dim, size) != size:
+                    raise ValueError(f"Part {n} has {size} '{dim}' steps, expected {sizes[dim]}")
+            for dim, size in metadata.chunks.items():
+                chunks.setdefault(dim, size)
+            for var_name, variable_dims in metadata.variables.items():
+                if var_name in variables:
+                    _check_shared_variable(var_name, variable_dims, self.parts[owners[var_name]].metadata, owners[var_name], metadata, n)
+                else:
+                    owners[var_name] = n
+                    variables[var_name] = variable_dims
+                    dtypes[var_name] = metadata.dtypes[var_name]
+                    native_chunks[var_name] = metadata.native_chunks.get(var_name, {})
+        self.metadata = SourceMetadata(sizes, variables, dtypes, chunks, native_chunks)
+
+    @property
+    def coords(self) -> Dict[str, Any]:
+        """Dimension coordinates of the merged dataset, each from the first part holding it"""
+        coords: Dict[str, Any] = {}
+        for part in self.parts:
+            for name, coord in part.coords.items():
+                coords.setdefault(name, coord)
+        return coords
+
+    def plan(self, chunk_definition: Dict[str, int]) -> MergePlan:
+        """Build the MergePlan for `chunk_definition`, planning each part with the same chunking"""
+        chunk_definition = {**self.metadata.sizes, **self.metadata.chunks, **chunk_definition}
+        return MergePlan([
+            part.plan({dim: chunk_definition[dim] for dim in part.metadata.sizes})
+            for part in self.parts
+        ])
+
+    def map_chunks(self, chunk_definition: Dict[str, int], cache: Optional["PlanCache"] = None) -> MergePlan:
+        """Map every output variable's chunks to the slices of the part holding it (through `cache`, if given)."""
+        return self.plan(chunk_definition) if cache is None else cache.plan(self, chunk_definition)
@@ -0,0 +1,203 @@
+from .. import instrument
+from ..base import BaseChunkPlanner
+from ..plan import PLAN_HEADER, ChunkPlan, Piece, Slice
+from ..sources import SourceMetadata
+from ..util import chunk_boundaries, overlap_slices, whole_source_slices
+
+import itertools
+import json
+import os
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from ..cache import PlanCache
+
+
+def _first_tiles(grid: np.ndarray, axes: Iterable[int]) -> np.ndarray:
+    """Collapse `axes` of a tile grid, keeping the first tile present along each."""
+    for axis in sorted(axes, reverse=True):
+        first = np.argmax(grid >= 0, axis=axis)
+        grid = np.take_along_axis(grid, np.expand_dims(first, axis), axis=axis).squeeze(axis)
+    return grid
+
+
+def _representatives(grid: np.ndarray, axis: int) -> np.ndarray:
+    """For each tile position along `axis`, the first source present at that position."""
+    return _first_tiles(grid, [other for other in range(grid.ndim) if other != axis])
+
+
+class MosaicPlan(ChunkPlan):
+    """
+    Chunk plan of a mosaic of tiles laid out on a grid over `grid_dims`.
+
+    `grid` maps tile positions to source indices (-1 where a tile is missing). The table
+    of each grid dimension holds `(source, start, end)` pieces, `source` being a source
+    at that tile position along the dimension (the first present), so every entry names
+    a source holding those elements, as every plan's do. `chunk_pieces` resolves the
+    entries into one read per tile the chunk intersects, through the positions of those
+    sources on the grid.
+
+    Work is partitioned (`shard`, `partition`) along the first grid dimension.
+    """
+
+    def __init__(self, *args, grid: np.ndarray, grid_dims: Sequence[str], **kwargs):
+        super().__init__(*args, **kwargs)
+        self.grid = np.asarray(grid, dtype=np.int64)
+        self.grid_dims = tuple(grid_dims)
+        self._variable_grids: Dict[str, np.ndarray] = {}
+        present = np.argwhere(self.grid >= 0)
+        sources = self.grid[tuple(present.T)]
+        self._positions: Dict[str, np.ndarray] = {}
+        for axis, dim in enumerate(self.grid_dims):
+            positions = np.full(int(sources.max(initial=-1)) + 1, -1, dtype=np.int64)
+            positions[sources] = present[:, axis]
+            self._positions[dim] = positions
+
+    def _slab_dim(self) -> Optional[str]:
+        """The first grid dimension any variable has: tiles along it are read slab by slab."""
+        return next((dim for dim in self.grid_dims if any(dim in dims for dims in self.variables.values())), None)
+
+    def _variable_grid(self, var_name: str) -> np.ndarray:
+        """Tile grid over the grid dimensions of `var_name`, in its dimension order."""
+        if var_name not in self._variable_grids:
+            variable_dims = self.variables[var_name]
+            collapsed = [n for n, dim in enumerate(self.grid_dims) if dim not in variable_dims]
+            kept = [dim for dim in self.grid_dims if dim in variable_dims]
+            grid = _first_tiles(self.grid, collapsed)
+            order = [kept.index(dim) for dim in variable_dims if dim in kept]
+            self._variable_grids[var_name] = grid.transpose(order)
+        return self._variable_grids[var_name]
+
+    def chunk_pieces(self, var_name: str, slices: Dict[str, List[Slice]]) -> List[Piece]:
+        """The reads of the output chunk of `var_name` with `slices`, one per tile present; missing tiles are left to the fill value."""
+        variable_dims = self.variables[var_name]
+        grid = self._variable_grid(var_name)
+        placed = []
+        for dim in variable_dims:
+            positions = self._positions.get(dim)
+            offset, dim_pieces = 0, []
+            for source, start, end in slices[dim]:
+                dim_pieces.append((positions[source] if positions is not None else 0, start, end, offset))
+                offset += end - start
+            placed.append(dim_pieces)
+
+        pieces = []
+        for combination in itertools.product(*placed):
+            tile = tuple(piece[0] for dim, piece in zip(variable_dims, combination) if dim in self.grid_dims)
+            source = int(grid[tile])
+            if source >= 0:
+                region = {dim: (start, end) for dim, (_, start, end, _) in zip(variable_dims, combination)}
+                offsets = {dim: offset for dim, (_, _, _, offset) in zip(variable_dims, combination)}
+                pieces.append((source, region, offsets))
+        return pieces
+
+    def chunk_sources(self, var_name: str, slices: Dict[str, List[Slice]]) -> List[int]:
+        return [source for source, _, _ in self.chunk_pieces(var_name, slices)]
+
+    def save(self, path: Union[str, os.PathLike]) -> None:
+        """Write the plan as `ChunkPlan.save` does, with the tile grid next to the tables."""
+        super().save(path)
+        np.save(os.path.join(path, "grid.npy"), self.grid)
+        with open(os.path.join(path, PLAN_HEADER)) as f:
+            header = json.load(f)
+        header["grid_dims"] = list(self.grid_dims)
+        with open(os.path.join(path, PLAN_HEADER), "w") as f:
+            json.dump(header, f)
+
+    @classmethod
+    def open(cls, path: Union[str, os.PathLike], mmap: bool = True) -> "MosaicPlan":
+        plan = ChunkPlan.open(path, mmap=mmap)
+        with open(os.path.join(path, PLAN_HEADER)) as f:
+            grid_dims = json.load(f)["grid_dims"]
+        return cls(
+            plan.chunk_definition,
+            plan.dim_sizes,
+            plan.variables,
+            plan.dim_tables,
+            sources=plan.sources,
+            dtypes=plan.dtypes,
+            chunk_offsets=plan.chunk_offsets,
+            grid=np.load(os.path.join(path, "grid.npy")),
+            grid_dims=grid_dims,
+        )
+
+
+class MosaicChunkPlanner(BaseChunkPlanner):
+    """
+    Plans the mosaic of sources tiled along several dimensions at once.
+
+    `grid` holds, for every tile position over `grid_dims`, the index of the source at
+    that position, or -1 where there is none. Tiles in the same row along a dimension
+    must agree on their size along it. Each dimension's tile edges are kept sorted, so
+    the tiles intersecting a chunk are found by binary search along every dimension
+    rather than by a scan over all tiles.
+    """
+
+    def __init__(self, source_datasets: Sequence[Any], grid: np.ndarray, grid_dims: Sequence[str], source_metadata: Sequence[SourceMetadata]):
+        self.source_datasets = list(source_datasets)
+        self.grid = np.asarray(grid, dtype=np.int64)
+        self.grid_dims = tuple(grid_dims)
+        self.source_metadata = list(source_metadata)
+        if self.grid.ndim != len(self.grid_dims):
+            raise ValueError(f"Grid has {self.grid.ndim} dimensions, expected {len(self.grid_dims)}")
+
+        self.tile_offsets = {}
+        sizes = dict(self.source_metadata[int(self.grid[self.grid >= 0].flat[0])].sizes)
+        for axis, dim in enumerate(self.grid_dims):
+            tile_sizes = []
+            for position in range(self.grid.shape[axis]):
+                row = np.take(self.grid, position, axis=axis)
+                row_sizes = {self.source_metadata[source].sizes[dim] for source in row[row >= 0].tolist()}
+                if len(row_sizes) != 1:
+                    raise ValueError(f"Tiles at position {position} along '{dim}' have sizes {sorted(row_sizes)}, expected exactly one")
+                tile_sizes.extend(row_sizes)
+            self.tile_offsets[dim] = np.concatenate([[0], np.cumsum(tile_sizes)]).astype(np.int64)
+            sizes[dim] = int(self.tile_offsets[dim][-1])
+
+        first = self.source_metadata[int(self.grid[self.grid >= 0].flat[0])]
+        chunks = {dim: size for dim, size in first.chunks.items() if dim not in self.grid_dims}
+        self.metadata = SourceMetadata(sizes, first.variables, first.dtypes, chunks, first.native_chunks)
+
+    def _dim_slice_tables(self, chunk_definition: Dict[str, int], dims: Iterable[str]) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """
+        Per dimension, the (source, start, end) pieces of each chunk, found by binary search
+        over tile edges; each piece names the first source at its tile position.
+        """
+        tables = {}
+        for dim in dims:
+            if dim in tables:
+                continue
+            chunk_starts, chunk_ends = chunk_boundaries(self.metadata.sizes[dim], chunk_definition[dim])
+            if dim in self.grid_dims:
+                offsets = self.tile_offsets[dim]
+                indptr, pieces = overlap_slices(offsets[:-1], offsets[1:], chunk_starts, chunk_ends)
+                pieces[:, 0] = _representatives(self.grid, self.grid_dims.index(dim))[pieces[:, 0]]
+                tables[dim] = (indptr, pieces)
+            else:
+                tables[dim] = whole_source_slices(chunk_starts, chunk_ends)
+        return tables
+
+    def plan(self, chunk_definition: Dict[str, int]) -> MosaicPlan:
+        """Build the MosaicPlan for `chunk_definition`"""
+        chunk_definition = {**self.metadata.sizes, **self.metadata.chunks, **chunk_definition}
+        variables = self.metadata.variables
+        with instrument.phase("slices"):
+            tables = self._dim_slice_tables(chunk_definition, [dim for dims in variables.values() for dim in dims])
+        chunk_plan = MosaicPlan(
+            chunk_definition,
+            self.metadata.sizes,
+            variables,
+            tables,
+            sources=self.source_datasets,
+            dtypes=self.metadata.dtypes,
+            grid=self.grid,
+            grid_dims=self.grid_dims,
+        )
+        instrument.count_plan(chunk_plan)
+        return chunk_plan
+
+    def map_chunks(self, chunk_definition: Dict[str, int], cache: Optional["PlanCache"] = None) -> MosaicPlan:
+        """Map output chunks to the pieces of the tiles they intersect (through `cache`, if given)."""
+        return self.plan(chunk_definition) if cache is None else cache.plan(self, chunk_definition)
@@ -0,0 +1,207 @@
+from . import instrument
+from .execute import DEFAULT_COMPRESSOR, ExecutionContext, clear_partial_chunks, encode_chunk, read_chunk, store_chunk, variable_specs, write_metadata
+from .instrument import ChunkTiming
+from .plan import ChunkPlan, Slice
+
+import asyncio
+import math
+import os
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Mapping, MutableMapping, NamedTuple, Optional, Tuple, Union
+
+import fsspec
+import numcodecs
+import numpy as np
+
+Fetch = Callable[[str, Dict[str, List[Slice]]], Awaitable[np.ndarray]]
+_END = object()
+
+
+class Prefetched(NamedTuple):
+    """The data of one output chunk, read ahead, and how long the read took."""
+    zarr_key: str
+    slices: Dict[str, List[Slice]]
+    data: np.ndarray
+    read_seconds: float
+
+
+async def prefetch_chunks(
+    records: Iterable[Tuple[str, Dict[str, List[Slice]]]],
+    fetch: Fetch,
+    nbytes: Callable[[str, Dict[str, List[Slice]]], int],
+    prefetch: int = 8,
+    max_bytes: int = 256 * 2**20,
+    ordered: bool = True,
+) -> AsyncIterator[Prefetched]:
+    """
+    Read the chunks of `records` ahead of their consumer, up to `prefetch` at a time.
+
+    `fetch` reads the data of a chunk, and `nbytes` gives its size. A chunk counts
+    against `max_bytes` from when its read starts until the consumer asks for the next
+    one; no read starts while that would exceed the budget, unless nothing else is held.
+    Chunks are yielded in the order of `records` if `ordered`, otherwise as their reads
+    complete. Reads still pending when the consumer stops are cancelled.
+    """
+    async def timed_fetch(zarr_key: str, slices: Dict[str, List[Slice]]) -> Tuple[np.ndarray, float]:
+        start = time.perf_counter()
+        data = await fetch(zarr_key, slices)
+        return data, time.perf_counter() - start
+
+    records = iter(records)
+    waiting: Any = next(records, _END)
+    # Insertion order is start order, which the ordered mode follows
+    tasks: Dict[asyncio.Future, Tuple[str, Dict[str, List[Slice]], int]] = {}
+    held_bytes = 0
+    try:
+        while True:
+            while waiting is not _END and len(tasks) < prefetch:
+                size = nbytes(*waiting)
+                if tasks and held_bytes + size > max_bytes:
+                    break
+                tasks[asyncio.ensure_future(timed_fetch(*waiting))] = (*waiting, size)
+                held_bytes += size
+                waiting = next(records, _END)
+            if not tasks:
+                return
+
+            if ordered:
+                task = next(iter(tasks))
+                await asyncio.wait([task])
+            else:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                task = next(task for task in tasks if task in done)
+            zarr_key, slices, size = tasks.pop(task)
+            data, read_seconds = task.result()
+            yield Prefetched(zarr_key, slices, data, read_seconds)
+            held_bytes -= size
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def chunk_fetcher(plan: ChunkPlan, context: ExecutionContext, specs: Mapping[str, Any], executor: Optional[Executor] = None) -> Fetch:
+    """A `fetch` reading chunks of `plan` with `read_chunk` on `executor` (the event loop's default if None)."""
+    async def fetch(zarr_key: str, slices: Dict[str, List[Slice]]) -> np.ndarray:
+        spec = specs[zarr_key.rpartition("/")[0]]
+        pieces = plan.chunk_pieces(spec.name, slices)
+        sources = {source: plan.sources[source] for source, _, _ in pieces}
+        return await asyncio.get_running_loop().run_in_executor(executor, read_chunk, context, spec, pieces, sources)
+    return fetch
+
+
+def with_latency(fetch: Fetch, latency: Union[float, Callable[[str], float]]) -> Fetch:
+    """Wrap `fetch` to wait `latency` seconds (or `latency(zarr_key)`) before each read, as remote storage would."""
+    async def delayed(zarr_key: str, slices: Dict[str, List[Slice]]) -> np.ndarray:
+        await asyncio.sleep(latency(zarr_key) if callable(latency) else latency)
+        return await fetch(zarr_key, slices)
+    return delayed
+
+
+def _store_chunk(context: ExecutionContext, spec: Any, zarr_key: str, data: np.ndarray) -> Tuple[int, float]:
+    start = time.perf_counter()
+    encoded = encode_chunk(context, spec, data)
+    store_chunk(context.store, zarr_key, encoded)
+    return len(encoded), time.perf_counter() - start
+
+
+async def execute_async(
+    plan: ChunkPlan,
+    store: Union[str, os.PathLike, MutableMapping],
+    fetch: Optional[Fetch] = None,
+    prefetch: int = 8,
+    max_prefetch_bytes: int = 256 * 2**20,
+    max_writes: int = 4,
+    ordered: bool = False,
+    executor: Optional[Executor] = None,
+    keys: Optional[Iterable[str]] = None,
+    coords: Optional[Mapping[str, Any]] = None,
+    compressor: Optional[numcodecs.abc.Codec] = DEFAULT_COMPRESSOR,
+    engine: Optional[str] = None,
+    max_open_files: int = 128,
+    skip_existing: bool = True,
+    metadata: bool = True,
+) -> Dict[str, int]:
+    """
+    Materialize a chunk plan as `execute` does, reading ahead of encoding and writing.
+
+    The source data of the next `prefetch` chunks is read concurrently, within a budget
+    of `max_prefetch_bytes` (see `prefetch_chunks`), while up to `max_writes` earlier
+    chunks are encoded and written on `executor`. Chunks handed to writers leave that
+    budget, so up to `max_writes` more chunks may be held at once. Reads go through `fetch`, by default
+    `read_chunk` on `executor`; wrap it with `with_latency`, or pass any coroutine
+    function, to model or use other storage. Chunks are written in plan order if
+    `ordered`, otherwise as soon as they are read.
+
+    Returns counts of chunks written and skipped and of bytes written.
+    """
+    if isinstance(store, (str, os.PathLike)):
+        store = fsspec.get_mapper(os.fspath(store))
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor()
+    loop = asyncio.get_running_loop()
+    observer = instrument.current()
+    stats = {"written": 0, "skipped": 0, "bytes_written": 0}
+    # Pending writes, with the key and read latency of their chunk
+    writes: Dict[asyncio.Future, Tuple[str, float]] = {}
+
+    def collect(done: Iterable[asyncio.Future]) -> None:
+        for future in done:
+            zarr_key, read_seconds = writes.pop(future)
+            nbytes, write_seconds = future.result()
+            stats["written"] += 1
+            stats["bytes_written"] += nbytes
+            if observer is not None:
+                observer.on_chunk(ChunkTiming(zarr_key, read_seconds, write_seconds, nbytes))
+
+    try:
+        if metadata:
+            specs = await loop.run_in_executor(executor, partial(write_metadata, plan, store, compressor=compressor, coords=coords, engine=engine))
+        else:
+            specs = await loop.run_in_executor(executor, partial(variable_specs, plan, engine=engine))
+        context = ExecutionContext(store, compressor, engine, max_open_files)
+        if skip_existing:
+            await loop.run_in_executor(executor, clear_partial_chunks, store)
+        existing = set(store) if skip_existing else set()
+        records = plan.iter_chunks() if keys is None else ((key, plan[key]) for key in keys)
+
+        def pending() -> Iterable[Tuple[str, Dict[str, List[Slice]]]]:
+            for zarr_key, slices in records:
+                if zarr_key in existing:
+                    stats["skipped"] += 1
+                else:
+                    yield zarr_key, slices
+
+        def nbytes(zarr_key: str, slices: Dict[str, List[Slice]]) -> int:
+            spec = specs[zarr_key.rpartition("/")[0]]
+            return math.prod(spec.chunk_shape) * spec.dtype.itemsize
+
+        fetch = chunk_fetcher(plan, context, specs, executor) if fetch is None else fetch
+        chunks = prefetch_chunks(pending(), fetch, nbytes, prefetch, max_prefetch_bytes, ordered)
+        try:
+            async for chunk in chunks:
+                while len(writes) >= max_writes:
+                    done, _ = await asyncio.wait(writes, return_when=asyncio.FIRST_COMPLETED)
+                    collect(done)
+                spec = specs[chunk.zarr_key.rpartition("/")[0]]
+                future = loop.run_in_executor(executor, _store_chunk, context, spec, chunk.zarr_key, chunk.data)
+                writes[future] = (chunk.zarr_key, chunk.read_seconds)
+        finally:
+            await chunks.aclose()
+        if writes:
+            done, _ = await asyncio.wait(writes)
+            collect(done)
+    finally:
+        # After a failure, let the (at most `max_writes`) writes handed out finish: cancelling
+        # their wrappers would not stop the threads running them
+        await asyncio.gather(*writes, return_exceptions=True)
+        if own_executor:
+            # Without blocking the event loop while reads still running finish
+            await loop.run_in_executor(None, executor.shutdown)
+
+    for name, value in (("chunks_written", stats["written"]), ("chunks_skipped", stats["skipped"]), ("bytes_written", stats["bytes_written"])):
+        instrument.count(name, value)
+    return stats
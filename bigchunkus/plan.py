@@ -0,0 +1,495 @@
+from . import instrument
+from .zarr import iter_chunk_keys
+
+import functools
+import itertools
+import json
+import math
+import os
+import time
+from collections.abc import Mapping
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import xarray as xr
+
+Slice = Tuple[int, int, int]
+# A read of an output chunk: (source, {dim: (start, end)} in the source, {dim: offset} in the chunk)
+Piece = Tuple[int, Dict[str, Tuple[int, int]], Dict[str, int]]
+
+PLAN_FORMAT_VERSION = 1
+PLAN_HEADER = "plan.json"
+PARTITION_WEIGHTS = ("bytes", "chunks")
+
+
+def _source_name(source: Any) -> Optional[str]:
+    """Best-effort path of a plan source, for serialization."""
+    if isinstance(source, (str, os.PathLike)):
+        return os.fspath(source)
+    if isinstance(source, xr.Dataset):
+        return source.encoding.get("source")
+    return None
+
+
+class ChunkPlan(Mapping):
+    """
+    Factorized mapping of output zarr keys to source slices.
+
+    The slices of an output chunk only depend on its chunk number along each dimension,
+    so rather than storing them for every zarr key, a plan keeps one slice table per
+    dimension (in CSR form: the pieces of chunk `n` along `dim` are
+    `pieces[indptr[n]:indptr[n + 1]]`, each row a `(source, start, end)` triple) together
+    with the dimensions of each variable. Entries are resolved on demand.
+
+    A plan behaves like the read-only dict `map_chunks` used to return: it holds a
+    `"var/i.j"` entry per output chunk and a `"dim/i"` entry per chunk of each dimension.
+    `dtypes`, if known, gives the numpy dtype string of each variable.
+
+    A plan may cover only a region of the output: the table of `dim` then holds the
+    chunks from `chunk_offsets[dim]` on, and keys are numbered as in the full plan.
+    """
+
+    def __init__(
+        self,
+        chunk_definition: Dict[str, int],
+        dim_sizes: Dict[str, int],
+        variables: Dict[str, Tuple[str, ...]],
+        dim_tables: Dict[str, Tuple[np.ndarray, np.ndarray]],
+        sources: Optional[Sequence[Any]] = None,
+        concat_dim: Optional[str] = None,
+        dtypes: Optional[Dict[str, str]] = None,
+        chunk_offsets: Optional[Dict[str, int]] = None,
+    ):
+        self.chunk_definition = dict(chunk_definition)
+        self.dim_sizes = dict(dim_sizes)
+        self.variables = {name: tuple(dims) for name, dims in variables.items()}
+        self.dim_tables = dim_tables
+        self.sources = list(sources) if sources is not None else []
+        self.concat_dim = concat_dim
+        self.dtypes = dict(dtypes or {})
+        self.chunk_offsets = {dim: int(offset) for dim, offset in (chunk_offsets or {}).items() if offset}
+
+    def n_chunks(self, dim: str) -> int:
+        """Number of chunks along `dim` (in the plan's region, if it covers one)."""
+        return len(self.dim_tables[dim][0]) - 1
+
+    def is_region(self) -> bool:
+        """Whether the plan covers only part of the output."""
+        return any(
+            self.chunk_offsets.get(dim, 0) or self.n_chunks(dim) != -(-self.dim_sizes[dim] // self.chunk_definition[dim])
+            for dim in self.dim_tables
+        )
+
+    def _chunk_starts(self, dim: str) -> range:
+        """Start offset of every chunk of the plan along `dim`."""
+        chunk_size = self.chunk_definition[dim]
+        first = self.chunk_offsets.get(dim, 0)
+        return range(first * chunk_size, min((first + self.n_chunks(dim)) * chunk_size, self.dim_sizes[dim]), chunk_size)
+
+    def _chunk_numbers(self, dim: str) -> range:
+        """Number of every chunk of the plan along `dim`."""
+        first = self.chunk_offsets.get(dim, 0)
+        return range(first, first + self.n_chunks(dim))
+
+    def chunk_indices(self, var_name: str) -> np.ndarray:
+        """
+        The `(n_chunks, ndim)` chunk numbers of every chunk of `var_name`, in key order.
+
+        Together with `zarr.format_chunk_keys` this gives the keys of a whole variable at once.
+        """
+        numbers = [np.asarray(self._chunk_numbers(dim), dtype=np.int64) for dim in self.variables[var_name]]
+        if not numbers:
+            return np.zeros((1, 0), dtype=np.int64)
+        return np.stack([grid.ravel() for grid in np.meshgrid(*numbers, indexing="ij")], axis=1)
+
+    def chunk_grid(self, var_name: str) -> Tuple[int, ...]:
+        """Number of chunks along each dimension of `var_name`."""
+        return tuple(self.n_chunks(dim) for dim in self.variables[var_name])
+
+    def dim_slices(self, dim: str, chunk_number: int) -> List[Slice]:
+        """Source slices making up chunk `chunk_number` along `dim`."""
+        indptr, pieces = self.dim_tables[dim]
+        row = chunk_number - self.chunk_offsets.get(dim, 0)
+        if not 0 <= row < len(indptr) - 1:
+            raise IndexError(f"Chunk {chunk_number} out of range for dimension '{dim}'")
+        return [tuple(piece) for piece in pieces[indptr[row]:indptr[row + 1]].tolist()]
+
+    def chunk_slices(self, var_name: str, chunk_numbers: Sequence[int]) -> Dict[str, List[Slice]]:
+        """Source slices for the chunk of `var_name` at `chunk_numbers`."""
+        variable_dims = self.variables[var_name]
+        if len(chunk_numbers) != len(variable_dims):
+            raise ValueError(f"Mismatched lengths: {len(chunk_numbers)} chunk numbers, but {len(variable_dims)} variable dimensions.")
+        return {dim: self.dim_slices(dim, n) for dim, n in zip(variable_dims, chunk_numbers)}
+
+    def chunk_sources(self, var_name: str, slices: Dict[str, List[Slice]]) -> List[int]:
+        """Indices of the sources the output chunk of `var_name` with `slices` is read from."""
+        variable_dims = self.variables[var_name]
+        if self.concat_dim in variable_dims:
+            return [source for source, _, _ in slices[self.concat_dim]]
+        if not variable_dims:
+            # Scalars (e.g. grid mappings) have no slices; they are read from the first source
+            return [0]
+        # Every source holds the variable in full; the first piece says which one to use
+        return [slices[variable_dims[0]][0][0]]
+
+    def chunk_pieces(self, var_name: str, slices: Dict[str, List[Slice]]) -> List[Piece]:
+        """
+        The reads making up the output chunk of `var_name` with `slices`, one per source
+        region, each with its offset in the chunk. Executors read chunks through these,
+        so plans whose tables do not hold source indices (e.g. `MosaicPlan`) override it.
+        """
+        variable_dims = self.variables[var_name]
+        region = {dim: (slices[dim][0][1], slices[dim][0][2]) for dim in variable_dims}
+        offsets = dict.fromkeys(variable_dims, 0)
+        if self.concat_dim not in variable_dims:
+            return [(self.chunk_sources(var_name, slices)[0], region, offsets)]
+        pieces = []
+        offset = 0
+        for source, start, end in slices[self.concat_dim]:
+            pieces.append((source, {**region, self.concat_dim: (start, end)}, {**offsets, self.concat_dim: offset}))
+            offset += end - start
+        return pieces
+
+    def variable_source(self, var_name: str) -> int:
+        """Index of the source of the first chunk of `var_name`, which stands for it in metadata."""
+        first = [self.chunk_offsets.get(dim, 0) for dim in self.variables[var_name]]
+        return self.chunk_sources(var_name, self.chunk_slices(var_name, first))[0]
+
+    def _dim_slice_lists(self) -> Dict[str, List[List[Slice]]]:
+        """Expand every dimension table into Python lists, for fast sequential access."""
+        slice_lists = {}
+        for dim, (indptr, pieces) in self.dim_tables.items():
+            rows = [tuple(piece) for piece in pieces.tolist()]
+            bounds = indptr.tolist()
+            slice_lists[dim] = [rows[lo:hi] for lo, hi in zip(bounds[:-1], bounds[1:])]
+        return slice_lists
+
+    def _iter_var_keys(self, var_names: Optional[Iterable[str]] = None) -> Iterator[str]:
+        """Yield the zarr key of every output chunk in a stable order."""
+        for var_name in self.variables if var_names is None else var_names:
+            yield from iter_chunk_keys(var_name, [self._chunk_numbers(dim) for dim in self.variables[var_name]])
+
+    def iter_chunks(self, var_names: Optional[Iterable[str]] = None) -> Iterator[Tuple[str, Dict[str, List[Slice]]]]:
+        """
+        Yield (zarr_key, slices) for every output chunk (of `var_names`, if given),
+        variable by variable in row-major order.
+        """
+        observer = instrument.current()
+        if observer is not None:
+            return self._iter_chunks_timed(var_names, observer)
+        return self._iter_chunks(var_names)
+
+    def _iter_chunks(self, var_names: Optional[Iterable[str]]) -> Iterator[Tuple[str, Dict[str, List[Slice]]]]:
+        slice_lists = self._dim_slice_lists()
+        for var_name in self.variables if var_names is None else var_names:
+            variable_dims = self.variables[var_name]
+            zarr_keys = iter_chunk_keys(var_name, [self._chunk_numbers(dim) for dim in variable_dims])
+            for zarr_key, slices in zip(zarr_keys, itertools.product(*(slice_lists[dim] for dim in variable_dims))):
+                yield zarr_key, dict(zip(variable_dims, slices))
+
+    def _iter_chunks_timed(self, var_names: Optional[Iterable[str]], observer: instrument.Observer) -> Iterator[Tuple[str, Dict[str, List[Slice]]]]:
+        """`_iter_chunks`, reporting the time spent generating keys and slices (not consuming them) as phases."""
+        clock = time.perf_counter
+        start = clock()
+        slice_lists = self._dim_slice_lists()
+        keys_seconds, enumerate_seconds = 0.0, clock() - start
+        start = clock()
+        try:
+            for var_name in self.variables if var_names is None else var_names:
+                variable_dims = self.variables[var_name]
+                zarr_keys = iter_chunk_keys(var_name, [self._chunk_numbers(dim) for dim in variable_dims])
+                products = itertools.product(*(slice_lists[dim] for dim in variable_dims))
+                for zarr_key in zarr_keys:
+                    keyed = clock()
+                    slices = dict(zip(variable_dims, next(products)))
+                    enumerated = clock()
+                    keys_seconds += keyed - start
+                    enumerate_seconds += enumerated - keyed
+                    yield zarr_key, slices
+                    start = clock()
+        finally:
+            observer.on_phase("keys", keys_seconds)
+            observer.on_phase("enumerate", enumerate_seconds)
+
+    def _iter_dim_keys(self) -> Iterator[str]:
+        for dim in self.dim_tables:
+            for n in self._chunk_numbers(dim):
+                yield f"{dim}/{n}"
+
+    def changed_keys(self, previous: "ChunkPlan") -> Iterator[str]:
+        """
+        Yield the zarr keys of output chunks which are new or changed since `previous`, an
+        earlier plan of the same concatenation before more sources were appended.
+
+        Along the concat dimension those are the previous trailing chunk (if it was
+        partial) and every chunk after it; variables without that dimension are unchanged.
+        Existing objects must be overwritten, e.g. `execute(..., skip_existing=False)`.
+        """
+        dim = self.concat_dim
+        if (
+            dim is None
+            or previous.concat_dim != dim
+            or previous.chunk_definition != self.chunk_definition
+            or previous.variables != self.variables
+            or any(previous.dim_sizes[other] != size for other, size in self.dim_sizes.items() if other != dim)
+        ):
+            raise ValueError(f"Plans differ by more than data appended along '{dim}'")
+
+        first_changed = previous.dim_sizes[dim] // self.chunk_definition[dim]
+        for var_name, variable_dims in self.variables.items():
+            if dim not in variable_dims:
+                continue
+            chunk_numbers = [
+                self._chunk_numbers(d)[max(first_changed - self.chunk_offsets.get(d, 0), 0):] if d == dim else self._chunk_numbers(d)
+                for d in variable_dims
+            ]
+            yield from iter_chunk_keys(var_name, chunk_numbers)
+
+    def _slab_dim(self) -> Optional[str]:
+        """The dimension work is partitioned along: the concat dimension, if any variable has it."""
+        if any(self.concat_dim in dims for dims in self.variables.values()):
+            return self.concat_dim
+        return None
+
+    def _dim_weights(self, dim: str, weight: str) -> np.ndarray:
+        """Weight factor of each chunk along `dim`: its length for `"bytes"`, 1 for `"chunks"`."""
+        if weight not in PARTITION_WEIGHTS:
+            raise ValueError(f"Unknown weight '{weight}', expected one of {PARTITION_WEIGHTS}")
+        if weight == "chunks":
+            return np.ones(self.n_chunks(dim), dtype=np.int64)
+        starts = np.asarray(self._chunk_starts(dim), dtype=np.int64)
+        return np.minimum(starts + self.chunk_definition[dim], self.dim_sizes[dim]) - starts
+
+    def _itemsize(self, var_name: str, weight: str) -> int:
+        if weight == "bytes" and var_name in self.dtypes:
+            return np.dtype(self.dtypes[var_name]).itemsize
+        return 1
+
+    def _chunk_weights(self, var_name: str, weight: str, slab: Optional[int] = None) -> np.ndarray:
+        """Weight of every chunk of `var_name` (at chunk `slab` along the slab dimension), in key order."""
+        factors = []
+        for dim in self.variables[var_name]:
+            dim_weights = self._dim_weights(dim, weight)
+            factors.append(dim_weights[slab:slab + 1] if dim == self._slab_dim() and slab is not None else dim_weights)
+        itemsize = self._itemsize(var_name, weight)
+        return itemsize * functools.reduce(np.multiply, np.ix_(*factors)).ravel() if factors else np.array([itemsize])
+
+    def _slab_weights(self, weight: str) -> np.ndarray:
+        """
+        Total weight of each slab, in partition order.
+
+        Slab 0 holds every chunk of the variables without the slab dimension (read from
+        the first source), and slab `n + 1` every chunk at `n` along the slab dimension.
+        A chunk's weight is a product of per-dimension factors, so these sums are too,
+        and no per-chunk weights are built.
+        """
+        slab_dim = self._slab_dim()
+        n_slabs = self.n_chunks(slab_dim) if slab_dim is not None else 0
+        weights = np.zeros(n_slabs + 1, dtype=np.int64)
+        for var_name, variable_dims in self.variables.items():
+            other = self._itemsize(var_name, weight)
+            for dim in variable_dims:
+                if dim != slab_dim:
+                    other *= int(self._dim_weights(dim, weight).sum())
+            if slab_dim in variable_dims:
+                weights[1:] += other * self._dim_weights(slab_dim, weight)
+            else:
+                weights[0] += other
+        return weights
+
+    def _iter_slab(self, slab: int, weight: str) -> Iterator[Tuple[str, int]]:
+        """Yield (zarr_key, weight) for every chunk of one slab, in partition order."""
+        slab_dim = self._slab_dim()
+        for var_name, variable_dims in self.variables.items():
+            if (slab_dim in variable_dims) != (slab > 0):
+                continue
+            chunk_numbers = [
+                [self._chunk_numbers(dim)[slab - 1]] if dim == slab_dim else self._chunk_numbers(dim)
+                for dim in variable_dims
+            ]
+            var_weights = self._chunk_weights(var_name, weight, slab - 1 if slab > 0 else None).tolist()
+            yield from zip(iter_chunk_keys(var_name, chunk_numbers), var_weights)
+
+    def _slab_of(self, var_name: str, chunk_numbers: Sequence[int]) -> int:
+        """The slab (see `_slab_weights`) holding the chunk of `var_name` at `chunk_numbers`."""
+        slab_dim = self._slab_dim()
+        variable_dims = self.variables[var_name]
+        if slab_dim not in variable_dims:
+            return 0
+        return chunk_numbers[variable_dims.index(slab_dim)] - self.chunk_offsets.get(slab_dim, 0) + 1
+
+    def _iter_slab_chunks(self, slab: int) -> Iterator[Tuple[str, Dict[str, List[Slice]]]]:
+        """Yield (zarr_key, slices) for every chunk of one slab, in partition order."""
+        slab_dim = self._slab_dim()
+        for var_name, variable_dims in self.variables.items():
+            if (slab_dim in variable_dims) != (slab > 0):
+                continue
+            chunk_numbers = [
+                [self._chunk_numbers(dim)[slab - 1]] if dim == slab_dim else self._chunk_numbers(dim)
+                for dim in variable_dims
+            ]
+            for zarr_key, numbers in zip(iter_chunk_keys(var_name, chunk_numbers), itertools.product(*chunk_numbers)):
+                yield zarr_key, self.chunk_slices(var_name, numbers)
+
+    def iter_slabs(self, keys: Optional[Iterable[str]] = None) -> Iterator[Iterator[Tuple[str, Dict[str, List[Slice]]]]]:
+        """
+        Yield, slab by slab in partition order (see `shard`), an iterator over the
+        (zarr_key, slices) of every chunk of the slab (or only of those in `keys`).
+
+        Chunks of a slab read neighbouring sources, so a consumer grouping chunks by
+        source can let go of a source once a slab no longer reads it.
+        """
+        slab_dim = self._slab_dim()
+        n_slabs = (self.n_chunks(slab_dim) if slab_dim is not None else 0) + 1
+        if keys is None:
+            for slab in range(n_slabs):
+                yield self._iter_slab_chunks(slab)
+            return
+
+        by_slab: List[List[str]] = [[] for _ in range(n_slabs)]
+        for zarr_key in keys:
+            var_name, _, index = zarr_key.rpartition("/")
+            chunk_numbers = [int(n) for n in index.split(".")] if self.variables[var_name] else []
+            by_slab[self._slab_of(var_name, chunk_numbers)].append(zarr_key)
+        for slab_keys in by_slab:
+            yield ((zarr_key, self[zarr_key]) for zarr_key in slab_keys)
+
+    def shard(self, worker_id: int, n_workers: int, weight: str = "bytes") -> List[str]:
+        """
+        Zarr keys of the output chunks assigned to worker `worker_id` of `n_workers`.
+
+        Chunks are ordered by their position along the concat dimension (chunks of
+        variables without it, which read the first source, come first), and cut into
+        `n_workers` runs of about equal total `weight` (a chunk goes to the run holding its
+        midpoint): the uncompressed `"bytes"` of each chunk (elements, if the plan has no
+        dtypes) or simply the number of `"chunks"`.
+        Each worker thus reads a contiguous range of sources, and every key belongs to
+        exactly one shard. The assignment is deterministic and only the chunks of the
+        slabs overlapping this worker's run are enumerated.
+        """
+        if not 0 <= worker_id < n_workers:
+            raise ValueError(f"Worker {worker_id} out of range for {n_workers} workers")
+        slab_weights = self._slab_weights(weight)
+        slab_offsets = np.concatenate([[0], np.cumsum(slab_weights)])
+        total = int(slab_offsets[-1])
+        # Work in doubled units, so that chunk midpoints are integers
+        if total == 0:
+            lo, hi = 0, int(worker_id == 0)
+        else:
+            lo = -(-worker_id * 2 * total // n_workers)
+            hi = -(-(worker_id + 1) * 2 * total // n_workers) if worker_id < n_workers - 1 else math.inf
+
+        keys = []
+        first = max(int(np.searchsorted(2 * slab_offsets, lo, side="right")) - 1, 0)
+        for slab in range(first, len(slab_weights)):
+            offset = 2 * int(slab_offsets[slab])
+            if offset >= hi:
+                break
+            for zarr_key, chunk_weight in self._iter_slab(slab, weight):
+                if lo <= offset + chunk_weight < hi:
+                    keys.append(zarr_key)
+                offset += 2 * chunk_weight
+        return keys
+
+    def partition(self, n_workers: int, weight: str = "bytes") -> List[List[str]]:
+        """The zarr keys of every shard (see `shard`), in one pass over the plan."""
+        if n_workers < 1:
+            raise ValueError("At least one worker is required")
+        slab_weights = self._slab_weights(weight)
+        total = int(slab_weights.sum())
+        shards: List[List[str]] = [[] for _ in range(n_workers)]
+        offset = 0
+        for slab in range(len(slab_weights)):
+            for zarr_key, chunk_weight in self._iter_slab(slab, weight):
+                midpoint = 2 * offset + chunk_weight
+                shards[min(midpoint * n_workers // (2 * total), n_workers - 1) if total else 0].append(zarr_key)
+                offset += chunk_weight
+        return shards
+
+    def save(self, path: Union[str, os.PathLike]) -> None:
+        """
+        Write the plan to the directory `path` in a columnar, memory-mappable layout.
+
+        Each dimension table is stored as a pair of int64 `.npy` arrays, next to a small
+        JSON header holding the chunk definition, variable dimensions and source paths.
+        Sources without a known path (e.g. in-memory datasets) are recorded as null.
+        """
+        os.makedirs(path, exist_ok=True)
+        dims = list(self.dim_tables)
+        for n, dim in enumerate(dims):
+            indptr, pieces = self.dim_tables[dim]
+            np.save(os.path.join(path, f"dim_{n}.indptr.npy"), np.asarray(indptr, dtype=np.int64))
+            np.save(os.path.join(path, f"dim_{n}.pieces.npy"), np.asarray(pieces, dtype=np.int64))
+
+        header = {
+            "version": PLAN_FORMAT_VERSION,
+            "chunk_definition": {dim: int(size) for dim, size in self.chunk_definition.items()},
+            "dim_sizes": {dim: int(size) for dim, size in self.dim_sizes.items()},
+            "variables": {name: list(dims) for name, dims in self.variables.items()},
+            "dims": dims,
+            "concat_dim": self.concat_dim,
+            "sources": [_source_name(source) for source in self.sources],
+            "dtypes": self.dtypes,
+            "chunk_offsets": self.chunk_offsets,
+        }
+        with open(os.path.join(path, PLAN_HEADER), "w") as f:
+            json.dump(header, f)
+
+    @classmethod
+    def open(cls, path: Union[str, os.PathLike], mmap: bool = True) -> "ChunkPlan":
+        """
+        Open a plan written by `save`.
+
+        With `mmap=True` the dimension tables are memory-mapped rather than read, so
+        looking up a single chunk only touches the handful of rows it needs.
+        """
+        with open(os.path.join(path, PLAN_HEADER)) as f:
+            header = json.load(f)
+        if header.get("version") != PLAN_FORMAT_VERSION:
+            raise ValueError(f"Unsupported chunk plan format version: {header.get('version')}")
+
+        mmap_mode = "r" if mmap else None
+        dim_tables = {
+            dim: (
+                np.load(os.path.join(path, f"dim_{n}.indptr.npy"), mmap_mode=mmap_mode),
+                np.load(os.path.join(path, f"dim_{n}.pieces.npy"), mmap_mode=mmap_mode),
+            )
+            for n, dim in enumerate(header["dims"])
+        }
+        return cls(
+            header["chunk_definition"],
+            header["dim_sizes"],
+            header["variables"],
+            dim_tables,
+            sources=header["sources"],
+            concat_dim=header["concat_dim"],
+            dtypes=header.get("dtypes"),
+            chunk_offsets=header.get("chunk_offsets"),
+        )
+
+    def __getitem__(self, key: str):
+        name, _, index = key.rpartition("/")
+        try:
+            if name in self.variables:
+                chunk_numbers = [int(i) for i in index.split(".")]
+                # The single chunk of a scalar is "0"
+                if not self.variables[name] and chunk_numbers == [0]:
+                    chunk_numbers = []
+                return self.chunk_slices(name, chunk_numbers)
+            if name in self.dim_tables:
+                return self.dim_slices(name, int(index))
+        except (ValueError, IndexError):
+            pass
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self._iter_dim_keys()
+        yield from self._iter_var_keys()
+
+    def __len__(self) -> int:
+        n_dim_keys = sum(self.n_chunks(dim) for dim in self.dim_tables)
+        n_var_keys = sum(int(np.prod(self.chunk_grid(var_name))) for var_name in self.variables)
+        return n_dim_keys + n_var_keys
+
+    def __repr__(self) -> str:
+        return f"<ChunkPlan: {len(self.variables)} variables, {len(self)} keys, chunks={self.chunk_definition}>"
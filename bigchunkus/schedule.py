@@ -0,0 +1,206 @@
+from .plan import ChunkPlan, Slice
+from .sources import open_source
+from .util import block_ranges, native_chunk_sizes
+
+import itertools
+import math
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+Block = Tuple[int, str, Tuple[int, ...]]
+# An output chunk waiting to be batched: (sort key, zarr key, slices, native blocks read, nbytes)
+_Item = Tuple[Tuple[int, Tuple[int, ...]], str, Dict[str, List[Slice]], List[Block], int]
+
+
+class SourceBatch(NamedTuple):
+    """
+    Output chunks scheduled together because they are read (mostly) from `source`, with
+    their total size, that of the distinct native chunks they read and the most bytes of
+    native chunks cached at once while they are written in order (each held from its
+    first read to its last).
+    """
+    source: int
+    items: List[Tuple[str, Dict[str, List[Slice]]]]
+    nbytes: int
+    read_bytes: int = 0
+    cache_bytes: int = 0
+
+
+class ScheduleStats(NamedTuple):
+    """Source opens and bytes read, per output chunk (naive) and per batch (scheduled)."""
+    naive_opens: int
+    scheduled_opens: int
+    naive_bytes_read: int
+    scheduled_bytes_read: int
+
+
+class Schedule(NamedTuple):
+    batches: List[SourceBatch]
+    stats: ScheduleStats
+    native_chunks: Dict[str, Dict[str, int]]
+
+
+def chunk_blocks(
+    plan: ChunkPlan,
+    var_name: str,
+    slices: Dict[str, List[Slice]],
+    native_chunks: Dict[str, int],
+) -> Iterator[Block]:
+    """Yield the (source, variable, native chunk index) of every source block an output chunk reads."""
+    variable_dims = plan.variables[var_name]
+    for source, region, _ in plan.chunk_pieces(var_name, slices):
+        ranges = [block_ranges(*region[dim], native_chunks[dim]) for dim in variable_dims]
+        for block in itertools.product(*ranges):
+            yield source, var_name, block
+
+
+class SourceScheduler:
+    """
+    Streams the output chunks of a plan in batches by source file and native chunk, so
+    that each source is opened, and each of its native chunks read, once per batch rather
+    than once per output chunk.
+
+    Chunks are grouped by the first source they read from and, within a source, ordered
+    by variable and by the native chunks they touch, so chunks sharing a source block are
+    adjacent. Batches are split once their output size, or that of the distinct native
+    chunks they read, would exceed `max_batch_bytes`.
+
+    The plan is walked slab by slab (`ChunkPlan.iter_slabs`) and the chunks of a source
+    are batched as soon as a slab no longer reads it, so only the chunks of the sources
+    being read are held. With `max_batch_bytes`, a source's full batches are let go of as
+    they fill up, too.
+
+    `native_chunks` gives the on-disk chunking of each variable; by default it is read
+    from the encoding of the first source holding it and assumed to hold for every source.
+    Opens and bytes read are counted (`stats`) as batches are produced.
+    """
+
+    def __init__(
+        self,
+        plan: ChunkPlan,
+        native_chunks: Optional[Dict[str, Dict[str, int]]] = None,
+        max_batch_bytes: Optional[int] = None,
+        engine: Optional[str] = None,
+    ):
+        templates = {
+            var_name: open_source(plan.sources[plan.variable_source(var_name)], engine=engine)[var_name]
+            for var_name in plan.variables
+        }
+        self.plan = plan
+        self.max_batch_bytes = max_batch_bytes
+        self.native_chunks = {
+            var_name: {**native_chunk_sizes(templates[var_name]), **(native_chunks or {}).get(var_name, {})}
+            for var_name in plan.variables
+        }
+        self._itemsizes = {var_name: templates[var_name].dtype.itemsize for var_name in plan.variables}
+        self._block_bytes = {
+            var_name: math.prod(self.native_chunks[var_name][dim] for dim in dims) * self._itemsizes[var_name]
+            for var_name, dims in plan.variables.items()
+        }
+        self._variable_order = {var_name: n for n, var_name in enumerate(plan.variables)}
+        self.naive_opens = self.scheduled_opens = self.naive_bytes_read = self.scheduled_bytes_read = 0
+
+    @property
+    def stats(self) -> ScheduleStats:
+        return ScheduleStats(self.naive_opens, self.scheduled_opens, self.naive_bytes_read, self.scheduled_bytes_read)
+
+    def _item(self, zarr_key: str, slices: Dict[str, List[Slice]]) -> Tuple[int, _Item]:
+        var_name = zarr_key.rpartition("/")[0]
+        blocks = list(chunk_blocks(self.plan, var_name, slices, self.native_chunks[var_name]))
+        sources = self.plan.chunk_sources(var_name, slices)
+        self.naive_opens += len(set(sources))
+        self.naive_bytes_read += len(blocks) * self._block_bytes[var_name]
+
+        nbytes = math.prod(
+            sum(end - start for _, start, end in slices[dim]) for dim in self.plan.variables[var_name]
+        ) * self._itemsizes[var_name]
+        # Chunks reading nothing (all missing tiles of a mosaic) are batched apart, as source -1
+        first_block = blocks[0][2] if blocks else ()
+        return sources[0] if sources else -1, ((self._variable_order[var_name], first_block), zarr_key, slices, blocks, nbytes)
+
+    def _cache_bytes(self, items: List[_Item]) -> int:
+        """Most bytes of native chunks held at once by a `BlockCache` reading `items` in order."""
+        reads = [block for item in items for block in item[3]]
+        last_read = {block: n for n, block in enumerate(reads)}
+        held = peak = 0
+        cached: Set[Block] = set()
+        for n, block in enumerate(reads):
+            if block not in cached:
+                cached.add(block)
+                held += self._block_bytes[block[1]]
+                peak = max(peak, held)
+            if last_read[block] == n:
+                cached.discard(block)
+                held -= self._block_bytes[block[1]]
+        return peak
+
+    def _batch(self, source: int, items: List[_Item], blocks: Set[Block], nbytes: int, read_bytes: int) -> SourceBatch:
+        self.scheduled_opens += len({block[0] for block in blocks})
+        self.scheduled_bytes_read += read_bytes
+        return SourceBatch(
+            source, [(zarr_key, slices) for _, zarr_key, slices, _, _ in items], nbytes, read_bytes, self._cache_bytes(items),
+        )
+
+    def _split(self, source: int, items: List[_Item], last: bool) -> Tuple[List[SourceBatch], List[_Item]]:
+        """Cut a source's chunks into batches; unless `last`, the chunks of the final (partial) batch are handed back."""
+        batches = []
+        batch_items: List[_Item] = []
+        batch_blocks: Set[Block] = set()
+        batch_bytes = read_bytes = 0
+        for item in sorted(items, key=lambda item: item[0]):
+            _, _, _, blocks, nbytes = item
+            new_blocks = set(blocks) - batch_blocks
+            new_bytes = sum(self._block_bytes[block[1]] for block in new_blocks)
+            if batch_items and self.max_batch_bytes is not None and max(batch_bytes + nbytes, read_bytes + new_bytes) > self.max_batch_bytes:
+                batches.append(self._batch(source, batch_items, batch_blocks, batch_bytes, read_bytes))
+                batch_items, batch_blocks, batch_bytes, read_bytes = [], set(), 0, 0
+                new_blocks = set(blocks)
+                new_bytes = sum(self._block_bytes[block[1]] for block in new_blocks)
+            batch_items.append(item)
+            batch_blocks |= new_blocks
+            batch_bytes += nbytes
+            read_bytes += new_bytes
+        if not last:
+            return batches, batch_items
+        if batch_items:
+            batches.append(self._batch(source, batch_items, batch_blocks, batch_bytes, read_bytes))
+        return batches, []
+
+    def batches(self, keys: Optional[Iterable[str]] = None, select: Optional[Callable[[str], bool]] = None) -> Iterator[SourceBatch]:
+        """Yield the batches of every output chunk (or only of `keys`, and of those `select` keeps)."""
+        pending: Dict[int, List[_Item]] = {}
+        pending_bytes: Dict[int, int] = {}
+        for records in self.plan.iter_slabs(keys):
+            read: Set[int] = set()
+            for zarr_key, slices in records:
+                if select is not None and not select(zarr_key):
+                    continue
+                source, item = self._item(zarr_key, slices)
+                read.add(source)
+                pending.setdefault(source, []).append(item)
+                pending_bytes[source] = pending_bytes.get(source, 0) + item[4]
+                if self.max_batch_bytes is not None and pending_bytes[source] > 2 * self.max_batch_bytes:
+                    batches, pending[source] = self._split(source, pending[source], last=False)
+                    pending_bytes[source] = sum(item[4] for item in pending[source])
+                    yield from batches
+            # Slabs with nothing to write (e.g. all already written) say nothing about the sources
+            for source in sorted(set(pending) - read) if read else []:
+                yield from self._split(source, pending.pop(source), last=True)[0]
+                del pending_bytes[source]
+        for source in sorted(pending):
+            yield from self._split(source, pending.pop(source), last=True)[0]
+
+
+def schedule_by_source(
+    plan: ChunkPlan,
+    keys: Optional[Iterable[str]] = None,
+    native_chunks: Optional[Dict[str, Dict[str, int]]] = None,
+    max_batch_bytes: Optional[int] = None,
+    engine: Optional[str] = None,
+) -> Schedule:
+    """
+    All the batches of a `SourceScheduler` over the plan (or only over `keys`), with the
+    opens and bytes read they save.
+    """
+    scheduler = SourceScheduler(plan, native_chunks=native_chunks, max_batch_bytes=max_batch_bytes, engine=engine)
+    batches = list(scheduler.batches(keys))
+    return Schedule(batches, scheduler.stats, scheduler.native_chunks)
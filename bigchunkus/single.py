@@ -1,20 +1,183 @@
-from . import util
+from . import instrument
+from .base import BaseChunkPlanner
+from .execute import execute
+from .plan import ChunkPlan
+from .sources import SourceMetadata, open_source
+from .util import chunk_boundaries, whole_source_slices
 
-from typing import Dict, Tuple, List
-import itertools
+import math
+import os
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple, Optional, Sequence, Union
+
+import numpy as np
 import xarray as xr
 
-class SingleSourceChunkPlanner:
-    def __init__(self, datasets: xr.Dataset):
-        self.input_dataset = datasets
-
-    def map_chunks(self, chunk_definition: Dict[str, int]) -> dict:
-        chunk_definition = util.merge_chunk_definitions(chunk_definition, self.input_dataset.chunks)
-        # Logic to generate chunk mapping for a single dataset
-        zarr_keys = self.generate_zarr_keys(chunk_definition)
-        chunk_map = {
-            "chunks": chunk_definition,
-            "mapping": "single_source_mapping",
-            "zarr_keys": zarr_keys
+if TYPE_CHECKING:
+    from .cache import PlanCache
+
+
+class RechunkStage(NamedTuple):
+    """One copy of a (possibly multi-stage) rechunk: `plan` is executed into `store`, reading its source with `engine`."""
+    plan: ChunkPlan
+    store: Union[str, os.PathLike]
+    engine: Optional[str]
+    coords: Dict[str, xr.Variable]
+    max_mem: int
+
+    def execute(self, **kwargs: Any) -> Dict[str, int]:
+        """
+        Run the stage with `execute`, batched by source so each native chunk is read once.
+
+        Batches and the native chunks cached for them are each held to half of `max_mem`
+        (or, for output chunks larger than that, to what a single chunk leaves of it), and
+        batches only run concurrently while all of them together stay within `max_mem`.
+        Keyword arguments are passed on to `execute`.
+        """
+        chunk_bytes = max(
+            math.prod(min(self.plan.chunk_definition[dim], self.plan.dim_sizes[dim]) for dim in dims) * np.dtype(self.plan.dtypes[name]).itemsize
+            for name, dims in self.plan.variables.items()
+        )
+        options = {
+            "engine": self.engine,
+            "coords": self.coords,
+            "by_source": True,
+            "max_batch_bytes": min(self.max_mem // 2, self.max_mem - chunk_bytes),
+            "max_in_flight_bytes": self.max_mem,
         }
-        return chunk_map
\ No newline at end of file
+        options.update(kwargs)
+        return execute(self.plan, self.store, **options)
+
+
+def _read_extent(size: int, chunk_size: int, native: int) -> int:
+    """Largest length of native chunks read along a dimension by one chunk of `chunk_size`."""
+    starts, ends = chunk_boundaries(size, chunk_size)
+    blocks = -(-ends // native) - starts // native
+    return int(blocks.max()) * native
+
+
+def _consolidate(shape: Sequence[int], chunks: Sequence[int], limits: Sequence[int], itemsize: int, max_mem: int) -> List[int]:
+    """
+    Grow `chunks` by whole multiples, dimension by dimension, while they fit in `max_mem`.
+
+    No dimension grows past the multiple covering its `limit` (or the whole dimension).
+    """
+    headroom = max(max_mem // (itemsize * math.prod(chunks)), 1)
+    grown = []
+    for size, chunk_size, limit in zip(shape, chunks, limits):
+        multiple = max(min(headroom, -(-min(limit, size) // chunk_size)), 1)
+        grown.append(min(chunk_size * multiple, size))
+        headroom //= multiple
+    return grown
+
+
+class SingleSourceChunkPlanner(BaseChunkPlanner):
+    """
+    Plans the rechunking of a single dataset.
+
+    Copying straight from source to target chunks is fine when each target chunk reads
+    few source chunks. When the two are very different (say chunks contiguous in time
+    read into chunks contiguous in space), every target chunk reads a slice of a large
+    share of the source chunks. `rechunk` then plans two copies through an intermediate
+    store, as rechunker does, so that no copy holds more than `max_mem` at once.
+    """
+
+    def __init__(self, dataset: Union[xr.Dataset, str]):
+        super().__init__(dataset)
+        self.input_dataset = dataset
+        self.metadata = SourceMetadata.from_dataset(open_source(dataset))
+
+    @property
+    def coords(self) -> Dict[str, xr.Variable]:
+        """Dimension coordinates of the dataset"""
+        coords = open_source(self.input_dataset).coords
+        return {name: coord.variable for name, coord in coords.items() if coord.dims == (name,)}
+
+    def _resolve_chunk_definition(self, chunk_definition: Dict[str, int]) -> Dict[str, int]:
+        """Merge the user-defined chunk definition with the dataset's chunk sizes"""
+        return {**self.metadata.sizes, **self.metadata.chunks, **chunk_definition}
+
+    def _plan(self, chunk_definition: Dict[str, int], source: Any) -> ChunkPlan:
+        variables = self.metadata.variables
+        tables = {}
+        with instrument.phase("slices"):
+            for dim in dict.fromkeys(dim for dims in variables.values() for dim in dims):
+                tables[dim] = whole_source_slices(*chunk_boundaries(self.metadata.sizes[dim], chunk_definition[dim]))
+        chunk_plan = ChunkPlan(
+            chunk_definition,
+            self.metadata.sizes,
+            variables,
+            tables,
+            sources=[source],
+            dtypes=self.metadata.dtypes,
+        )
+        instrument.count_plan(chunk_plan)
+        return chunk_plan
+
+    def plan(self, chunk_definition: Dict[str, int]) -> ChunkPlan:
+        """Build the ChunkPlan copying the dataset into `chunk_definition`"""
+        return self._plan(self._resolve_chunk_definition(chunk_definition), self.input_dataset)
+
+    def map_chunks(self, chunk_definition: Dict[str, int], cache: Optional["PlanCache"] = None) -> ChunkPlan:
+        """Map output chunks to the slices of the dataset they hold (through `cache`, if given)."""
+        return self.plan(chunk_definition) if cache is None else cache.plan(self, chunk_definition)
+
+    def stage_chunks(self, chunk_definition: Dict[str, int], max_mem: int) -> List[Dict[str, int]]:
+        """
+        Chunk definition of each copy rechunking the dataset into `chunk_definition`.
+
+        A single copy is enough when every target chunk, and the source chunks it reads,
+        fit in `max_mem`. Otherwise source chunks are grown towards the target chunks
+        while half of `max_mem` holds them; the intermediate chunks are the smaller of
+        these and the target chunks along each dimension, so the first copy writes them
+        from contiguous reads of the source and the second reads whole intermediate
+        chunks into every target chunk.
+        """
+        target = self._resolve_chunk_definition(chunk_definition)
+        sizes = self.metadata.sizes
+        intermediate: Dict[str, int] = {}
+        for name, dims in self.metadata.variables.items():
+            itemsize = np.dtype(self.metadata.dtypes[name]).itemsize
+            shape = [sizes[dim] for dim in dims]
+            native = [min(self.metadata.native_chunks.get(name, {}).get(dim, size), size) for dim, size in zip(dims, shape)]
+            write = [min(target[dim], size) for dim, size in zip(dims, shape)]
+            for label, chunks in (("Source", native), ("Target", write)):
+                nbytes = itemsize * math.prod(chunks)
+                if nbytes > max_mem:
+                    raise ValueError(f"{label} chunks of '{name}' take {nbytes} bytes, more than max_mem={max_mem}")
+
+            extents = [_read_extent(size, chunk_size, n) for size, chunk_size, n in zip(shape, write, native)]
+            if itemsize * (math.prod(write) + math.prod(extents)) <= max_mem:
+                continue
+            read = _consolidate(shape, native, write, itemsize, max_mem // 2)
+            for dim, read_size, write_size in zip(dims, read, write):
+                intermediate[dim] = min(intermediate.get(dim, write_size), read_size, write_size)
+
+        if all(size == min(target[dim], sizes[dim]) for dim, size in intermediate.items()):
+            return [target]
+        return [{**target, **intermediate}, target]
+
+    def rechunk(
+        self,
+        chunk_definition: Dict[str, int],
+        max_mem: int,
+        target_store: Union[str, os.PathLike],
+        temp_store: Optional[Union[str, os.PathLike]] = None,
+    ) -> List[RechunkStage]:
+        """
+        Plan the rechunking of the dataset into `chunk_definition` in `target_store`.
+
+        Returns the copies to run, in order, each with `RechunkStage.execute`. When an
+        intermediate copy is needed (see `stage_chunks`) it is written to `temp_store`, a
+        path the second copy reads back as a zarr source.
+        """
+        stages = self.stage_chunks(chunk_definition, max_mem)
+        coords = self.coords
+        if len(stages) == 1:
+            return [RechunkStage(self._plan(stages[0], self.input_dataset), target_store, None, coords, max_mem)]
+        if temp_store is None:
+            raise ValueError("The chunk shapes are too different to copy within max_mem; an intermediate temp_store is needed")
+        temp_store = os.fspath(temp_store)
+        return [
+            RechunkStage(self._plan(stages[0], self.input_dataset), temp_store, None, coords, max_mem),
+            RechunkStage(self._plan(stages[1], temp_store), target_store, "zarr", coords, max_mem),
+        ]
@@ -0,0 +1,198 @@
+from .util import native_chunk_sizes
+
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import xarray as xr
+
+_local = threading.local()
+
+INDEX_FORMAT_VERSION = 1
+# Coordinate dtypes whose bounds survive a round trip through their string form
+_SERIALIZABLE_KINDS = "biufmMSU"
+
+
+def open_source(source: Any, engine: Optional[str] = None, max_open_files: int = 128) -> xr.Dataset:
+    """
+    Open a plan source, reusing this worker's handle if it is already open.
+
+    Handles are cached per thread (and so per worker process) in a small LRU; the least
+    recently used file is closed once more than `max_open_files` are open.
+    """
+    if isinstance(source, xr.Dataset):
+        return source
+    if source is None:
+        raise ValueError("Plan source has no path; plans built from in-memory datasets can only run in-process")
+
+    cache = getattr(_local, "sources", None)
+    if cache is None:
+        cache = _local.sources = OrderedDict()
+    if source in cache:
+        cache.move_to_end(source)
+        return cache[source]
+
+    dataset = xr.open_dataset(source, engine=engine)
+    cache[source] = dataset
+    while len(cache) > max_open_files:
+        _, evicted = cache.popitem(last=False)
+        evicted.close()
+    return dataset
+
+
+class SourceMetadata:
+    """
+    What the planners need to know about a dataset, without any of its data.
+
+    `sizes` maps dimensions to lengths, `variables` data variables to their dimensions
+    and `dtypes` to their numpy dtype strings. `chunks` is the dataset's (dask) chunk
+    size per dimension, if any, and `native_chunks` the on-disk chunking of each variable.
+    `bounds` holds the first and last value of each indexed dimension coordinate.
+    """
+
+    def __init__(
+        self,
+        sizes: Dict[str, int],
+        variables: Dict[str, Tuple[str, ...]],
+        dtypes: Dict[str, str],
+        chunks: Optional[Dict[str, int]] = None,
+        native_chunks: Optional[Dict[str, Dict[str, int]]] = None,
+        bounds: Optional[Dict[str, np.ndarray]] = None,
+    ):
+        self.sizes = dict(sizes)
+        self.variables = {name: tuple(dims) for name, dims in variables.items()}
+        self.dtypes = dict(dtypes)
+        self.chunks = dict(chunks or {})
+        self.native_chunks = dict(native_chunks or {})
+        self.bounds = dict(bounds or {})
+
+    @classmethod
+    def from_dataset(cls, dataset: xr.Dataset) -> "SourceMetadata":
+        return cls(
+            dict(dataset.sizes),
+            {name: tuple(var.dims) for name, var in dataset.data_vars.items()},
+            {name: var.dtype.str for name, var in dataset.data_vars.items()},
+            # Dask chunks may be irregular; the first chunk along each dimension stands for all
+            {dim: sizes[0] for dim, sizes in dataset.chunks.items()},
+            {name: native_chunk_sizes(var) for name, var in dataset.data_vars.items()},
+            {dim: np.asarray(index[[0, -1]]) for dim, index in dataset.indexes.items() if len(index)},
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        """JSON-serializable form; bounds of object (e.g. cftime) coordinates are dropped."""
+        return {
+            "sizes": self.sizes,
+            "variables": {name: list(dims) for name, dims in self.variables.items()},
+            "dtypes": self.dtypes,
+            "chunks": self.chunks,
+            "native_chunks": self.native_chunks,
+            "bounds": {
+                dim: {"dtype": bounds.dtype.str, "values": bounds.astype(str).tolist()}
+                for dim, bounds in self.bounds.items() if bounds.dtype.kind in _SERIALIZABLE_KINDS
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, record: Dict[str, Any]) -> "SourceMetadata":
+        return cls(
+            record["sizes"],
+            record["variables"],
+            record["dtypes"],
+            record["chunks"],
+            record["native_chunks"],
+            {dim: np.array(bounds["values"], dtype=bounds["dtype"]) for dim, bounds in record["bounds"].items()},
+        )
+
+    @classmethod
+    def concat(cls, metadatas: Sequence["SourceMetadata"], dim: str) -> "SourceMetadata":
+        """
+        Metadata of the concatenation of sources along `dim`, without concatenating them.
+
+        Mirrors `xr.concat(..., data_vars='minimal', compat='override')`: lengths along
+        `dim` are summed, everything else is taken from the first source, and variables
+        holding `dim` must be present in every source. Sources must agree on the sizes of
+        the dimensions they share, other than `dim`.
+        """
+        first = metadatas[0]
+        for n, metadata in enumerate(metadatas):
+            if dim not in metadata.sizes:
+                raise ValueError(f"Dimension '{dim}' not found in source {n}")
+            for other, size in metadata.sizes.items():
+                if other != dim and first.sizes.get(other, size) != size:
+                    raise ValueError(f"Source {n} has size {size} along '{other}', expected {first.sizes[other]} as in source 0")
+            missing = [name for name, dims in first.variables.items() if dim in dims and name not in metadata.variables]
+            if missing:
+                raise ValueError(f"Variables {missing} are not present in source {n}")
+
+        sizes = dict(first.sizes)
+        sizes[dim] = sum(metadata.sizes[dim] for metadata in metadatas)
+        chunks = {name: size for name, size in first.chunks.items() if name != dim}
+        bounds = {name: values for name, values in first.bounds.items() if name != dim}
+        if all(dim in metadata.bounds for metadata in metadatas):
+            bounds[dim] = np.array([metadatas[0].bounds[dim][0], metadatas[-1].bounds[dim][-1]])
+        return cls(sizes, first.variables, first.dtypes, chunks, first.native_chunks, bounds)
+
+
+def _read_header(path: str, engine: Optional[str] = None) -> SourceMetadata:
+    with xr.open_dataset(path, engine=engine) as dataset:
+        return SourceMetadata.from_dataset(dataset)
+
+
+def _load_index(index: str) -> Dict[str, Dict[str, Any]]:
+    if not os.path.exists(index):
+        return {}
+    with open(index) as f:
+        stored = json.load(f)
+    if stored.get("version") != INDEX_FORMAT_VERSION:
+        return {}
+    return stored["sources"]
+
+
+def _save_index(index: str, records: Dict[str, Dict[str, Any]]) -> None:
+    # Write then rename, so a crash never leaves a truncated index behind
+    temporary = f"{index}.{os.getpid()}.tmp"
+    with open(temporary, "w") as f:
+        json.dump({"version": INDEX_FORMAT_VERSION, "sources": records}, f)
+    os.replace(temporary, index)
+
+
+def read_metadata(
+    paths: Sequence[str],
+    engine: Optional[str] = None,
+    max_workers: Optional[int] = None,
+    index: Optional[str] = None,
+) -> List[SourceMetadata]:
+    """
+    Read the SourceMetadata of every file in `paths`, opening headers concurrently.
+
+    Files are opened on a pool of `max_workers` threads. With `index`, the metadata is
+    also kept in that JSON sidecar file keyed by absolute path, and a file whose
+    modification time and size still match its record is not opened at all.
+    """
+    records = _load_index(index) if index is not None else {}
+    keys = [os.path.abspath(path) for path in paths]
+    signatures = [(stat.st_mtime_ns, stat.st_size) for stat in map(os.stat, keys)]
+
+    metadatas: List[Optional[SourceMetadata]] = [None] * len(keys)
+    stale = []
+    for n, (key, (mtime_ns, size)) in enumerate(zip(keys, signatures)):
+        record = records.get(key)
+        if record is not None and record["mtime_ns"] == mtime_ns and record["size"] == size:
+            metadatas[n] = SourceMetadata.from_dict(record["metadata"])
+        else:
+            stale.append(n)
+
+    if stale:
+        with ThreadPoolExecutor(max_workers) as pool:
+            for n, metadata in zip(stale, pool.map(partial(_read_header, engine=engine), [keys[n] for n in stale])):
+                metadatas[n] = metadata
+                mtime_ns, size = signatures[n]
+                records[keys[n]] = {"mtime_ns": mtime_ns, "size": size, "metadata": metadata.to_dict()}
+        if index is not None:
+            _save_index(index, records)
+    return metadatas
@@ -0,0 +1,176 @@
+from .merge import ConcatChunkPlanner
+from .util import chunk_boundaries, overlap_slices
+
+import itertools
+import math
+from typing import Dict, List, Mapping, NamedTuple, Optional, Sequence, Union
+
+import numpy as np
+
+ACCESS_PATTERNS = ("timeseries", "spatial")
+
+
+class ChunkEstimate(NamedTuple):
+    """Estimated cost of writing (and, given an access pattern, reading) one chunk definition."""
+    chunk_definition: Dict[str, int]
+    chunk_bytes: int
+    n_objects: int
+    read_bytes: int
+    read_amplification: float
+    files_per_chunk: float
+    working_bytes: int
+    query_bytes: Optional[int]
+
+
+class _DimCost(NamedTuple):
+    n_chunks: int
+    read_extent: int
+    pieces: int
+    max_read_extent: int
+
+
+def _candidate_sizes(size: int, native: int) -> List[int]:
+    """Chunk sizes worth trying along a dimension: powers-of-two multiples and fractions of
+    the native chunk size, and the whole dimension."""
+    candidates = {size}
+    candidates.update(native * 2**k for k in range(0, 32) if native * 2**k < size)
+    candidates.update(native // 2**k for k in range(1, 32) if native // 2**k >= 1)
+    return sorted(candidates)
+
+
+def _dim_cost(planner: ConcatChunkPlanner, dim: str, chunk_size: int, native: int) -> _DimCost:
+    """
+    Cost terms along one dimension for one chunk size.
+
+    `read_extent` is the total length of native chunks read along `dim` when every output
+    chunk reads the native chunks it overlaps, and `max_read_extent` the most any one
+    chunk reads; since the chunk grid is an outer product, a variable's bytes read (in
+    total, or by its worst chunk) are the product of these over its dimensions.
+    """
+    chunk_starts, chunk_ends = chunk_boundaries(planner.metadata.sizes[dim], chunk_size)
+    if dim == planner.concat_dim_name:
+        source_ends = [end for _, end in planner.concat_dim_ranges]
+        indptr, pieces = overlap_slices(planner.offsets, source_ends, chunk_starts, chunk_ends)
+        starts, ends = pieces[:, 1], pieces[:, 2]
+    else:
+        indptr = np.arange(len(chunk_starts) + 1)
+        starts, ends = chunk_starts, chunk_ends
+    blocks = -(-ends // native) - starts // native
+    # Native chunks read by each output chunk, over all of its pieces
+    chunk_blocks = np.bincount(np.repeat(np.arange(len(chunk_starts)), np.diff(indptr)), weights=blocks, minlength=len(chunk_starts))
+    return _DimCost(len(chunk_starts), int(blocks.sum()) * native, len(starts), int(chunk_blocks.max(initial=0)) * native)
+
+
+def _query_chunks(n_chunks: int, chunk_size: int, extent: int) -> float:
+    """Expected number of chunks overlapped by a randomly placed window of length `extent`."""
+    return min(n_chunks, (extent - 1) / chunk_size + 1)
+
+
+def _query_extents(planner: ConcatChunkPlanner, access_pattern: Union[str, Mapping[str, int], None]) -> Optional[Dict[str, int]]:
+    if access_pattern is None:
+        return None
+    sizes = planner.metadata.sizes
+    if access_pattern == "timeseries":
+        return {dim: size if dim == planner.concat_dim_name else 1 for dim, size in sizes.items()}
+    if access_pattern == "spatial":
+        return {dim: 1 if dim == planner.concat_dim_name else size for dim, size in sizes.items()}
+    if isinstance(access_pattern, str):
+        raise ValueError(f"Unknown access pattern '{access_pattern}', expected one of {ACCESS_PATTERNS} or a mapping of dimension to query extent")
+    return {dim: min(access_pattern.get(dim, 1), size) for dim, size in sizes.items()}
+
+
+def suggest_chunks(
+    planner: ConcatChunkPlanner,
+    target_bytes: int = 64 * 2**20,
+    access_pattern: Union[str, Mapping[str, int], None] = None,
+    max_mem: Optional[int] = None,
+    native_chunks: Optional[Dict[str, int]] = None,
+    candidates: Optional[Mapping[str, Sequence[int]]] = None,
+    top: int = 10,
+) -> List[ChunkEstimate]:
+    """
+    Rank chunk definitions for `planner` by estimated I/O.
+
+    For each candidate chunk shape the cost model estimates, from the plan's dimension
+    tables and the sources' native chunking (that of the first source unless
+    `native_chunks` is given):
+
+    - `read_bytes` / `read_amplification`: bytes of native chunks read to produce every
+      output chunk once, in total and relative to the size of the data;
+    - `files_per_chunk`: source files touched per output chunk along the concat dimension;
+    - `n_objects`: number of output objects written;
+    - `working_bytes`: memory to hold the largest output chunk and the native chunks read
+      by the output chunk reading the most (e.g. one straddling source boundaries);
+    - `query_bytes`: with an `access_pattern` (`"timeseries"`, `"spatial"` or a mapping of
+      dimension to query extent), the bytes of output chunks read by one such query.
+
+    Candidates are chunk shapes built from multiples and fractions of the native chunk
+    size (or the sizes in `candidates`) whose largest chunk is between a quarter of and
+    `target_bytes`, and whose working memory fits in `max_mem` (default: four times
+    `target_bytes`). They are ranked by query bytes, then bytes read, then object count,
+    and the best `top` are returned. Sources holding no data are rejected.
+    """
+    max_mem = 4 * target_bytes if max_mem is None else max_mem
+    sizes = planner.metadata.sizes
+    variables = planner.metadata.variables
+    dims = list(dict.fromkeys(dim for var_dims in variables.values() for dim in var_dims))
+
+    itemsizes = {name: np.dtype(planner.metadata.dtypes[name]).itemsize for name in variables}
+    total_bytes = sum(itemsizes[name] * math.prod(sizes[dim] for dim in var_dims) for name, var_dims in variables.items())
+    if total_bytes == 0:
+        raise ValueError("Sources hold no data to chunk")
+    native = {}
+    for name in variables:
+        for dim, size in planner.metadata.native_chunks[name].items():
+            native.setdefault(dim, size)
+    native.update(native_chunks or {})
+
+    dim_candidates = {
+        dim: sorted(set(candidates[dim])) if candidates and dim in candidates else _candidate_sizes(sizes[dim], native[dim])
+        for dim in dims
+    }
+    dim_costs = {
+        dim: {size: _dim_cost(planner, dim, size, native[dim]) for size in dim_candidates[dim]}
+        for dim in dims
+    }
+    query_extents = _query_extents(planner, access_pattern)
+
+    estimates = []
+    for shape in itertools.product(*(dim_candidates[dim] for dim in dims)):
+        chunk_definition = dict(zip(dims, shape))
+        chunk_bytes = n_objects = read_bytes = working_bytes = 0
+        query_bytes = 0.0
+        for name, var_dims in variables.items():
+            costs = [dim_costs[dim][chunk_definition[dim]] for dim in var_dims]
+            var_chunk_bytes = itemsizes[name] * math.prod(min(chunk_definition[dim], sizes[dim]) for dim in var_dims)
+            var_objects = math.prod(cost.n_chunks for cost in costs)
+            var_read_bytes = itemsizes[name] * math.prod(cost.read_extent for cost in costs)
+
+            chunk_bytes = max(chunk_bytes, var_chunk_bytes)
+            n_objects += var_objects
+            read_bytes += var_read_bytes
+            working_bytes = max(working_bytes, var_chunk_bytes + itemsizes[name] * math.prod(cost.max_read_extent for cost in costs))
+            if query_extents is not None:
+                query_bytes += var_chunk_bytes * math.prod(
+                    _query_chunks(cost.n_chunks, chunk_definition[dim], query_extents[dim])
+                    for dim, cost in zip(var_dims, costs)
+                )
+
+        if not target_bytes / 4 <= chunk_bytes <= target_bytes or working_bytes > max_mem:
+            continue
+
+        concat_cost = dim_costs.get(planner.concat_dim_name, {}).get(chunk_definition.get(planner.concat_dim_name))
+        files_per_chunk = concat_cost.pieces / concat_cost.n_chunks if concat_cost else 1.0
+        estimates.append(ChunkEstimate(
+            chunk_definition,
+            chunk_bytes,
+            n_objects,
+            read_bytes,
+            read_bytes / total_bytes,
+            files_per_chunk,
+            working_bytes,
+            int(query_bytes) if query_extents is not None else None,
+        ))
+
+    estimates.sort(key=lambda estimate: (estimate.query_bytes or 0, estimate.read_bytes, estimate.n_objects))
+    return estimates[:top]
@@ -1,25 +1,48 @@
-from .merge import ConcatChunkPlanner
+from . import instrument
+from .merge import ConcatChunkPlanner, MergeChunkPlanner, MosaicChunkPlanner
 from .base import BaseChunkPlanner
+from .sources import SourceMetadata, open_source
 
-from typing import Dict
+import math
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+import numpy as np
+import pandas as pd
 import xarray as xr
 
 class UnmergedChunkPlanner(BaseChunkPlanner):
+    def __init__(self, *datasets: Union[xr.Dataset, str], metadata: Optional[Sequence[SourceMetadata]] = None):
+        super().__init__(*datasets)
+        # Datasets may be given as paths, in which case their metadata must be too
+        self.source_metadata = list(metadata) if metadata is not None else None
+
+    def _metadata(self):
+        if self.source_metadata is None:
+            self.source_metadata = [SourceMetadata.from_dataset(ds) for ds in self.source_datasets]
+        return self.source_metadata
 
     def _order_datasets_by_dim(self, dim: str):
         """
         Reorder datasets by the first value in the 'time' coordinate for each dataset.
         """
-        # Sort the datasets based on the starting time value in the 'time' coordinate.
-        self.source_datasets = sorted(
-            self.source_datasets, 
-            key=lambda ds: ds.indexes[dim][0]
-        )
+        # Sort the datasets based on the starting time value in the 'time' coordinate,
+        # as recorded in their metadata.
+        metadata = self._metadata()
+        order = sorted(range(len(metadata)), key=lambda n: metadata[n].bounds[dim][0])
+        self.source_datasets = [self.source_datasets[n] for n in order]
+        self.source_metadata = [metadata[n] for n in order]
+
+    def concat(self, dim: str, manually_ordered: bool = False, full_concat: bool = False, **concat_args) -> ConcatChunkPlanner:
+        """
+        Plan the concatenation of the datasets along `dim`.
 
-    def concat(self, dim: str, manually_ordered: bool = False, **concat_args) -> ConcatChunkPlanner:
+        Only the datasets' metadata is combined (sizes summed along `dim`, variables,
+        dtypes and chunking taken from the first dataset), which is linear and cheap in the
+        number of datasets. Set `full_concat` to also build the concatenated dataset with
+        `xr.concat` (`concat_args` are passed on to it), available as `merged_dataset`.
+        """
         if not manually_ordered:
-            for ds in self.source_datasets:
-                if dim not in ds.indexes:
+            for source_metadata in self._metadata():
+                if dim not in source_metadata.bounds:
                     raise ValueError(
                         f"Expected dimension '{dim}' not in dataset indexes.\n"
                         "If indexes aren't loaded and the order of concatenation is known "
@@ -27,24 +50,29 @@ class UnmergedChunkPlanner(BaseChunkPlanner):
                         "ensure that datasets are supplied to the UnmergedChunkPlanner in the "
                         "anticipated order."
                     )
-            self._order_datasets_by_dim(dim)
+            with instrument.phase("order"):
+                self._order_datasets_by_dim(dim)
 
-        merged_dataset = xr.concat(
-            self.source_datasets,
-            dim=dim,
-            coords='minimal',
-            compat='override',
-            data_vars='minimal',
-            **concat_args
-        )
+        with instrument.phase("concat"):
+            metadata = SourceMetadata.concat(self._metadata(), dim)
+            merged_dataset = None
+            if full_concat:
+                merged_dataset = xr.concat(
+                    [open_source(ds) for ds in self.source_datasets],
+                    dim=dim,
+                    coords='minimal',
+                    compat='override',
+                    data_vars='minimal',
+                    **concat_args
+                )
 
         # Calculate ranges and offsets for the concatenated dimension
         concat_dim_ranges = []
         offsets = []
         current_offset = 0
 
-        for dataset in self.source_datasets:
-            dim_size = dataset.sizes[dim]
+        for source_metadata in self._metadata():
+            dim_size = source_metadata.sizes[dim]
             start = current_offset
             end = start + dim_size
             concat_dim_ranges.append((start, end))
@@ -52,8 +80,70 @@ class UnmergedChunkPlanner(BaseChunkPlanner):
             current_offset = end
 
         # Pass the concatenated dimension name to ConcatChunkPlanner
-        return ConcatChunkPlanner(self.source_datasets, merged_dataset, concat_dim_ranges, offsets, concat_dim_name=dim)
+        return ConcatChunkPlanner(self.source_datasets, merged_dataset, concat_dim_ranges, offsets, concat_dim_name=dim, metadata=metadata, source_metadata=self._metadata())
     
 
+    def merge(self, concat_dim: Optional[str] = None, manually_ordered: bool = False) -> MergeChunkPlanner:
+        """
+        Plan the merge of datasets holding different variables, e.g. one variable per file.
+
+        With `concat_dim`, datasets holding the same data variables are first concatenated
+        along it (see `concat`), so that each variable is read from its own series of
+        files. Nothing is opened beyond the datasets' metadata.
+        """
+        groups: Dict[Tuple[str, ...], List[int]] = {}
+        for n, source_metadata in enumerate(self._metadata()):
+            groups.setdefault(tuple(sorted(source_metadata.variables)), []).append(n)
+
+        parts = []
+        for members in groups.values():
+            datasets = [self.source_datasets[n] for n in members]
+            metadata = [self.source_metadata[n] for n in members]
+            if concat_dim is not None:
+                parts.append(UnmergedChunkPlanner(*datasets, metadata=metadata).concat(concat_dim, manually_ordered=manually_ordered))
+                continue
+            for dataset, source_metadata in zip(datasets, metadata):
+                # A single source, "concatenated" along any of its dimensions
+                dim = next(iter(source_metadata.sizes))
+                size = source_metadata.sizes[dim]
+                parts.append(ConcatChunkPlanner([dataset], None, [(0, size)], [0], concat_dim_name=dim, metadata=source_metadata, source_metadata=[source_metadata]))
+        return MergeChunkPlanner(*parts)
+
+    def combine_nested(self, concat_dims: Sequence[str], shape: Optional[Tuple[int, ...]] = None) -> MosaicChunkPlanner:
+        """
+        Plan the mosaic of the datasets tiled along `concat_dims`.
+
+        Like `xr.combine_nested`, but the datasets are given flat, in row-major order over
+        a grid of `shape` tiles (by default, a single row along the one concat dim).
+        """
+        shape = tuple(shape) if shape is not None else (len(self.source_datasets),)
+        if len(shape) != len(concat_dims) or math.prod(shape) != len(self.source_datasets):
+            raise ValueError(f"Cannot lay out {len(self.source_datasets)} datasets on a grid of shape {shape} over {tuple(concat_dims)}")
+        grid = np.arange(len(self.source_datasets)).reshape(shape)
+        return MosaicChunkPlanner(self.source_datasets, grid, concat_dims, self._metadata())
+
+    def combine_by_coords(self, dims: Sequence[str]) -> MosaicChunkPlanner:
+        """
+        Plan the mosaic of the datasets tiled along `dims`, placed by their coordinates.
+
+        Each dataset's position along a dimension is the rank of its first coordinate
+        value among those of all datasets; positions holding no dataset are left to the
+        fill value.
+        """
+        metadata = self._metadata()
+        positions = []
+        for dim in dims:
+            missing = [n for n, source_metadata in enumerate(metadata) if dim not in source_metadata.bounds]
+            if missing:
+                raise ValueError(f"Datasets {missing} have no '{dim}' coordinate to place them by")
+            firsts = pd.Index(np.array([source_metadata.bounds[dim][0] for source_metadata in metadata]))
+            positions.append(firsts.unique().sort_values().get_indexer(firsts))
+
+        if len(set(zip(*(position.tolist() for position in positions)))) != len(metadata):
+            raise ValueError("Several datasets start at the same coordinates")
+        grid = np.full(tuple(int(position.max()) + 1 for position in positions), -1, dtype=np.int64)
+        grid[tuple(positions)] = np.arange(len(metadata))
+        return MosaicChunkPlanner(self.source_datasets, grid, dims, metadata)
+
     def map_chunks(self, chunk_definition: Dict[str, int]) -> dict:
         raise ValueError("Multiple datasets without a defined merge strategy! Please use a merge method first.")
@@ -1,4 +1,7 @@
-from typing import Dict, List, Mapping, Tuple
+from typing import Dict, List, Mapping, Optional, Tuple
+
+import numpy as np
+import xarray as xr
 
 def merge_chunk_definitions(dict1: Dict[str, int], dict2: Mapping[str, int]) -> Dict[str, int]:
     dict2 = dict(dict2)
@@ -11,4 +14,65 @@ def get_zarr_key(var_name: str, chunk_indices: Tuple[int, ...], chunk_sizes: Dic
             key_parts.append(str(index // chunk_sizes[dim]))
         else:
             key_parts.append('0')  # For dimensions not explicitly chunked (like 'bnds')
-    return '/'.join(key_parts)
\ No newline at end of file
+    return '/'.join(key_parts)
+
+def chunk_boundaries(size: int, chunk_size: int, first: int = 0, stop: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the start and (exclusive) end offset of every chunk along a dimension (numbered `first` to `stop`)."""
+    end = size if stop is None else min(stop * chunk_size, size)
+    starts = np.arange(first * chunk_size, end, chunk_size, dtype=np.int64)
+    ends = np.minimum(starts + chunk_size, size)
+    return starts, ends
+
+def overlap_slices(source_starts: np.ndarray, source_ends: np.ndarray, chunk_starts: np.ndarray, chunk_ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the (source, local_start, local_end) pieces overlapping each chunk, for all chunks at once.
+
+    Sources must be contiguous and sorted along the dimension. The result is in CSR form:
+    the pieces of chunk `n` are `pieces[indptr[n]:indptr[n + 1]]`, with `pieces` an
+    (n_pieces, 3) int64 array.
+    """
+    source_starts = np.asarray(source_starts, dtype=np.int64)
+    source_ends = np.asarray(source_ends, dtype=np.int64)
+
+    # First source ending after the chunk start, and one past the last source starting before its end
+    first = np.searchsorted(source_ends, chunk_starts, side="right")
+    last = np.searchsorted(source_starts, chunk_ends, side="left")
+    counts = np.maximum(last - first, 0)
+
+    indptr = np.zeros(len(chunk_starts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+
+    chunk_of_piece = np.repeat(np.arange(len(chunk_starts)), counts)
+    source = np.arange(indptr[-1], dtype=np.int64) - indptr[:-1][chunk_of_piece] + first[chunk_of_piece]
+    offset = source_starts[source]
+
+    pieces = np.empty((len(source), 3), dtype=np.int64)
+    pieces[:, 0] = source
+    pieces[:, 1] = np.maximum(offset, chunk_starts[chunk_of_piece]) - offset
+    pieces[:, 2] = np.minimum(source_ends[source], chunk_ends[chunk_of_piece]) - offset
+    return indptr, pieces
+
+def whole_source_slices(chunk_starts: np.ndarray, chunk_ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """The (source, start, end) pieces, in CSR form, of chunks along a dimension which every source holds whole."""
+    indptr = np.arange(len(chunk_starts) + 1, dtype=np.int64)
+    return indptr, np.stack([np.zeros_like(chunk_starts), chunk_starts, chunk_ends], axis=1)
+
+def native_chunk_sizes(variable: xr.DataArray) -> Dict[str, int]:
+    """
+    Chunk size along each dimension of a variable as stored in its source.
+
+    Variables stored contiguously are read in rows, which is modelled as chunks of
+    length one along every dimension but the last.
+    """
+    encoding = variable.encoding
+    preferred = encoding.get("preferred_chunks")
+    if preferred:
+        return {dim: preferred.get(dim, size) for dim, size in variable.sizes.items()}
+    chunks = encoding.get("chunksizes") or encoding.get("chunks")
+    if chunks:
+        return dict(zip(variable.dims, chunks))
+    return {dim: size if n == variable.ndim - 1 else 1 for n, (dim, size) in enumerate(variable.sizes.items())}
+
+def block_ranges(start: int, end: int, chunk_size: int) -> range:
+    """Indices of the native chunks of size `chunk_size` overlapping [start, end)."""
+    return range(start // chunk_size, -(-end // chunk_size))
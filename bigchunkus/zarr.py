@@ -1,4 +1,9 @@
-from typing import List, Dict
+import itertools
+from typing import Any, Iterable, Iterator, List, Dict, Sequence, Tuple
+
+import numpy as np
+import xarray as xr
+from numpy.dtypes import StringDType
 
 def build_zarr_key_generator(variable_name: str, chunk_definition: Dict[str, int], variable_dims: List[str]):
     """Build and return a Zarr key generator function with validation performed once."""
@@ -19,4 +24,69 @@ def build_zarr_key_generator(variable_name: str, chunk_definition: Dict[str, int
         adjusted_indices = [ci // chunk_definition[dim] for ci, dim in zip(chunk_indices, variable_dims)]
         return f"{variable_name}/" + ".".join(map(str, adjusted_indices))
 
-    return generate_zarr_key
\ No newline at end of file
+    return generate_zarr_key
+
+def format_chunk_keys(variable_name: str, chunk_indices: np.ndarray) -> np.ndarray:
+    """
+    Format the zarr v2 keys (`var/0.1`) of many chunks at once.
+
+    `chunk_indices` is an `(n_chunks, ndim)` array of chunk numbers; the keys are built
+    column by column with vectorized string operations and returned as a string array.
+    """
+    chunk_indices = np.asarray(chunk_indices, dtype=np.int64)
+    if chunk_indices.ndim != 2:
+        raise ValueError(f"Expected an (n_chunks, ndim) array of chunk indices, got shape {chunk_indices.shape}")
+    if chunk_indices.shape[1] == 0:
+        # Scalars have a single chunk
+        return np.full(len(chunk_indices), f"{variable_name}/0", dtype=StringDType())
+
+    keys = np.full(len(chunk_indices), f"{variable_name}/", dtype=StringDType())
+    for n, column in enumerate(chunk_indices.T):
+        if n:
+            keys = np.strings.add(keys, ".")
+        # Format each distinct number once, then gather
+        numbers, inverse = np.unique(column, return_inverse=True)
+        keys = np.strings.add(keys, numbers.astype(StringDType())[inverse])
+    return keys
+
+def iter_chunk_keys(variable_name: str, chunk_numbers: Sequence[Iterable[int]]) -> Iterator[str]:
+    """
+    Lazily yield the zarr v2 keys of every chunk in the product of `chunk_numbers`, in row-major order.
+
+    Each chunk number is formatted once per dimension; nothing is validated per key.
+    """
+    prefix = f"{variable_name}/"
+    if not chunk_numbers:
+        yield prefix + "0"
+        return
+    strings = [[str(n) for n in numbers] for numbers in chunk_numbers]
+    yield from map(prefix.__add__, map(".".join, itertools.product(*strings)))
+
+def json_attrs(attrs: Dict[str, Any]) -> Dict[str, Any]:
+    """Make attributes JSON-serializable (numpy scalars and arrays become Python values)."""
+    return {key: value.tolist() if isinstance(value, (np.generic, np.ndarray)) else value for key, value in attrs.items()}
+
+
+def encode_coordinate(name: str, variable: xr.Variable) -> Tuple[Dict[str, Any], Dict[str, Any], str, bytes]:
+    """
+    Encode a (small) coordinate variable as a single uncompressed zarr v2 chunk.
+
+    Returns the `.zarray` and `.zattrs` contents, the key of the chunk and its bytes.
+    """
+    encoded = xr.conventions.encode_cf_variable(variable, name=name)
+    values = np.ascontiguousarray(encoded.values)
+    zarray = {
+        "shape": list(values.shape),
+        "chunks": list(values.shape),
+        "dtype": values.dtype.str,
+        "fill_value": None,
+        "order": "C",
+        "filters": None,
+        "compressor": None,
+        "dimension_separator": ".",
+        "zarr_format": 2,
+    }
+    zattrs = json_attrs(encoded.attrs)
+    zattrs["_ARRAY_DIMENSIONS"] = list(variable.dims)
+    chunk_key = f"{name}/" + ".".join("0" for _ in values.shape)
+    return zarray, zattrs, chunk_key, values.tobytes()
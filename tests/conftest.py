@@ -0,0 +1,70 @@
+import math
+
+import numpy as np
+import pytest
+import xarray as xr
+
+
+@pytest.fixture
+def make_sources(tmp_path):
+    """
+    Factory of datasets following each other along `time`, one per entry of `sizes`.
+
+    Each holds `variables` over `time` and the `dims` (name to size) after it, counting
+    up from `100 * i` in source `i` (plus `1000 * k` for the `k`-th variable), and the
+    `extra` variables, given as `(dims, values[, attrs])`, whole. `coords` overrides
+    the default `time` (split between the sources) and `10 * arange` coordinates, or
+    drops one when None. `encoding` applies to every variable of `variables`.
+
+    Datasets are returned in memory, named by `source` (formatted with `i` and the
+    `offset` of the source along `time`) as if opened from a file, or with `write` set,
+    written to netCDF files named after `name` and returned as `"paths"` or reopened
+    `"datasets"`.
+    """
+    def make(
+        sizes,
+        variables=("var",),
+        dims=None,
+        extra=None,
+        coords=None,
+        attrs=None,
+        dtype="f4",
+        encoding=None,
+        write=None,
+        name="source_{i}.nc",
+        source=None,
+    ):
+        dims = {"x": 5} if dims is None else dims
+        coords = {"time": np.arange(sum(sizes)), **{dim: np.arange(size) * 10 for dim, size in dims.items()}, **(coords or {})}
+        results = []
+        offset = 0
+        for i, size in enumerate(sizes):
+            shape = (size, *dims.values())
+            ds = xr.Dataset(
+                {
+                    var_name: (("time", *dims), np.arange(math.prod(shape), dtype=dtype).reshape(shape) + 100 * i + 1000 * k, dict(attrs or {}))
+                    for k, var_name in enumerate(variables)
+                },
+                coords={
+                    dim: values[offset:offset + size] if dim == "time" else values
+                    for dim, values in coords.items() if values is not None
+                },
+            )
+            for var_name, variable in (extra or {}).items():
+                ds[var_name] = variable
+
+            if write is None:
+                for var_name in variables:
+                    ds[var_name].encoding.update(encoding or {})
+                if source is not None:
+                    ds.encoding["source"] = source.format(i=i, offset=offset)
+                results.append(ds)
+                offset += size
+                continue
+            offset += size
+            path = str(tmp_path / name.format(i=i))
+            ds.to_netcdf(path, engine="h5netcdf", encoding={var_name: dict(encoding) for var_name in variables} if encoding else None)
+            results.append(path if write == "paths" else xr.open_dataset(path, engine="h5netcdf"))
+        return results
+
+    return make
@@ -0,0 +1,55 @@
+from bigchunkus.benchmark import Scenario, compare, run, synthetic_metadata
+
+import copy
+
+def small_scenarios():
+    return [
+        Scenario("sources-10", "sources", 10, 3, 2, True),
+        Scenario("sources-100", "sources", 100, 3, 2, True),
+        Scenario("dims-1", "dims", 10, 1, 1, False),
+        Scenario("dims-4", "dims", 10, 4, 1, False),
+    ]
+
+def test_synthetic_metadata_is_shuffled_and_reproducible():
+    scenario = Scenario("ragged", "ragged", 50, 4, 3, True)
+
+    metadata = synthetic_metadata(scenario)
+
+    assert [m.sizes for m in metadata] == [m.sizes for m in synthetic_metadata(scenario)]
+    assert list(metadata[0].sizes) == ["time", "level", "y", "x"]
+    assert len(metadata[0].variables) == 3
+    assert len({m.sizes["time"] for m in metadata}) > 1
+    firsts = [int(m.bounds["time"][0]) for m in metadata]
+    assert firsts != sorted(firsts)
+
+def test_run_reports_plan_size_and_scaling():
+    results = run(small_scenarios(), repeat=1)
+
+    by_name = {r["name"]: r for r in results["results"]}
+    # Uniform sources of 24 steps in chunks of 10 along time and 8 elsewhere
+    assert by_name["dims-1"]["n_chunks"] == 24
+    assert by_name["dims-4"]["n_chunks"] == 24 * 2 * 2 * 2
+    assert all(r["seconds"] > 0 and r["iterate_seconds"] > 0 and r["keys_seconds"] > 0 for r in results["results"])
+    assert all(r["peak_bytes"] > 0 for r in results["results"])
+    assert set(results["scaling"]["seconds"]) == {"sources", "dims"}
+    assert set(results["scaling"]["iterate_seconds"]) == {"sources", "dims"}
+
+def test_compare_flags_regressions_against_baseline():
+    baseline = run(small_scenarios(), repeat=1)
+    current = copy.deepcopy(baseline)
+
+    assert compare(current, baseline) == []
+
+    current["results"][1]["seconds"] = baseline["results"][1]["seconds"] * 2 + 1
+    current["results"][0]["iterate_seconds"] = baseline["results"][0]["iterate_seconds"] * 2 + 1
+    current["results"][2]["n_chunks"] += 1
+    regressions = compare(current, baseline)
+
+    assert {(r.name, r.metric) for r in regressions} == {
+        ("sources-100", "seconds"), ("sources-10", "iterate_seconds"), ("dims-1", "n_chunks"),
+    }
+
+    # Baselines recorded before enumeration was timed still compare on what they hold
+    for result in baseline["results"]:
+        del result["iterate_seconds"]
+    assert {(r.name, r.metric) for r in compare(current, baseline)} == {("sources-100", "seconds"), ("dims-1", "n_chunks")}
@@ -0,0 +1,112 @@
+from bigchunkus.cache import PlanCache, source_fingerprint
+from bigchunkus.merge.merge import MergePlan
+from bigchunkus.unmerged import UnmergedChunkPlanner
+
+import os
+
+import numpy as np
+import xarray as xr
+
+# As if opened from files, so plans can be cached on disk
+SOURCES = dict(source="memory/var/{offset}.nc")
+
+def test_repeated_plans_come_from_memory(make_sources):
+    planner = UnmergedChunkPlanner(*make_sources([3, 1, 4], **SOURCES)).concat(dim="time")
+    cache = PlanCache()
+
+    first = planner.map_chunks({"time": 3}, cache=cache)
+    # x defaults to its full size either way
+    second = planner.map_chunks({"time": 3, "x": 5}, cache=cache)
+
+    assert second.dim_tables is first.dim_tables
+    assert dict(first) == dict(planner.map_chunks({"time": 3}))
+    assert cache.stats == {"hits": 1, "disk_hits": 0, "misses": 1}
+
+def test_plans_load_from_disk_with_the_planner_sources(tmp_path, make_sources):
+    datasets = make_sources([3, 1, 4], **SOURCES)
+    planner = UnmergedChunkPlanner(*datasets).concat(dim="time")
+    PlanCache(directory=tmp_path / "plans").plan(planner, {"time": 3, "x": 2})
+
+    cache = PlanCache(directory=tmp_path / "plans")
+    chunk_plan = cache.plan(UnmergedChunkPlanner(*datasets).concat(dim="time"), {"time": 3, "x": 2})
+
+    assert cache.stats["disk_hits"] == 1
+    assert dict(chunk_plan) == dict(planner.plan({"time": 3, "x": 2}))
+    assert all(source is dataset for source, dataset in zip(chunk_plan.sources, datasets))
+
+def test_fingerprint_follows_sources(make_sources):
+    datasets = make_sources([3, 1, 4], **SOURCES)
+    planner = UnmergedChunkPlanner(*datasets).concat(dim="time")
+
+    assert source_fingerprint(planner) == source_fingerprint(UnmergedChunkPlanner(*datasets).concat(dim="time"))
+    assert source_fingerprint(planner) != source_fingerprint(UnmergedChunkPlanner(*make_sources([3, 2, 4], **SOURCES)).concat(dim="time"))
+    assert source_fingerprint(planner) != source_fingerprint(planner.append(*make_sources([2], **SOURCES)))
+
+def test_cache_evicts_by_count_and_size(tmp_path, make_sources):
+    planner = UnmergedChunkPlanner(*make_sources([3, 1, 4], **SOURCES)).concat(dim="time")
+    cache = PlanCache(max_entries=2)
+    for size in (1, 2, 3):
+        cache.plan(planner, {"time": size})
+
+    cache.plan(planner, {"time": 1})
+    assert cache.stats["misses"] == 4
+
+    plan_bytes = cache.nbytes // 2
+    sized = PlanCache(max_bytes=plan_bytes + 1, directory=tmp_path / "plans", max_disk_bytes=1)
+    sized.plan(planner, {"time": 2})
+    sized.plan(planner, {"time": 3})
+    assert len(sized._plans) == 1
+    # Only the most recent plan stays on disk
+    assert len([name for name in os.listdir(tmp_path / "plans") if not name.startswith(".")]) == 1
+
+def test_invalidate_drops_plans_of_a_planner(tmp_path, make_sources):
+    planner = UnmergedChunkPlanner(*make_sources([3, 1, 4], **SOURCES)).concat(dim="time")
+    other = UnmergedChunkPlanner(*make_sources([2, 2], **SOURCES)).concat(dim="time")
+    cache = PlanCache(directory=tmp_path / "plans")
+    for chunk_definition in ({"time": 2}, {"time": 3}):
+        cache.plan(planner, chunk_definition)
+        cache.plan(other, chunk_definition)
+
+    assert cache.invalidate(planner, {"time": 2}) == 2
+    assert cache.invalidate(planner) == 2
+    cache.plan(other, {"time": 3})
+    assert cache.stats["hits"] == 1
+    cache.clear()
+    assert not cache._plans and not os.listdir(tmp_path / "plans")
+
+def test_merge_plans_round_trip_through_disk(tmp_path, make_sources):
+    planner = UnmergedChunkPlanner(*make_sources([3], variables=("tas",), source="memory/tas/{offset}.nc"), *make_sources([3], variables=("pr",), source="memory/pr/{offset}.nc")).merge()
+    PlanCache(directory=tmp_path / "plans").plan(planner, {"time": 2})
+
+    cache = PlanCache(directory=tmp_path / "plans")
+    chunk_plan = planner.map_chunks({"time": 2}, cache=cache)
+
+    assert cache.stats["disk_hits"] == 1
+    assert isinstance(chunk_plan, MergePlan)
+    assert dict(chunk_plan.iter_chunks()) == dict(planner.plan({"time": 2}).iter_chunks())
+
+
+def test_unnamed_sources_are_not_confused(tmp_path):
+    def dataset(value, start):
+        return xr.Dataset({"var": (("time",), np.full(2, value))}, coords={"time": [start, start + 1]})
+
+    cache = PlanCache(directory=tmp_path / "plans")
+    first = UnmergedChunkPlanner(dataset(1.0, 0), dataset(2.0, 2)).concat(dim="time")
+    second = UnmergedChunkPlanner(dataset(7.0, 0), dataset(8.0, 2)).concat(dim="time")
+    first_plan = cache.plan(first, {"time": 2})
+    second_plan = cache.plan(second, {"time": 2})
+
+    assert cache.key(first, {"time": 2}) != cache.key(second, {"time": 2})
+    assert float(second_plan.sources[0]["var"][0]) == 7.0
+    assert float(first_plan.sources[0]["var"][0]) == 1.0
+    # Only named sources are cached on disk
+    assert not os.listdir(tmp_path / "plans")
+
+def test_memory_hits_use_the_planner_sources(make_sources):
+    cache = PlanCache()
+    cache.plan(UnmergedChunkPlanner(*make_sources([3, 1, 4], **SOURCES)).concat(dim="time"), {"time": 3})
+    datasets = make_sources([3, 1, 4], **SOURCES)
+    chunk_plan = cache.plan(UnmergedChunkPlanner(*datasets).concat(dim="time"), {"time": 3})
+
+    assert cache.stats["hits"] == 1
+    assert all(source is dataset for source, dataset in zip(chunk_plan.sources, datasets))
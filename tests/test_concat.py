@@ -2,6 +2,7 @@ from bigchunkus.unmerged import UnmergedChunkPlanner
 from bigchunkus.merge import ConcatChunkPlanner
 
 import numpy as np
+import pandas as pd
 import pytest
 import xarray as xr
 
@@ -274,3 +275,148 @@ def test_automatic_ordering_without_indexes_raises():
     unmerged_planner = UnmergedChunkPlanner(ds2, ds1)
     with pytest.raises(ValueError):
         unmerged_planner.concat(dim='time')
+
+def test_iter_chunks_streams_records_in_order():
+    ds1 = xr.Dataset({
+        "var": (("time", "x"), np.array([[1, 2, 3], [4, 5, 6]]))
+    }, coords={"time": [0, 1], "x": [10, 20, 30]})
+
+    ds2 = xr.Dataset({
+        "var": (("time", "x"), np.array([[7, 8, 9], [10, 11, 12]]))
+    }, coords={"time": [2, 3], "x": [10, 20, 30]})
+    concat_planner = UnmergedChunkPlanner(ds1, ds2).concat(dim='time')
+    chunk_definition = {"time": 3, "x": 3}
+
+    records = concat_planner.map_chunks(chunk_definition, stream=True)
+    assert not isinstance(records, dict)
+    assert next(records) == ("var/0.0", {"time": [(0, 0, 2), (1, 0, 1)], "x": [(0, 0, 3)]})
+    assert next(records) == ("var/1.0", {"time": [(1, 1, 2)], "x": [(0, 0, 3)]})
+    with pytest.raises(StopIteration):
+        next(records)
+
+    chunk_map = concat_planner.map_chunks(chunk_definition)
+    streamed = dict(concat_planner.iter_chunks(chunk_definition))
+    assert streamed == {key: chunk_map[key] for key in streamed}
+
+def test_overlap_slices_matches_linear_scan():
+    from bigchunkus.util import chunk_boundaries, overlap_slices
+
+    sizes = [2, 0, 1, 3, 0, 0, 1, 5, 2]
+    ends = np.cumsum(sizes)
+    starts = ends - sizes
+    chunk_starts, chunk_ends = chunk_boundaries(int(ends[-1]), 3)
+    indptr, pieces = overlap_slices(starts, ends, chunk_starts, chunk_ends)
+
+    for n, (chunk_start, chunk_end) in enumerate(zip(chunk_starts, chunk_ends)):
+        expected = [
+            (i, max(start, chunk_start) - start, min(end, chunk_end) - start)
+            for i, (start, end) in enumerate(zip(starts, ends))
+            if end > chunk_start and start < chunk_end
+        ]
+        assert [tuple(p) for p in pieces[indptr[n]:indptr[n + 1]].tolist()] == expected
+
+def test_metadata_concat_matches_full_concat():
+    ds1 = xr.Dataset({
+        "var": (("time", "x"), np.zeros((2, 3), dtype="f4")),
+        "x_bnds": (("x", "bnds"), np.zeros((3, 2)))
+    }, coords={"time": [0, 1], "x": [10, 20, 30]})
+    ds2 = xr.Dataset({
+        "var": (("time", "x"), np.zeros((3, 3), dtype="f4")),
+        "x_bnds": (("x", "bnds"), np.zeros((3, 2)))
+    }, coords={"time": [2, 3, 4], "x": [10, 20, 30]})
+
+    fast = UnmergedChunkPlanner(ds1, ds2).concat(dim='time')
+    full = UnmergedChunkPlanner(ds1, ds2).concat(dim='time', full_concat=True)
+
+    assert fast.merged_dataset is None
+    assert fast.metadata.sizes == dict(full.merged_dataset.sizes)
+    assert fast.metadata.variables == {name: var.dims for name, var in full.merged_dataset.data_vars.items()}
+    assert fast.metadata.dtypes == {"var": "<f4", "x_bnds": "<f8"}
+    assert fast.coords.keys() == full.coords.keys()
+    for name, coord in fast.coords.items():
+        assert coord.identical(full.coords[name])
+    chunk_definition = {"time": 2, "x": 2}
+    assert fast.map_chunks(chunk_definition) == full.map_chunks(chunk_definition)
+
+def test_metadata_concat_requires_concatenated_variables_in_every_source():
+    ds1 = xr.Dataset({"var": (("time", "x"), np.zeros((2, 3)))}, coords={"time": [0, 1]})
+    ds2 = xr.Dataset({"other": (("time", "x"), np.zeros((2, 3)))}, coords={"time": [2, 3]})
+
+    with pytest.raises(ValueError):
+        UnmergedChunkPlanner(ds1, ds2).concat(dim='time')
+
+def test_metadata_concat_requires_equal_sizes_along_other_dims():
+    ds1 = xr.Dataset({"var": (("time", "x"), np.zeros((2, 3)))}, coords={"time": [0, 1]})
+    ds2 = xr.Dataset({"var": (("time", "x"), np.zeros((2, 4)))}, coords={"time": [2, 3]})
+
+    with pytest.raises(ValueError, match="'x'"):
+        UnmergedChunkPlanner(ds1, ds2).concat(dim='time')
+
+def build_region_planner(make_sources):
+    datasets = make_sources(
+        [7, 3, 11, 4, 9],
+        dims={"lat": 10},
+        extra={"lat_bnds": (("lat", "bnds"), np.zeros((10, 2)))},
+        coords={"time": pd.date_range("2000-01-01", periods=34), "lat": np.linspace(-45, 45, 10)},
+        dtype="f8",
+    )
+    return UnmergedChunkPlanner(*datasets).concat(dim='time')
+
+@pytest.mark.parametrize("region, positional, time_chunks, lat_chunks", [
+    ({"time": slice("2000-01-09", "2000-01-12")}, False, [1, 2], [0, 1, 2]),
+    ({"time": slice("2000-01-09", "2000-01-12"), "lat": slice(0, 20)}, False, [1, 2], [1]),
+    ({"time": slice(8, 12)}, True, [1, 2], [0, 1, 2]),
+    ({"time": slice(None, 2), "lat": slice(-3, None)}, True, [0], [1, 2]),
+    ({"time": slice("2001-01-01", None)}, False, [], [0, 1, 2]),
+])
+def test_region_plan_matches_full_plan(region, positional, time_chunks, lat_chunks, make_sources):
+    planner = build_region_planner(make_sources)
+    chunk_definition = {"time": 5, "lat": 4}
+    full = dict(planner.map_chunks(chunk_definition))
+
+    region_plan = planner.map_chunks(chunk_definition, region=region, positional=positional)
+
+    expected_keys = [f"var/{t}.{y}" for t in time_chunks for y in lat_chunks]
+    assert [key for key, _ in region_plan.iter_chunks() if key.startswith("var/")] == expected_keys
+    assert all(full[key] == slices for key, slices in region_plan.iter_chunks())
+    assert all(full[key] == region_plan[key] for key in region_plan)
+    assert region_plan.is_region()
+    assert "var/0.0" in full and ("var/0.0" in region_plan) == (0 in time_chunks and 0 in lat_chunks)
+
+@pytest.mark.parametrize("lat_region", [slice(20, 0), slice(0, 20), slice(None, 30), slice(-40, None)])
+def test_region_plan_on_descending_coordinate(lat_region):
+    datasets = [
+        xr.Dataset({"var": (("time", "lat"), np.zeros((size, 10)))}, coords={"time": np.arange(offset, offset + size), "lat": np.linspace(45, -45, 10)})
+        for offset, size in zip([0, 7], [7, 3])
+    ]
+    planner = UnmergedChunkPlanner(*datasets).concat(dim='time')
+
+    region_plan = planner.map_chunks({"time": 5, "lat": 4}, region={"lat": lat_region})
+
+    # The chunks holding what Dataset.sel selects
+    selected = np.flatnonzero(np.isin(datasets[0]["lat"].values, datasets[0]["lat"].sel(lat=lat_region).values))
+    lat_chunks = sorted(set((selected // 4).tolist()))
+    assert [key for key, _ in region_plan.iter_chunks()] == [f"var/{t}.{y}" for t in range(2) for y in lat_chunks]
+
+@pytest.mark.parametrize("time_region", [slice(22, 3), slice(15, 12), slice(3, 22)])
+def test_region_plan_along_descending_concat_dim(time_region):
+    datasets = [
+        xr.Dataset({"var": (("time",), np.zeros(size))}, coords={"time": np.arange(offset + size - 1, offset - 1, -1)})
+        for offset, size in [(20, 5), (10, 4), (0, 6)]
+    ]
+    planner = UnmergedChunkPlanner(*datasets).concat(dim='time', manually_ordered=True)
+
+    region_plan = planner.map_chunks({"time": 2}, region={"time": time_region})
+
+    times = np.concatenate([dataset["time"].values for dataset in datasets])
+    selected = np.flatnonzero((times <= time_region.start) & (times >= time_region.stop))
+    assert [key for key, _ in region_plan.iter_chunks()] == [f"var/{n}" for n in sorted(set((selected // 2).tolist()))]
+
+def test_region_plan_rejects_unsorted_coordinates():
+    dataset = xr.Dataset({"var": (("time", "lat"), np.zeros((2, 3)))}, coords={"time": [0, 1], "lat": [10.0, -10.0, 20.0]})
+    with pytest.raises(ValueError, match="sorted"):
+        UnmergedChunkPlanner(dataset).concat(dim='time').map_chunks({"time": 1}, region={"lat": slice(0, 15)})
+
+def test_region_plan_rejects_steps(make_sources):
+    with pytest.raises(ValueError):
+        build_region_planner(make_sources).map_chunks({"time": 5}, region={"time": slice(0, 10, 2)}, positional=True)
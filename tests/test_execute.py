@@ -0,0 +1,169 @@
+from bigchunkus.execute import execute
+from bigchunkus.plan import ChunkPlan
+from bigchunkus.unmerged import UnmergedChunkPlanner
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import numpy as np
+import pytest
+import xarray as xr
+
+# A series of files holding a variable and its (constant) bounds
+SOURCES = dict(extra={"x_bnds": (("x", "bnds"), np.arange(10).reshape(5, 2))}, attrs={"units": "K"}, write="paths")
+
+def open_planner(paths):
+    datasets = [xr.open_dataset(path, engine="h5netcdf") for path in paths]
+    return UnmergedChunkPlanner(*datasets).concat(dim="time", full_concat=True)
+
+def test_execute_writes_zarr_store(tmp_path, make_sources):
+    paths = make_sources([3, 1, 4], **SOURCES)
+    concat_planner = open_planner(paths)
+    chunk_plan = concat_planner.map_chunks({"time": 3, "x": 2})
+    store = str(tmp_path / "out.zarr")
+
+    stats = execute(chunk_plan, store, coords=concat_planner.coords)
+
+    assert stats["written"] == 3 * 3 + 3
+    result = xr.open_zarr(store, consolidated=False, zarr_format=2)
+    xr.testing.assert_identical(result.load(), concat_planner.merged_dataset.load())
+
+def test_execute_is_restartable(tmp_path, make_sources):
+    paths = make_sources([2, 2], **SOURCES)
+    concat_planner = open_planner(paths)
+    chunk_plan = concat_planner.map_chunks({"time": 3, "x": 5})
+    store = str(tmp_path / "out.zarr")
+
+    assert execute(chunk_plan, store)["written"] == 3
+    os.remove(os.path.join(store, "var", "1.0"))
+    stats = execute(chunk_plan, store)
+
+    assert stats["written"] == 1
+    assert stats["skipped"] == 2
+    result = xr.open_zarr(store, consolidated=False, zarr_format=2)
+    np.testing.assert_array_equal(result["var"].values, concat_planner.merged_dataset["var"].values)
+
+def test_interrupted_writes_leave_no_truncated_chunks(tmp_path, make_sources, monkeypatch):
+    paths = make_sources([2, 2], **SOURCES)
+    concat_planner = open_planner(paths)
+    chunk_plan = concat_planner.map_chunks({"time": 3, "x": 5})
+    store = str(tmp_path / "out.zarr")
+
+    def crash(src, dst):
+        raise OSError("writer died")
+
+    # The chunk is written aside, but the writer dies before renaming it into place
+    monkeypatch.setattr("bigchunkus.execute.os.replace", crash)
+    with pytest.raises(OSError, match="writer died"):
+        execute(chunk_plan, store, keys=["var/1.0"])
+    monkeypatch.undo()
+    assert not os.path.exists(os.path.join(store, "var", "1.0"))
+    assert [name for name in os.listdir(os.path.join(store, "var")) if name.endswith(".partial")] == []
+
+    stats = execute(chunk_plan, store)
+    assert stats["written"] == 3
+    result = xr.open_zarr(store, consolidated=False, zarr_format=2)
+    np.testing.assert_array_equal(result["var"].values, concat_planner.merged_dataset["var"].values)
+
+def test_resumed_runs_clear_files_of_killed_writes(tmp_path, make_sources):
+    chunk_plan = open_planner(make_sources([2, 2], **SOURCES)).map_chunks({"time": 3, "x": 5})
+    store = str(tmp_path / "out.zarr")
+    execute(chunk_plan, store, keys=["var/0.0"])
+    # Left by a writer killed before renaming, and by one of another shard still writing
+    stale, live = (os.path.join(store, "var", f".1.0.{n}.partial") for n in ("a", "b"))
+    for path in (stale, live):
+        with open(path, "wb") as f:
+            f.write(b"trunc")
+    os.utime(stale, (0, 0))
+
+    stats = execute(chunk_plan, store)
+
+    assert stats["written"] == 2 and stats["skipped"] == 1
+    assert not os.path.exists(stale) and os.path.exists(live)
+
+def test_execute_with_process_pool_from_saved_plan(tmp_path, make_sources):
+    paths = make_sources([2, 3], **SOURCES)
+    concat_planner = open_planner(paths)
+    chunk_plan = concat_planner.map_chunks({"time": 2, "x": 5})
+    chunk_plan.save(tmp_path / "plan")
+    reopened = ChunkPlan.open(tmp_path / "plan")
+    store = str(tmp_path / "out.zarr")
+
+    assert reopened.sources == paths
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        stats = execute(reopened, store, executor=executor, keys=["var/1.0", "var/2.0"], engine="h5netcdf")
+
+    assert stats["written"] == 2
+    result = xr.open_zarr(store, consolidated=False, zarr_format=2)
+    expected = concat_planner.merged_dataset["var"].values
+    np.testing.assert_array_equal(result["var"].values[2:], expected[2:])
+    assert np.isnan(result["var"].values[:2]).all()
+
+def test_append_rewrites_only_changed_chunks(tmp_path, make_sources):
+    paths = make_sources([3, 1, 4, 2, 3], **SOURCES)
+    datasets = [xr.open_dataset(path, engine="h5netcdf") for path in paths]
+    chunk_definition = {"time": 3, "x": 2}
+    planner = UnmergedChunkPlanner(*datasets[:3]).concat(dim="time")
+    previous = planner.map_chunks(chunk_definition)
+    store = str(tmp_path / "out.zarr")
+    execute(previous, store, coords=planner.coords)
+
+    appended = planner.append(*datasets[3:])
+    chunk_plan = appended.update_plan(previous)
+    changed = list(chunk_plan.changed_keys(previous))
+
+    # 8 -> 13 steps: chunk 2 was partial, chunks 3 and 4 are new; x_bnds has no time dim
+    assert changed == [f"var/{t}.{x}" for t in (2, 3, 4) for x in range(3)]
+    assert dict(chunk_plan) == dict(appended.map_chunks(chunk_definition))
+    stats = execute(chunk_plan, store, keys=changed, coords=appended.coords, skip_existing=False)
+
+    assert stats["written"] == len(changed)
+    expected = UnmergedChunkPlanner(*datasets).concat(dim="time", full_concat=True).merged_dataset
+    result = xr.open_zarr(store, consolidated=False, zarr_format=2)
+    xr.testing.assert_identical(result.load(), expected.load())
+
+def test_append_rejects_datasets_of_other_sizes(make_sources):
+    planner = UnmergedChunkPlanner(*make_sources([3, 1])).concat(dim="time")
+
+    with pytest.raises(ValueError, match="Appended dataset 0 .* 'x'"):
+        planner.append(*make_sources([2], dims={"x": 4}))
+
+def test_changed_keys_rejects_unrelated_plans(make_sources):
+    paths = make_sources([3, 1], **SOURCES)
+    planner = open_planner(paths)
+
+    with pytest.raises(ValueError):
+        list(planner.map_chunks({"time": 3, "x": 2}).changed_keys(planner.map_chunks({"time": 2, "x": 2})))
+
+def test_execute_shards_independently(tmp_path, make_sources):
+    paths = make_sources([3, 1, 4, 2], **SOURCES)
+    concat_planner = open_planner(paths)
+    chunk_plan = concat_planner.map_chunks({"time": 3, "x": 2})
+    store = str(tmp_path / "out.zarr")
+
+    written = [
+        execute(chunk_plan, store, keys=chunk_plan.shard(worker_id, 3), coords=concat_planner.coords, metadata=worker_id == 0)["written"]
+        for worker_id in range(3)
+    ]
+
+    assert sum(written) == 4 * 3 + 3
+    result = xr.open_zarr(store, consolidated=False, zarr_format=2)
+    xr.testing.assert_identical(result.load(), concat_planner.merged_dataset.load())
+
+@pytest.mark.parametrize("by_source", [False, True])
+def test_execute_writes_scalar_variables(tmp_path, make_sources, by_source):
+    crs = ((), np.int32(4326), {"grid_mapping_name": "latitude_longitude"})
+    paths = make_sources([3, 3], dims={}, extra={"crs": crs}, write="paths")
+    concat_planner = open_planner(paths)
+    chunk_plan = concat_planner.map_chunks({"time": 4})
+
+    assert "crs/0" in list(chunk_plan)
+    assert chunk_plan["crs/0"] == {}
+    assert dict(chunk_plan)["crs/0"] == {}
+    assert [key for shard in chunk_plan.partition(2) for key in shard].count("crs/0") == 1
+
+    store = str(tmp_path / "out.zarr")
+    assert execute(chunk_plan, store, by_source=by_source)["written"] == 3
+    result = xr.open_zarr(store, consolidated=False, zarr_format=2)
+    assert int(result["crs"]) == 4326
+    assert result["crs"].attrs["grid_mapping_name"] == "latitude_longitude"
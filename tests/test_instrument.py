@@ -0,0 +1,38 @@
+from bigchunkus import instrument
+from bigchunkus.execute import execute
+from bigchunkus.unmerged import UnmergedChunkPlanner
+
+def test_planning_reports_phases_and_counters(capsys, make_sources):
+    # Sources out of order, so that they must be sorted
+    with instrument.observe() as recorder:
+        chunk_plan = UnmergedChunkPlanner(*make_sources([3, 1, 4])[::-1]).concat(dim="time").map_chunks({"time": 3, "x": 2})
+        records = list(chunk_plan.iter_chunks())
+
+    assert capsys.readouterr().out == ""
+    assert set(recorder.phases) == {"order", "concat", "slices", "keys", "enumerate"}
+    # time chunks [0, 3) from source 0, [3, 6) from sources 0-2 and [6, 8) from source 2
+    assert dict(recorder.counters) == {"chunks": 9, "multi_source_chunks": 3, "sources_touched": 3}
+    assert len(records) == 9
+
+def test_instrumentation_is_off_outside_observe(make_sources):
+    recorder = instrument.Recorder()
+    with instrument.observe(recorder):
+        pass
+
+    UnmergedChunkPlanner(*make_sources([3, 1, 4])[::-1]).concat(dim="time").map_chunks({"time": 3})
+
+    assert instrument.current() is None
+    assert not recorder.phases and not recorder.counters
+
+def test_execute_reports_chunk_latency(tmp_path, make_sources):
+    planner = UnmergedChunkPlanner(*make_sources([3, 1, 4])[::-1]).concat(dim="time")
+    chunk_plan = planner.map_chunks({"time": 3, "x": 5})
+
+    with instrument.observe() as recorder:
+        stats = execute(chunk_plan, str(tmp_path / "out.zarr"), coords=planner.coords)
+
+    assert sorted(timing.zarr_key for timing in recorder.chunks) == ["var/0.0", "var/1.0", "var/2.0"]
+    assert all(timing.read_seconds >= 0 and timing.write_seconds >= 0 for timing in recorder.chunks)
+    assert recorder.counters["chunks_written"] == stats["written"] == 3
+    assert recorder.counters["bytes_written"] == sum(timing.nbytes for timing in recorder.chunks)
+    assert set(recorder.summary()["read_seconds"]) == {"p50", "p90", "p99"}
@@ -0,0 +1,98 @@
+from bigchunkus.kerchunk import ByteRange, byte_range_plan, coalesce_ranges
+from bigchunkus.unmerged import UnmergedChunkPlanner
+
+import json
+
+import numcodecs
+import numpy as np
+import pytest
+import xarray as xr
+
+kerchunk_hdf = pytest.importorskip("kerchunk.hdf")
+
+SOURCES = dict(dims={"x": 6}, dtype="f8", encoding={"chunksizes": (2, 3), "compression": "gzip"}, write="paths")
+
+def open_with_references(paths):
+    datasets = [xr.open_dataset(path, engine="h5netcdf") for path in paths]
+    return datasets, [kerchunk_hdf.SingleHdf5ToZarr(path, inline_threshold=0).translate() for path in paths]
+
+def test_kerchunk_references_split_aligned_and_misaligned_chunks(tmp_path, make_sources):
+    datasets, refs = open_with_references(make_sources([3, 3, 4], **SOURCES))
+    concat_planner = UnmergedChunkPlanner(*datasets).concat(dim="time")
+    output = str(tmp_path / "refs.json")
+
+    references, work = concat_planner.to_kerchunk_references(refs, output=output)
+
+    # time chunks: [0, 2) lies in source 0, [2, 4) spans sources 0 and 1,
+    # [4, 6) is misaligned within source 1, [6, 8) and [8, 10) are native chunks of source 2
+    assert sorted(work) == ["var/1.0", "var/1.1", "var/2.0", "var/2.1"]
+    assert work["var/1.0"] == {"time": [(0, 2, 3), (1, 0, 1)], "x": [(0, 0, 3)]}
+    assert references["refs"]["var/0.1"] == refs[0]["refs"]["var/0.1"]
+    assert references["refs"]["var/3.0"] == refs[2]["refs"]["var/0.0"]
+    assert references["refs"]["var/4.1"] == refs[2]["refs"]["var/1.1"]
+
+    virtual = xr.open_dataset(
+        "reference://", engine="zarr",
+        backend_kwargs={"consolidated": False, "storage_options": {"fo": output}}
+    )
+    expected = xr.concat(datasets, dim="time")
+    np.testing.assert_array_equal(virtual["time"].values, expected["time"].values)
+    np.testing.assert_array_equal(virtual["var"].values[0:2], expected["var"].values[0:2])
+    np.testing.assert_array_equal(virtual["var"].values[8:10], expected["var"].values[8:10])
+
+def test_kerchunk_references_require_matching_chunk_shape(make_sources):
+    datasets, refs = open_with_references(make_sources([2, 2], **SOURCES))
+    concat_planner = UnmergedChunkPlanner(*datasets).concat(dim="time")
+
+    references, work = concat_planner.to_kerchunk_references(refs, {"time": 2, "x": 6})
+
+    assert len(work) == 2
+    assert sorted(key for key in references["refs"] if key.startswith("var/")) == ["var/.zarray", "var/.zattrs"]
+
+def decode_native_chunk(zarray, data):
+    for codec in reversed([zarray["compressor"], *(zarray["filters"] or [])]):
+        if codec is not None:
+            data = numcodecs.get_codec(codec).decode(data)
+    return np.frombuffer(data, dtype=zarray["dtype"]).reshape(zarray["chunks"])
+
+def test_byte_range_plan_reassembles_output_chunks(make_sources):
+    datasets, refs = open_with_references(make_sources([3, 3], **SOURCES))
+    chunk_plan = UnmergedChunkPlanner(*datasets).concat(dim="time").plan({"time": 4, "x": 4})
+    expected = xr.concat(datasets, dim="time")["var"].values
+
+    reads = {chunk.zarr_key: chunk for chunk in byte_range_plan(chunk_plan, refs)}
+
+    # Output chunk 0.0 reads native chunks (0, 0) and (1, 0) of source 0 and (0, 0) of source 1, then x [0, 3) and [3, 4)
+    chunk = reads["var/0.0"]
+    assert [r.native_chunk_index for r in chunk.ranges] == [(0, 0), (0, 1), (1, 0), (1, 1), (0, 0), (0, 1)]
+    assert chunk.ranges[1].subselection == (slice(0, 2), slice(0, 1))
+    assert chunk.ranges[4].out_selection == (slice(3, 4), slice(0, 3))
+    # Native chunks wholly inside the output chunk are read by no other
+    assert [r.shared for r in chunk.ranges] == [False, True, False, True, True, True]
+    assert sum(len(request.ranges) for request in chunk.requests) == len(chunk.ranges)
+    assert len({r.path for r in chunk.ranges}) == len({request.path for request in chunk.requests}) == 2
+
+    zarray = json.loads(refs[0]["refs"]["var/.zarray"])
+    for zarr_key, chunk in reads.items():
+        i, j = map(int, zarr_key.split("/")[1].split("."))
+        out = np.full((4, 4), np.nan)
+        for request in chunk.requests:
+            with open(request.path, "rb") as f:
+                f.seek(request.offset)
+                data = f.read(request.length)
+            for r in request.ranges:
+                native = decode_native_chunk(zarray, data[r.offset - request.offset:r.offset - request.offset + r.length])
+                out[r.out_selection] = native[r.subselection]
+        window = expected[4 * i:4 * i + 4, 4 * j:4 * j + 4]
+        np.testing.assert_array_equal(out[:window.shape[0], :window.shape[1]], window)
+
+def test_coalesce_ranges_merges_adjacent_and_near_ranges():
+    ranges = [
+        ByteRange("a.nc", 100, 50, (1,), (slice(0, 1),), (slice(0, 1),), False),
+        ByteRange("a.nc", 0, 100, (0,), (slice(0, 1),), (slice(1, 2),), False),
+        ByteRange("a.nc", 160, 10, (2,), (slice(0, 1),), (slice(2, 3),), False),
+        ByteRange("b.nc", 150, 10, (0,), (slice(0, 1),), (slice(3, 4),), False),
+    ]
+
+    assert [request[:3] for request in coalesce_ranges(ranges)] == [("a.nc", 0, 150), ("a.nc", 160, 10), ("b.nc", 150, 10)]
+    assert [request[:3] for request in coalesce_ranges(ranges, max_gap=10)] == [("a.nc", 0, 170), ("b.nc", 150, 10)]
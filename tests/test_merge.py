@@ -0,0 +1,78 @@
+from bigchunkus.execute import execute
+from bigchunkus.merge import MergeChunkPlanner
+from bigchunkus.merge.merge import MergePlan
+from bigchunkus.unmerged import UnmergedChunkPlanner
+
+import numpy as np
+import pytest
+import xarray as xr
+
+def write_variable_files(make_sources, names, sizes):
+    """One file per variable and year, like tas_0.nc, pr_0.nc, tas_1.nc, ..."""
+    files = [
+        make_sources(sizes, variables=(name,), dims={"x": 4}, extra={"x_bnds": (("x", "bnds"), np.arange(8.0).reshape(4, 2))}, write="paths", name=f"{name}_{{i}}.nc")
+        for name in names
+    ]
+    return [path for year in zip(*files) for path in year]
+
+def test_merge_routes_each_variable_to_its_files():
+    tas = xr.Dataset({"tas": (("time", "x"), np.zeros((3, 4)))}, coords={"time": [0, 1, 2]})
+    pr = xr.Dataset({"pr": (("time", "x"), np.zeros((3, 4)))}, coords={"time": [0, 1, 2]})
+
+    merge_planner = UnmergedChunkPlanner(tas, pr).merge()
+    chunk_plan = merge_planner.map_chunks({"time": 2, "x": 4})
+
+    assert isinstance(merge_planner, MergeChunkPlanner)
+    assert chunk_plan.variables == {"tas": ("time", "x"), "pr": ("time", "x")}
+    assert chunk_plan["tas/1.0"] == {"time": [(0, 2, 3)], "x": [(0, 0, 4)]}
+    assert chunk_plan["pr/1.0"] == {"time": [(1, 2, 3)], "x": [(1, 0, 4)]}
+    assert dict(chunk_plan.iter_chunks()) == {key: chunk_plan[key] for key in ["tas/0.0", "tas/1.0", "pr/0.0", "pr/1.0"]}
+
+def test_merge_of_concats_writes_merged_store(tmp_path, make_sources):
+    paths = write_variable_files(make_sources, ["tas", "pr"], [3, 1, 4])
+    datasets = [xr.open_dataset(path, engine="h5netcdf") for path in paths]
+
+    merge_planner = UnmergedChunkPlanner(*datasets).merge(concat_dim="time")
+    chunk_plan = merge_planner.map_chunks({"time": 3, "x": 3})
+
+    # tas and pr each read from their own three files
+    assert chunk_plan["tas/1.0"]["time"] == [(1, 0, 1), (2, 0, 2)]
+    assert chunk_plan["pr/1.0"]["time"] == [(4, 0, 1), (5, 0, 2)]
+    assert [chunk_plan.sources[source] for source, _, _ in chunk_plan["pr/1.0"]["time"]] == [datasets[3], datasets[5]]
+
+    store = str(tmp_path / "out.zarr")
+    stats = execute(chunk_plan, store, coords=merge_planner.coords)
+
+    assert stats["written"] == 2 * 3 * 2 + 2
+    expected = xr.merge([
+        xr.concat(datasets[k::2], dim="time", data_vars="minimal", coords="minimal", compat="override")
+        for k in range(2)
+    ], compat="override")
+    result = xr.open_zarr(store, consolidated=False, zarr_format=2)
+    xr.testing.assert_identical(result.load(), expected[list(result.data_vars)].load())
+
+def test_merge_plan_save_and_open(tmp_path, make_sources):
+    paths = write_variable_files(make_sources, ["tas", "pr"], [3, 2])
+    merge_planner = UnmergedChunkPlanner.from_paths(paths).merge(concat_dim="time")
+    chunk_plan = merge_planner.map_chunks({"time": 2, "x": 4})
+
+    chunk_plan.save(tmp_path / "plan")
+    reopened = MergePlan.open(tmp_path / "plan")
+
+    assert dict(reopened) == dict(chunk_plan)
+    assert reopened.sources == paths[0::2] + paths[1::2]
+
+def test_merge_rejects_mismatched_parts():
+    tas = xr.Dataset({"tas": (("time", "x"), np.zeros((3, 4)))})
+    pr = xr.Dataset({"pr": (("time", "x"), np.zeros((2, 4)))})
+
+    with pytest.raises(ValueError):
+        UnmergedChunkPlanner(tas, pr).merge()
+
+def test_merge_rejects_variables_split_along_a_dimension():
+    def tas(start):
+        return xr.Dataset({"tas": (("time", "x"), np.zeros((3, 4)))}, coords={"time": np.arange(start, start + 3)})
+    pr = xr.Dataset({"pr": (("time", "x"), np.zeros((3, 4)))}, coords={"time": [0, 1, 2]})
+
+    with pytest.raises(ValueError, match="concat_dim"):
+        UnmergedChunkPlanner(tas(0), tas(3), pr).merge()
@@ -0,0 +1,126 @@
+from bigchunkus.execute import execute
+from bigchunkus.merge import MosaicChunkPlanner
+from bigchunkus.merge.mosaic import MosaicPlan
+from bigchunkus.unmerged import UnmergedChunkPlanner
+
+import numpy as np
+import pytest
+import xarray as xr
+
+Y_SIZES = [3, 5]
+X_SIZES = [4, 2, 3]
+
+def build_tiles(make_sources):
+    [full] = make_sources([2], dims={"y": 8, "x": 9}, extra={"y_bnds": (("y", "bnds"), np.arange(16.0).reshape(8, 2))})
+    tiles = []
+    y_offsets = np.cumsum([0] + Y_SIZES)
+    x_offsets = np.cumsum([0] + X_SIZES)
+    for y0, y1 in zip(y_offsets[:-1], y_offsets[1:]):
+        for x0, x1 in zip(x_offsets[:-1], x_offsets[1:]):
+            tiles.append(full.isel(y=slice(y0, y1), x=slice(x0, x1)))
+    return full, tiles
+
+def assemble(chunk_plan, var_name, zarr_key, pieces, tiles, fill=np.nan):
+    """Build an output chunk from its pieces, placing each at its offset in the chunk."""
+    dims = chunk_plan.variables[var_name]
+    numbers = [int(n) for n in zarr_key.rpartition("/")[2].split(".")]
+    chunk_starts = [n * chunk_plan.chunk_definition[dim] for dim, n in zip(dims, numbers)]
+    shape = [min(chunk_plan.chunk_definition[dim], chunk_plan.dim_sizes[dim] - start) for dim, start in zip(dims, chunk_starts)]
+    out = np.full(shape, fill)
+    for source, region, offsets in pieces:
+        placement = tuple(slice(offsets[dim], offsets[dim] + region[dim][1] - region[dim][0]) for dim in dims)
+        out[placement] = tiles[source][var_name].values[tuple(slice(*region[dim]) for dim in dims)]
+    return out
+
+@pytest.mark.parametrize("combine", ["nested", "by_coords"])
+def test_mosaic_pieces_rebuild_every_chunk(combine, make_sources):
+    full, tiles = build_tiles(make_sources)
+    planner = UnmergedChunkPlanner(*tiles[::-1] if combine == "by_coords" else tiles)
+    if combine == "nested":
+        mosaic = planner.combine_nested(["y", "x"], shape=(2, 3))
+    else:
+        mosaic = planner.combine_by_coords(["y", "x"])
+        tiles = tiles[::-1]
+
+    assert isinstance(mosaic, MosaicChunkPlanner)
+    assert mosaic.metadata.sizes == {"time": 2, "y": 8, "x": 9, "bnds": 2}
+    chunk_plan = mosaic.map_chunks({"time": 1, "y": 4, "x": 4})
+    records = list(chunk_plan.iter_chunks())
+
+    assert len(records) == 2 * 2 * 3 + 2
+    for zarr_key, slices in records:
+        var_name = zarr_key.rpartition("/")[0]
+        assert chunk_plan[zarr_key] == slices
+        pieces = chunk_plan.chunk_pieces(var_name, slices)
+        expected = full[var_name].values
+        dims = chunk_plan.variables[var_name]
+        numbers = [int(n) for n in zarr_key.rpartition("/")[2].split(".")]
+        selection = tuple(slice(n * chunk_plan.chunk_definition[dim], (n + 1) * chunk_plan.chunk_definition[dim]) for dim, n in zip(dims, numbers))
+        np.testing.assert_array_equal(assemble(chunk_plan, var_name, zarr_key, pieces, tiles), expected[selection])
+
+def test_mosaic_chunk_spanning_tiles_lists_each_piece(make_sources):
+    _, tiles = build_tiles(make_sources)
+    chunk_plan = UnmergedChunkPlanner(*tiles).combine_nested(["y", "x"], shape=(2, 3)).map_chunks({"time": 2, "y": 4, "x": 4})
+
+    # y 0-4 spans tiles 0 (0-3) and 1 (3-8); x 4-8 spans tiles 1 (4-6) and 2 (6-9)
+    assert chunk_plan.chunk_pieces("var", chunk_plan["var/0.0.1"]) == [
+        (1, {"time": (0, 2), "y": (0, 3), "x": (0, 2)}, {"time": 0, "y": 0, "x": 0}),
+        (2, {"time": (0, 2), "y": (0, 3), "x": (0, 2)}, {"time": 0, "y": 0, "x": 2}),
+        (4, {"time": (0, 2), "y": (0, 1), "x": (0, 2)}, {"time": 0, "y": 3, "x": 0}),
+        (5, {"time": (0, 2), "y": (0, 1), "x": (0, 2)}, {"time": 0, "y": 3, "x": 2}),
+    ]
+    assert chunk_plan.chunk_pieces("y_bnds", chunk_plan["y_bnds/1.0"]) == [(3, {"y": (1, 5), "bnds": (0, 2)}, {"y": 0, "bnds": 0})]
+
+def test_mosaic_entries_name_sources_holding_them(make_sources):
+    _, tiles = build_tiles(make_sources)
+    # Without the middle tile of the first row, so x entries there name the tile below it
+    tiles = tiles[:1] + tiles[2:]
+    chunk_plan = UnmergedChunkPlanner(*tiles).combine_by_coords(["y", "x"]).map_chunks({"time": 2, "y": 4, "x": 4})
+
+    assert chunk_plan["var/0.0.1"] == {"time": [(0, 0, 2)], "y": [(0, 0, 3), (2, 0, 1)], "x": [(3, 0, 2), (1, 0, 2)]}
+    for zarr_key, slices in chunk_plan.iter_chunks():
+        for dim, pieces in slices.items():
+            for source, start, end in pieces:
+                assert 0 <= start < end <= tiles[source].sizes[dim]
+
+def test_mosaic_plans_partition_along_the_first_grid_dim(make_sources):
+    _, tiles = build_tiles(make_sources)
+    chunk_plan = UnmergedChunkPlanner(*tiles).combine_nested(["y", "x"], shape=(2, 3)).map_chunks({"time": 2, "y": 4, "x": 9})
+
+    shards = chunk_plan.partition(2)
+
+    assert shards == [["var/0.0.0", "y_bnds/0.0"], ["var/0.1.0", "y_bnds/1.0"]]
+    assert [sorted({source for key in shard for source in chunk_plan.chunk_sources(key.rpartition("/")[0], chunk_plan[key])}) for shard in shards] == [[0, 1, 2, 3, 4, 5], [3, 4, 5]]
+
+def test_mosaic_missing_tiles_are_skipped(tmp_path, make_sources):
+    full, tiles = build_tiles(make_sources)
+    # Drop the middle tile of the first row; its neighbours still place every other tile
+    mosaic = UnmergedChunkPlanner(*tiles[:1], *tiles[2:]).combine_by_coords(["y", "x"])
+
+    assert mosaic.grid.tolist() == [[0, -1, 1], [2, 3, 4]]
+    chunk_plan = mosaic.map_chunks({"time": 2, "y": 3, "x": 9})
+    assert chunk_plan.chunk_sources("var", chunk_plan["var/0.0.0"]) == [0, 1]
+
+    chunk_plan.save(tmp_path / "plan")
+    reopened = MosaicPlan.open(tmp_path / "plan")
+    assert dict(reopened.iter_chunks()) == dict(chunk_plan.iter_chunks())
+
+@pytest.mark.parametrize("by_source", [False, True])
+def test_mosaic_plans_execute(tmp_path, by_source, make_sources):
+    full, tiles = build_tiles(make_sources)
+    # Without the middle tile of the first row, which is left to the fill value
+    mosaic = UnmergedChunkPlanner(*tiles[:1], *tiles[2:]).combine_by_coords(["y", "x"])
+    execute(mosaic.map_chunks({"time": 1, "y": 4, "x": 4}), tmp_path / "out.zarr", coords={name: full[name].variable for name in ("time", "y", "x")}, by_source=by_source)
+
+    expected = full["var"].values.copy()
+    expected[:, :3, 4:6] = np.nan
+    result = xr.open_zarr(tmp_path / "out.zarr", consolidated=False)
+    np.testing.assert_array_equal(result["var"].values, expected)
+    np.testing.assert_array_equal(result["y_bnds"].values, full["y_bnds"].values)
+
+def test_mosaic_rejects_inconsistent_tiles(make_sources):
+    _, tiles = build_tiles(make_sources)
+    with pytest.raises(ValueError):
+        UnmergedChunkPlanner(*tiles).combine_nested(["y", "x"], shape=(3, 2))
+    with pytest.raises(ValueError):
+        UnmergedChunkPlanner(*tiles).combine_nested(["y", "x"], shape=(2, 2))
@@ -0,0 +1,169 @@
+from bigchunkus import instrument
+from bigchunkus.execute import ExecutionContext, variable_specs
+from bigchunkus.pipeline import chunk_fetcher, execute_async, prefetch_chunks, with_latency
+from bigchunkus.unmerged import UnmergedChunkPlanner
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import xarray as xr
+
+class FakeStore:
+    """Serves chunk records from memory once their reads are released, tracking concurrent reads."""
+
+    def __init__(self):
+        self.released = {}
+        self.completed = []
+        self.active = 0
+        self.max_active = 0
+        self.cancelled = 0
+
+    def release(self, zarr_key):
+        self.released.setdefault(zarr_key, asyncio.Event()).set()
+
+    async def release_in_order(self, keys, running):
+        """Once `running` reads are in flight, let those of `keys` complete one after the other."""
+        while self.active < running:
+            await asyncio.sleep(0)
+        for zarr_key in keys:
+            self.release(zarr_key)
+            while zarr_key not in self.completed:
+                await asyncio.sleep(0)
+
+    async def fetch(self, zarr_key, slices):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await self.released.setdefault(zarr_key, asyncio.Event()).wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            self.active -= 1
+        self.completed.append(zarr_key)
+        return np.full(4, int(zarr_key.split("/")[1]))
+
+def records(n):
+    return [(f"var/{i}", {}) for i in range(n)]
+
+def keys(n):
+    return [zarr_key for zarr_key, _ in records(n)]
+
+async def collect(chunks, releases=None):
+    result = [chunk.zarr_key async for chunk in chunks]
+    if releases is not None:
+        await releases
+    return result
+
+def test_prefetch_yields_in_order_or_as_completed():
+    async def ordered():
+        store = FakeStore()
+        chunks = prefetch_chunks(records(5), store.fetch, lambda *_: 32, prefetch=5)
+        # Later chunks are read first
+        releases = asyncio.ensure_future(store.release_in_order(keys(5)[::-1], running=5))
+        return await collect(chunks, releases), store.completed
+
+    async def unordered():
+        store = FakeStore()
+        order, result = keys(5)[::-1], []
+        store.release(order[0])
+        async for chunk in prefetch_chunks(records(5), store.fetch, lambda *_: 32, prefetch=5, ordered=False):
+            result.append(chunk.zarr_key)
+            # The next read completes only once this chunk is consumed
+            if len(result) < len(order):
+                store.release(order[len(result)])
+        return result
+
+    assert asyncio.run(ordered()) == (keys(5), keys(5)[::-1])
+    assert asyncio.run(unordered()) == keys(5)[::-1]
+
+def test_prefetch_overlaps_reads_within_depth_and_byte_budget():
+    async def run(running, **kwargs):
+        store = FakeStore()
+        chunks = prefetch_chunks(records(8), store.fetch, lambda *_: 32, prefetch=8, **kwargs)
+        # Reads only complete once `running` of them are in flight together
+        result = await collect(chunks, asyncio.ensure_future(store.release_in_order(keys(8), running)))
+        return result, store.max_active
+
+    assert asyncio.run(run(8)) == (keys(8), 8)
+    assert asyncio.run(run(3, max_bytes=96)) == (keys(8), 3)
+
+def test_prefetch_cancels_pending_reads_when_consumer_stops():
+    store = FakeStore()
+    store.release("var/0")
+
+    async def first():
+        chunks = prefetch_chunks(records(6), store.fetch, lambda *_: 32, prefetch=4)
+        async for chunk in chunks:
+            await chunks.aclose()
+            return chunk.zarr_key
+
+    assert asyncio.run(first()) == "var/0"
+    assert store.cancelled == 3
+
+def test_execute_async_writes_same_store_as_execute(tmp_path):
+    datasets = []
+    for i, size in enumerate([3, 1, 4]):
+        datasets.append(xr.Dataset(
+            {"var": (("time", "x"), np.random.rand(size, 5))},
+            coords={"time": np.arange(size) + 10 * i, "x": np.arange(5)},
+        ))
+    planner = UnmergedChunkPlanner(*datasets).concat(dim="time", full_concat=True)
+    chunk_plan = planner.map_chunks({"time": 3, "x": 2})
+    store = str(tmp_path / "out.zarr")
+
+    async def run():
+        context = ExecutionContext(None, None, None, 128)
+        fetch = with_latency(chunk_fetcher(chunk_plan, context, variable_specs(chunk_plan)), 0.01)
+        with instrument.observe() as recorder:
+            stats = await execute_async(chunk_plan, store, fetch=fetch, coords=planner.coords, prefetch=4)
+        return stats, recorder
+
+    stats, recorder = asyncio.run(run())
+
+    assert stats["written"] == 9
+    assert all(timing.read_seconds >= 0.01 for timing in recorder.chunks)
+    result = xr.open_zarr(store, consolidated=False, zarr_format=2)
+    xr.testing.assert_identical(result.load(), planner.merged_dataset.load())
+
+class SlowStore(dict):
+    """Store whose chunk writes take a while, tracking how many are running."""
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.active = 0
+
+    def __setitem__(self, key, value):
+        if "/." not in key and not key.startswith("."):
+            with self.lock:
+                self.active += 1
+            time.sleep(0.05)
+            with self.lock:
+                self.active -= 1
+        super().__setitem__(key, value)
+
+def test_execute_async_settles_writes_when_a_read_fails():
+    datasets = [xr.Dataset({"var": (("time",), np.random.rand(4))}, coords={"time": np.arange(4) + 4 * i}) for i in range(4)]
+    chunk_plan = UnmergedChunkPlanner(*datasets).concat(dim="time").map_chunks({"time": 1})
+    store = SlowStore()
+
+    async def fetch(zarr_key, slices):
+        if zarr_key == "var/6":
+            raise OSError("read failed")
+        return np.zeros(1)
+
+    async def run(executor):
+        try:
+            await execute_async(chunk_plan, store, fetch=fetch, prefetch=1, max_writes=4, executor=executor)
+        except OSError:
+            return store.active
+
+    # No write is left running once the failure surfaces, even on an executor the caller keeps
+    with ThreadPoolExecutor() as executor:
+        assert asyncio.run(run(executor)) == 0
+    assert asyncio.run(run(None)) == 0
+    assert {f"var/{n}" for n in range(6)} <= set(store)
@@ -0,0 +1,122 @@
+from bigchunkus.unmerged import UnmergedChunkPlanner
+from bigchunkus.plan import ChunkPlan
+from bigchunkus.zarr import format_chunk_keys
+
+import numpy as np
+import pytest
+import xarray as xr
+
+def build_plan() -> ChunkPlan:
+    ds1 = xr.Dataset({
+        "var": (("time", "x"), np.zeros((2, 5))),
+        "x_bnds": (("x", "bnds"), np.zeros((5, 2)))
+    }, coords={"time": [0, 1]})
+    ds2 = xr.Dataset({
+        "var": (("time", "x"), np.zeros((3, 5))),
+        "x_bnds": (("x", "bnds"), np.zeros((5, 2)))
+    }, coords={"time": [2, 3, 4]})
+    concat_planner = UnmergedChunkPlanner(ds1, ds2).concat(dim='time')
+    return concat_planner.map_chunks({"time": 3, "x": 2})
+
+def test_chunk_plan_resolves_keys_on_demand():
+    chunk_plan = build_plan()
+
+    assert isinstance(chunk_plan, ChunkPlan)
+    assert chunk_plan["var/0.2"] == {"time": [(0, 0, 2), (1, 0, 1)], "x": [(0, 4, 5)]}
+    assert chunk_plan["x_bnds/1.0"] == {"x": [(0, 2, 4)], "bnds": [(0, 0, 2)]}
+    assert chunk_plan["time/1"] == [(1, 1, 3)]
+    assert chunk_plan["x/2"] == [(0, 4, 5)]
+    assert chunk_plan.chunk_grid("var") == (2, 3)
+
+def test_chunk_plan_is_dict_compatible():
+    chunk_plan = build_plan()
+    as_dict = dict(chunk_plan)
+
+    # 2 time + 3 x + 1 bnds dimension keys, 2 * 3 var keys and 3 * 1 x_bnds keys
+    assert len(chunk_plan) == len(as_dict) == 6 + 6 + 3
+    assert list(chunk_plan) == list(as_dict)
+    assert chunk_plan == as_dict
+    assert dict(chunk_plan.iter_chunks()) == {key: value for key, value in as_dict.items() if "." in key}
+
+def test_iter_slabs_walks_the_plan_in_partition_order():
+    chunk_plan = build_plan()
+
+    slabs = [list(records) for records in chunk_plan.iter_slabs()]
+
+    assert [[key for key, _ in records] for records in slabs] == [["x_bnds/0.0", "x_bnds/1.0", "x_bnds/2.0"], ["var/0.0", "var/0.1", "var/0.2"], ["var/1.0", "var/1.1", "var/1.2"]]
+    assert dict(record for records in slabs for record in records) == dict(chunk_plan.iter_chunks())
+    assert [[key for key, _ in records] for records in chunk_plan.iter_slabs(["var/1.2", "x_bnds/1.0", "var/1.0"])] == [["x_bnds/1.0"], [], ["var/1.2", "var/1.0"]]
+
+@pytest.mark.parametrize("key", ["var/2.0", "var/0", "var/a.b", "time/-1", "missing/0", "var"])
+def test_chunk_plan_missing_keys(key):
+    chunk_plan = build_plan()
+
+    assert key not in chunk_plan
+    with pytest.raises(KeyError):
+        chunk_plan[key]
+
+def test_chunk_plan_save_and_open(tmp_path):
+    chunk_plan = build_plan()
+    chunk_plan.save(tmp_path / "plan")
+
+    reopened = ChunkPlan.open(tmp_path / "plan", mmap=True)
+    indptr, pieces = reopened.dim_tables["time"]
+    assert isinstance(indptr, np.memmap)
+    assert isinstance(pieces, np.memmap)
+    assert reopened["var/0.2"] == chunk_plan["var/0.2"]
+    assert reopened == chunk_plan
+    assert reopened.concat_dim == "time"
+    assert reopened.sources == [None, None]
+
+    loaded = ChunkPlan.open(tmp_path / "plan", mmap=False)
+    assert not isinstance(loaded.dim_tables["time"][1], np.memmap)
+    assert loaded == chunk_plan
+
+def build_ragged_plan(make_sources) -> ChunkPlan:
+    datasets = make_sources([7, 3, 11, 4, 9], dims={"x": 6}, extra={"x_bnds": (("x", "bnds"), np.zeros((6, 2)))})
+    return UnmergedChunkPlanner(*datasets).concat(dim='time').map_chunks({"time": 4, "x": 4})
+
+@pytest.mark.parametrize("n_workers", [1, 2, 3, 7, 40])
+def test_partition_assigns_every_chunk_once(n_workers, make_sources):
+    chunk_plan = build_ragged_plan(make_sources)
+
+    shards = chunk_plan.partition(n_workers)
+
+    assert len(shards) == n_workers
+    assert sorted(key for shard in shards for key in shard) == sorted(key for key, _ in chunk_plan.iter_chunks())
+    assert shards == [chunk_plan.shard(worker_id, n_workers) for worker_id in range(n_workers)]
+
+def test_partition_balances_bytes_and_keeps_sources_together(make_sources):
+    chunk_plan = build_ragged_plan(make_sources)
+    sizes = {key: 4 * sum(e - s for _, s, e in slices["time"]) * sum(e - s for _, s, e in slices["x"])
+             for key, slices in chunk_plan.iter_chunks() if key.startswith("var/")}
+    sizes.update({key: 8 * 4 * 2 if key.endswith("0.0") else 8 * 2 * 2 for key, _ in chunk_plan.iter_chunks() if key.startswith("x_bnds/")})
+
+    shards = chunk_plan.partition(3)
+
+    shard_bytes = [sum(sizes[key] for key in shard) for shard in shards]
+    assert max(shard_bytes) - min(shard_bytes) <= max(sizes.values())
+    # Shards cover increasing, barely overlapping runs of sources
+    source_ranges = [
+        [source for key in shard if key.startswith("var/") for source in chunk_plan.chunk_sources("var", chunk_plan[key])]
+        for shard in shards
+    ]
+    assert all(left[-1] <= right[0] for left, right in zip(source_ranges, source_ranges[1:]))
+
+def test_partition_by_chunk_count(make_sources):
+    chunk_plan = build_ragged_plan(make_sources)
+
+    assert [len(shard) for shard in chunk_plan.partition(4, weight="chunks")] == [5, 5, 5, 5]
+    with pytest.raises(ValueError):
+        chunk_plan.partition(2, weight="flops")
+    with pytest.raises(ValueError):
+        chunk_plan.shard(2, 2)
+
+def test_chunk_indices_give_plan_keys(make_sources):
+    chunk_plan = build_ragged_plan(make_sources)
+    region_plan = UnmergedChunkPlanner(*chunk_plan.sources).concat(dim="time").map_chunks({"time": 4, "x": 4}, region={"time": slice(9, 20)})
+
+    for plan in (chunk_plan, region_plan):
+        for var_name in plan.variables:
+            keys = format_chunk_keys(var_name, plan.chunk_indices(var_name)).tolist()
+            assert keys == [key for key, _ in plan.iter_chunks([var_name])]
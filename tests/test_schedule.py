@@ -0,0 +1,86 @@
+from bigchunkus.execute import BlockCache, ExecutionContext, execute, read_chunk, variable_specs
+from bigchunkus.schedule import SourceScheduler, schedule_by_source
+from bigchunkus.unmerged import UnmergedChunkPlanner
+
+import numpy as np
+import xarray as xr
+
+def build_planner(make_sources, sizes=(8, 8, 6)):
+    datasets = make_sources(sizes, variables=("tas", "pr"), dims={"x": 6}, dtype="f8", encoding={"chunksizes": (4, 6)}, write="datasets")
+    return UnmergedChunkPlanner(*datasets).concat(dim="time", full_concat=True)
+
+def test_schedule_groups_chunks_by_source_and_reads_blocks_once(make_sources):
+    chunk_plan = build_planner(make_sources).map_chunks({"time": 2, "x": 3})
+
+    schedule = schedule_by_source(chunk_plan)
+
+    assert [batch.source for batch in schedule.batches] == [0, 1, 2]
+    assert sum(len(batch.items) for batch in schedule.batches) == 2 * 11 * 2
+    assert {key.split("/")[0] for key, _ in schedule.batches[0].items} == {"tas", "pr"}
+    assert schedule.native_chunks["tas"] == {"time": 4, "x": 6}
+
+    # Each (4, 6) native block is shared by four (2, 3) output chunks
+    block_bytes = 4 * 6 * 8
+    assert schedule.stats.naive_opens == 44
+    assert schedule.stats.scheduled_opens == 3
+    assert schedule.stats.naive_bytes_read == 44 * block_bytes
+    assert schedule.stats.scheduled_bytes_read == 2 * 6 * block_bytes
+
+def test_schedule_splits_batches(make_sources):
+    chunk_plan = build_planner(make_sources).map_chunks({"time": 2, "x": 3})
+
+    schedule = schedule_by_source(chunk_plan, max_batch_bytes=4 * 2 * 3 * 8)
+
+    assert all(len(batch.items) <= 4 for batch in schedule.batches)
+    assert sum(len(batch.items) for batch in schedule.batches) == 44
+
+def test_scheduler_streams_batches_source_by_source(make_sources):
+    chunk_plan = build_planner(make_sources).map_chunks({"time": 2, "x": 3})
+    scheduler = SourceScheduler(chunk_plan)
+
+    first = next(scheduler.batches())
+
+    # Source 0 is batched once the first slab reading source 1 is reached, not at the end
+    assert first.source == 0
+    assert len(first.items) == 2 * 4 * 2
+    assert scheduler.naive_opens < 44
+
+def test_scheduler_batches_only_selected_keys(make_sources):
+    chunk_plan = build_planner(make_sources).map_chunks({"time": 2, "x": 3})
+    keys = ["pr/10.1", "tas/0.0", "tas/5.1"]
+
+    batches = list(SourceScheduler(chunk_plan).batches(keys, select=lambda key: key != "pr/10.1"))
+
+    assert [(batch.source, [key for key, _ in batch.items]) for batch in batches] == [(0, ["tas/0.0"]), (1, ["tas/5.1"])]
+
+def test_block_cache_holds_blocks_until_their_last_read(make_sources):
+    chunk_plan = build_planner(make_sources).map_chunks({"time": 2, "x": 3})
+    # Batches of two chunks, each reading half of a (4, 6) native block another batch reads too
+    schedule = schedule_by_source(chunk_plan, max_batch_bytes=2 * 2 * 3 * 8)
+    specs = variable_specs(chunk_plan)
+    context = ExecutionContext({}, None, None, 8)
+
+    for batch in schedule.batches:
+        blocks = BlockCache(schedule.native_chunks)
+        items = [(key, chunk_plan.chunk_pieces(key.rpartition("/")[0], slices)) for key, slices in batch.items]
+        for key, pieces in items:
+            blocks.expect(specs[key.rpartition("/")[0]], pieces)
+        peak = 0
+        for key, pieces in items:
+            read_chunk(context, specs[key.rpartition("/")[0]], pieces, dict(enumerate(chunk_plan.sources)), blocks)
+            peak = max(peak, blocks.nbytes)
+
+        assert blocks.blocks_read * 4 * 6 * 8 == batch.read_bytes
+        assert blocks.nbytes == 0
+        assert peak <= batch.cache_bytes <= batch.read_bytes
+
+def test_execute_by_source_matches_per_chunk_execution(tmp_path, make_sources):
+    concat_planner = build_planner(make_sources, sizes=(5, 4, 6))
+    chunk_plan = concat_planner.map_chunks({"time": 3, "x": 4})
+
+    stats = execute(chunk_plan, str(tmp_path / "out.zarr"), by_source=True)
+
+    assert stats["written"] == 2 * 5 * 2
+    result = xr.open_zarr(str(tmp_path / "out.zarr"), consolidated=False, zarr_format=2)
+    for name in ["tas", "pr"]:
+        np.testing.assert_array_equal(result[name].values, concat_planner.merged_dataset[name].values)
@@ -0,0 +1,112 @@
+from bigchunkus.base import BaseChunkPlanner
+from bigchunkus.single import SingleSourceChunkPlanner
+from bigchunkus.util import block_ranges
+
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import math
+import threading
+
+import pytest
+import xarray as xr
+
+# One native chunk per time step, as for a file of daily maps
+MAPS = dict(variables=("tas",), dims={"y": 8, "x": 6}, attrs={"units": "K"}, encoding={"chunksizes": (1, 8, 6)}, write="datasets", name="maps.nc")
+
+class RecordingExecutor(ThreadPoolExecutor):
+    """Thread pool recording the most bytes held at once by the batches it runs: their chunks and cached native chunks."""
+
+    def __init__(self):
+        super().__init__(max_workers=8)
+        self.lock = threading.Lock()
+        self.in_flight = self.peak = 0
+
+    def submit(self, task):
+        _, specs, items, _, native_chunks = task.args
+        nbytes, reads = 0, []
+        for zarr_key, pieces in items:
+            spec = specs[zarr_key.rpartition("/")[0]]
+            native = native_chunks[spec.name]
+            for source, region, _ in pieces:
+                nbytes += math.prod(end - start for start, end in region.values()) * spec.dtype.itemsize
+                ranges = [block_ranges(*region[dim], native[dim]) for dim in spec.dims]
+                reads.extend((source, spec.name, block) for block in itertools.product(*ranges))
+        # Native chunks are cached from their first read to their last
+        last_read = {block: n for n, block in enumerate(reads)}
+        cached, block_bytes = set(), 0
+        for n, block in enumerate(reads):
+            cached.add(block)
+            block_bytes = max(block_bytes, sum(math.prod(native_chunks[name].values()) * specs[name].dtype.itemsize for _, name, _ in cached))
+            if last_read[block] == n:
+                cached.discard(block)
+        held = nbytes + block_bytes
+
+        with self.lock:
+            self.in_flight += held
+            self.peak = max(self.peak, self.in_flight)
+        future = super().submit(task)
+        future.add_done_callback(lambda _: self._release(held))
+        return future
+
+    def _release(self, held):
+        with self.lock:
+            self.in_flight -= held
+
+def test_map_chunks_plans_single_source(make_sources):
+    dataset = make_sources([24], **MAPS)[0]
+    planner = BaseChunkPlanner.from_datasets(dataset)
+
+    chunk_plan = planner.map_chunks({"time": 10, "y": 4})
+
+    assert isinstance(planner, SingleSourceChunkPlanner)
+    assert chunk_plan.chunk_definition == {"time": 10, "y": 4, "x": 6}
+    assert chunk_plan["tas/2.1.0"] == {"time": [(0, 20, 24)], "y": [(0, 4, 8)], "x": [(0, 0, 6)]}
+
+def test_small_rechunk_is_a_single_copy(tmp_path, make_sources):
+    dataset = make_sources([24], **MAPS)[0]
+    planner = SingleSourceChunkPlanner(dataset)
+
+    stages = planner.rechunk({"time": 4}, max_mem=2**20, target_store=str(tmp_path / "out.zarr"))
+
+    assert len(stages) == 1
+    stages[0].execute()
+    result = xr.open_zarr(str(tmp_path / "out.zarr"), consolidated=False, zarr_format=2)
+    xr.testing.assert_identical(result.load(), dataset.load())
+
+def test_time_to_space_rechunk_goes_through_intermediate_store(tmp_path, make_sources):
+    dataset = make_sources([24], **MAPS)[0]
+    planner = SingleSourceChunkPlanner(dataset)
+    max_mem = 2000
+    target = {"time": 24, "y": 2, "x": 3}
+
+    stages = planner.rechunk(target, max_mem, str(tmp_path / "out.zarr"), temp_store=str(tmp_path / "temp.zarr"))
+
+    # Maps of 192 bytes: 5 fit in half the budget, read into (5, 2, 3) intermediate chunks
+    assert [stage.plan.chunk_definition for stage in stages] == [{"time": 5, "y": 2, "x": 3}, target]
+    for stage in stages:
+        stage.execute()
+    result = xr.open_zarr(str(tmp_path / "out.zarr"), consolidated=False, zarr_format=2)
+    assert result["tas"].encoding["chunks"] == (24, 2, 3)
+    xr.testing.assert_identical(result.load(), dataset.load())
+
+def test_rechunk_needs_temp_store_and_chunks_within_budget(tmp_path, make_sources):
+    planner = SingleSourceChunkPlanner(make_sources([24], **MAPS)[0])
+
+    with pytest.raises(ValueError, match="temp_store"):
+        planner.rechunk({"time": 24, "y": 2, "x": 3}, 2000, str(tmp_path / "out.zarr"))
+    with pytest.raises(ValueError, match="Target chunks"):
+        planner.stage_chunks({"time": 24}, 2000)
+
+def test_rechunk_stages_hold_batches_within_max_mem(tmp_path, make_sources):
+    dataset = make_sources([96], **MAPS)[0]
+    max_mem = 2000
+    stages = SingleSourceChunkPlanner(dataset).rechunk(
+        {"time": 96, "y": 1, "x": 3}, max_mem, str(tmp_path / "out.zarr"), temp_store=str(tmp_path / "temp.zarr"),
+    )
+
+    for stage in stages:
+        with RecordingExecutor() as executor:
+            stage.execute(executor=executor)
+        assert 0 < executor.peak <= max_mem
+    result = xr.open_zarr(str(tmp_path / "out.zarr"), consolidated=False, zarr_format=2)
+    xr.testing.assert_identical(result.load(), dataset.load())
@@ -0,0 +1,54 @@
+from bigchunkus import sources
+from bigchunkus.base import BaseChunkPlanner
+from bigchunkus.sources import SourceMetadata, read_metadata
+from bigchunkus.unmerged import UnmergedChunkPlanner
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+SOURCES = dict(coords={"time": pd.date_range("2000-01-01", periods=8)}, encoding={"chunksizes": (1, 5)}, write="paths")
+
+def test_metadata_round_trips_through_dict():
+    ds = xr.Dataset({"var": (("time",), np.zeros(3, dtype="i2"))}, coords={"time": pd.date_range("2000-01-01", periods=3)})
+    metadata = SourceMetadata.from_dataset(ds)
+
+    loaded = SourceMetadata.from_dict(metadata.to_dict())
+
+    assert loaded.to_dict() == metadata.to_dict()
+    np.testing.assert_array_equal(loaded.bounds["time"], np.array(["2000-01-01", "2000-01-03"], dtype="M8[ns]"))
+
+def test_from_paths_matches_from_datasets(make_sources):
+    paths = make_sources([3, 1, 4], **SOURCES)
+    datasets = [xr.open_dataset(path, engine="h5netcdf") for path in paths]
+    chunk_definition = {"time": 3, "x": 2}
+
+    # Listed out of order, so the cached first coordinate has to order them
+    from_paths = BaseChunkPlanner.from_paths(paths[::-1], max_workers=2).concat(dim="time")
+    from_datasets = UnmergedChunkPlanner(*datasets).concat(dim="time")
+
+    assert from_paths.source_datasets == paths
+    assert from_paths.map_chunks(chunk_definition) == from_datasets.map_chunks(chunk_definition)
+    assert from_paths.metadata.native_chunks == {"var": {"time": 1, "x": 5}}
+    assert from_paths.coords["time"].identical(from_datasets.coords["time"])
+
+def test_index_skips_unchanged_files(tmp_path, monkeypatch, make_sources):
+    paths = make_sources([3, 1, 4], **SOURCES)
+    index = str(tmp_path / "index.json")
+    first = read_metadata(paths, engine="h5netcdf", index=index)
+
+    opened = []
+    read_header = sources._read_header
+    monkeypatch.setattr(sources, "_read_header", lambda path, engine=None: opened.append(path) or read_header(path, engine))
+    assert [metadata.to_dict() for metadata in read_metadata(paths, engine="h5netcdf", index=index)] == [metadata.to_dict() for metadata in first]
+    assert opened == []
+
+    xr.Dataset({"var": (("time", "x"), np.zeros((2, 5), dtype="f4"))}, coords={"time": [0, 1]}).to_netcdf(paths[1], engine="h5netcdf")
+    again = read_metadata(paths, engine="h5netcdf", index=index)
+    assert opened == [paths[1]]
+    assert again[1].sizes == {"time": 2, "x": 5}
+
+def test_from_paths_requires_paths():
+    with pytest.raises(ValueError):
+        BaseChunkPlanner.from_paths([])
@@ -0,0 +1,59 @@
+from bigchunkus.schedule import chunk_blocks, schedule_by_source
+from bigchunkus.tuning import suggest_chunks
+from bigchunkus.unmerged import UnmergedChunkPlanner
+
+import pytest
+
+def build_planner(make_sources, n_sources=6, n_time=24):
+    datasets = make_sources([n_time] * n_sources, variables=("tas",), dims={"lat": 32, "lon": 64}, encoding={"chunksizes": (n_time, 16, 16)})
+    return UnmergedChunkPlanner(*datasets).concat(dim="time")
+
+def test_read_estimate_matches_schedule(make_sources):
+    concat_planner = build_planner(make_sources)
+    chunk_definition = {"time": 10, "lat": 8, "lon": 32}
+
+    [estimate] = suggest_chunks(concat_planner, target_bytes=10 * 8 * 32 * 4, max_mem=2**30, candidates={dim: [size] for dim, size in chunk_definition.items()})
+    stats = schedule_by_source(concat_planner.plan(chunk_definition)).stats
+
+    assert estimate.chunk_definition == chunk_definition
+    assert estimate.read_bytes == stats.naive_bytes_read
+    assert estimate.n_objects == 15 * 4 * 2
+    assert estimate.files_per_chunk == pytest.approx(19 / 15)  # sources end at 24, 48, 72 and 96 mid-chunk
+    assert estimate.read_amplification == pytest.approx(stats.naive_bytes_read / (144 * 32 * 64 * 4))
+
+    # The worst chunk straddles a source boundary, reading two native chunks along time (one
+    # per source) by two along lon
+    chunk_plan = concat_planner.plan(chunk_definition)
+    native_chunks = {"time": 24, "lat": 16, "lon": 16}
+    most_blocks = max(len(list(chunk_blocks(chunk_plan, "tas", slices, native_chunks))) for _, slices in chunk_plan.iter_chunks())
+    assert most_blocks == 4
+    assert estimate.working_bytes == 10 * 8 * 32 * 4 + most_blocks * 24 * 16 * 16 * 4
+
+def test_suggest_chunks_follows_access_pattern(make_sources):
+    concat_planner = build_planner(make_sources)
+    target_bytes = 2**16
+
+    [timeseries, *_] = suggest_chunks(concat_planner, target_bytes=target_bytes, access_pattern="timeseries")
+    [spatial, *_] = suggest_chunks(concat_planner, target_bytes=target_bytes, access_pattern="spatial")
+
+    assert timeseries.chunk_definition["time"] == 144
+    assert spatial.chunk_definition["lat"] * spatial.chunk_definition["lon"] == 32 * 64
+    for estimate in [timeseries, spatial]:
+        assert target_bytes / 4 <= estimate.chunk_bytes <= target_bytes
+
+def test_suggest_chunks_without_access_pattern_aligns_with_native_chunks(make_sources):
+    estimates = suggest_chunks(build_planner(make_sources), target_bytes=24 * 16 * 16 * 4, top=3)
+
+    assert estimates[0].read_amplification == pytest.approx(1.0)
+    assert estimates[0].query_bytes is None
+    assert [e.read_bytes for e in estimates] == sorted(e.read_bytes for e in estimates)
+
+def test_suggest_chunks_rejects_unknown_access_pattern(make_sources):
+    with pytest.raises(ValueError):
+        suggest_chunks(build_planner(make_sources), access_pattern="diagonal")
+
+def test_suggest_chunks_rejects_empty_sources(make_sources):
+    planner = UnmergedChunkPlanner(*make_sources([4, 4], dims={"lat": 0})).concat(dim="time")
+
+    with pytest.raises(ValueError, match="no data"):
+        suggest_chunks(planner)
@@ -1,6 +1,7 @@
+import numpy as np
 import pytest
 
-from bigchunkus.zarr import build_zarr_key_generator
+from bigchunkus.zarr import build_zarr_key_generator, format_chunk_keys, iter_chunk_keys
 
 def test_generate_zarr_key_basic():
     # Basic case with 2 dimensions
@@ -70,3 +71,29 @@ def test_build_zarr_generator_missing_dimension_in_chunk_definition():
 
     with pytest.raises(KeyError):
         build_zarr_key_generator(variable_name, chunk_definition, variable_dims)
+
+def test_format_chunk_keys_matches_generator():
+    chunk_definition = {"time": 10, "lat": 25}
+    generate_zarr_key = build_zarr_key_generator("temperature", chunk_definition, ["time", "lat"])
+    chunk_indices = np.array([[0, 0], [2, 11], [13, 4]])
+
+    keys = format_chunk_keys("temperature", chunk_indices)
+
+    assert keys.tolist() == [generate_zarr_key([t * 10, y * 25]) for t, y in chunk_indices]
+
+def test_format_chunk_keys_of_sparse_indices():
+    chunk_indices = np.array([[0, 10**12], [7, 3], [0, 3]])
+
+    assert format_chunk_keys("tas", chunk_indices).tolist() == ["tas/0.1000000000000", "tas/7.3", "tas/0.3"]
+    assert list(iter_chunk_keys("tas", [[0, 7], [3, 10**12]])) == ["tas/0.3", "tas/0.1000000000000", "tas/7.3", "tas/7.1000000000000"]
+
+def test_chunk_keys_of_scalars():
+    assert format_chunk_keys("scalar", np.zeros((1, 0), dtype=int)).tolist() == ["scalar/0"]
+    assert list(iter_chunk_keys("scalar", [])) == ["scalar/0"]
+
+def test_iter_chunk_keys_is_row_major():
+    assert list(iter_chunk_keys("var", [range(2), range(3, 5)])) == ["var/0.3", "var/0.4", "var/1.3", "var/1.4"]
+
+def test_chunk_keys_reject_bad_input():
+    with pytest.raises(ValueError):
+        format_chunk_keys("tas", np.array([1, 2]))